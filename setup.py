@@ -20,6 +20,7 @@ setup(
     entry_points={
         'console_scripts': [
             'slackbot = werewolf.app:main',
+            'werewolf-owner = werewolf.owner:main',
         ],
     },
 
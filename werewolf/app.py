@@ -1,15 +1,26 @@
+import atexit
 import flask
 from functools import partial
 import logging
+import os
 import queue
+import requests
 import threading
 import time
+from werkzeug.serving import make_server
 
 from .service import Agent, Channel
-from .service.slack import load_config, validate_token, get_service
-from .dispatch import QueuingDispatch, MuxDispatch
+from .service.slack import load_config, validate_token, get_service, get_cluster
+from .cluster import FORWARDED
+from .dispatch import QueuingDispatch, ShardedMuxDispatch
+from . import handoff, inbound, journal, leader
+from .ingress import Deduplicator
+from .ipc import IPCClient, ForwardingDispatch, RemoteDeduplicator, RemoteRoutes
+from .prefilter import Prefilter, CHATTER, DROP
+from .scheduler import FairScheduler, BACKGROUND, classify
+from .shard import ProcessShardDispatch
 from .game import GeneralWerewolf, SpecificWerewolf
-from .persist import load
+from .persist import load, Snapshots
 from .rules import load_games
 
 
@@ -24,15 +35,110 @@ load_games()
 BASE_PATH = '/slack/werewolf'
 
 
-QUEUE = queue.Queue()
-DISPATCHER = QueuingDispatch(queue=QUEUE)
-RUNNER = load('mux',
-              default=partial(MuxDispatch, queue=QUEUE, default=GeneralWerewolf()),
-              factory=partial(MuxDispatch.load, queue=QUEUE,
-                              default_type=GeneralWerewolf,
-                              default_factory=GeneralWerewolf.load,
-                              target_factory=SpecificWerewolf.load))
-RUNNER.start()
+PREFILTER = Prefilter()
+
+
+def lane(m):
+    """Ordinary discussion in a game's channels is handled after everything else"""
+    return BACKGROUND if PREFILTER.classify_item(m) == CHATTER else classify(m)
+
+
+def expendable(m):
+    """Under load, that discussion may be dropped altogether"""
+    return PREFILTER.classify_item(m) == CHATTER
+
+
+DRAINING = False
+
+
+def shutdown():
+    """Stop taking events; handle those already queued, up to a deadline, and write everything out"""
+    global DRAINING
+    if RUNNER is None or DRAINING:
+        return
+    DRAINING = True
+    deadline = time.time() + handoff.DRAIN_TIMEOUT
+    if not handoff.within(QUEUE.join, handoff.DRAIN_TIMEOUT):
+        LOG.warning('%d events are still queued; they will be replayed from the journal', QUEUE.qsize())
+    # Changes held back by the write window
+    if not handoff.within(RUNNER.flush, max(deadline - time.time(), 1)):
+        LOG.warning('Gave up waiting for games to be written out')
+
+
+# With INGRESS_FORWARD set, this process only accepts events and forwards them to the
+# game-owner process (see werewolf.owner) listening on that unix socket; any number of
+# such HTTP workers may then be run.
+INGRESS_FORWARD = os.environ.get('INGRESS_FORWARD')
+if INGRESS_FORWARD:
+    IPC = IPCClient(path=INGRESS_FORWARD)
+    QUEUE = None
+    DISPATCHER = ForwardingDispatch(client=IPC)
+    DEDUP = RemoteDeduplicator(client=IPC)
+    RUNNER = None
+    INBOUND = None
+    INHERITED = []
+    PREFILTER.routes = RemoteRoutes(client=IPC, ttl=float(os.environ.get('INGRESS_ROUTES_TTL', 2)))
+else:
+    # A process that we are replacing writes everything out before it passes its sockets over
+    INHERITED = handoff.take_over(handoff.HANDOFF_SOCKET) if handoff.HANDOFF_SOCKET else []
+    # Only one process at a time may work on DATA_DIR; a process we replace passes its lock over too
+    LEADERSHIP = leader.lead(fd=INHERITED[1] if len(INHERITED) > 1 else None)
+    QUEUE = FairScheduler(classify=lane, maxsize=int(os.environ.get('INGRESS_MAXSIZE', 1000)),
+                          policy=os.environ.get('INGRESS_POLICY', 'reject'),
+                          shed=expendable)
+    WORKERS = int(os.environ.get('WORKERS', 4))
+    RESOLVERS = int(os.environ.get('RESOLVERS', 4))
+    SHARD_PROCESSES = int(os.environ.get('SHARD_PROCESSES', 0))
+    if SHARD_PROCESSES > 0:
+        Runner, RUNNER_ARGS = ProcessShardDispatch, dict(processes=SHARD_PROCESSES, srv_lookup=get_service)
+    else:
+        Runner, RUNNER_ARGS = ShardedMuxDispatch, dict(workers=WORKERS)
+    WRITE_WINDOW = float(os.environ.get('WRITE_WINDOW', 10))
+    RUNNER_ARGS['write_window'] = WRITE_WINDOW
+    if os.environ.get('BGSAVE'):
+        if journal.ENABLED:
+            # A game's journal is discarded as its snapshot is saved, which must not happen first
+            LOG.warning('BGSAVE is not used with JOURNAL, which already keeps snapshots rare')
+        elif SHARD_PROCESSES > 0:
+            # Shard processes write their games out as they change; only the lobby is saved here
+            LOG.warning('BGSAVE is not used with SHARD_PROCESSES, whose shards write games out themselves')
+        else:
+            # Games are written out by forked children (see werewolf.persist)
+            RUNNER_ARGS['snapshots'] = Snapshots()
+    # Games idle for this long are swapped out of memory until they are next needed
+    RUNNER_ARGS['idle_timeout'] = float(os.environ.get('IDLE_TIMEOUT', 3600))
+    # Nothing waits on the dispatcher's threads at exit; shutdown() drains them instead
+    RUNNER_ARGS['daemon'] = True
+    # Accepted events are journalled, so that a crash or restart does not lose them
+    INBOUND = inbound.journal() if inbound.ENABLED else None
+    RUNNER_ARGS['inbound'] = INBOUND
+    DISPATCHER = QueuingDispatch(queue=QUEUE, inbound=INBOUND)
+    DEDUP = Deduplicator(ttl=int(os.environ.get('DEDUP_TTL', 600)))
+    RUNNER = load('mux',
+                  default=partial(Runner, queue=QUEUE, resolvers=RESOLVERS, default=GeneralWerewolf(),
+                                  target_factory=SpecificWerewolf.load, **RUNNER_ARGS),
+                  factory=partial(Runner.load, queue=QUEUE, resolvers=RESOLVERS, **RUNNER_ARGS,
+                                  default_type=GeneralWerewolf,
+                                  default_factory=GeneralWerewolf.load,
+                                  target_factory=SpecificWerewolf.load))
+    PREFILTER.routes = RUNNER.route_ids
+    RUNNER.default.routes = RUNNER.route_ids
+    RUNNER.start()
+    if os.environ.get('PRELOAD'):
+        # Games are otherwise loaded as they are first needed
+        RUNNER.preload()
+    if INBOUND is not None:
+        DISPATCHER.replay(srv_lookup=get_service)
+    atexit.register(shutdown)
+
+
+def owner_stats():
+    stats = {'queue': QUEUE.stats(), 'dedup': DEDUP.stats(), 'games': RUNNER.stats()}
+    if RUNNER.snapshots is not None:
+        stats['snapshots'] = RUNNER.snapshots.stats()
+    if INBOUND is not None:
+        stats['inbound'] = INBOUND.stats()
+    return stats
 
 
 # Set up logging
@@ -51,9 +157,16 @@ def root(*args, **kwargs):
         LOG.debug("request is %s", args)
         return flask.Response(args['challenge'], 200)
 
+    if DRAINING:
+        # Slack will retry the delivery, by which time our successor will be serving
+        return flask.Response('', status=503)
+
     team = args.get('team_id')
     if team is None:
         return flask.Response('', status=404)
+    if not owned(team):
+        return forward(team, data=flask.request.get_data(),
+                       headers={'Content-Type': flask.request.headers.get('Content-Type', 'application/json')})
     service = get_service(team)
     if service is None:
         return flask.Response('', status=404)
@@ -78,8 +191,22 @@ def root(*args, **kwargs):
             elif event.get('channel_type') == 'im':
                 channel = channel.replace(is_im=True)
             receivers = [Agent(id=rcv, is_bot=True) for rcv in args.get('authed_users', [])]
-            DISPATCHER.raw_message(srv=service, sender=sender, channel=channel, receivers=receivers,
-                                   text=text, message_id=ts)
+            if PREFILTER.classify(channel=channel, sender=sender, receivers=receivers, text=text) == DROP:
+                return flask.Response('', 200)
+
+            # Slack redelivers events that we were slow to acknowledge
+            key = args.get('event_id') or '{}:{}:{}'.format(team, event.get('channel'), ts)
+            if not DEDUP.claim(key):
+                LOG.info('Dropping duplicate event %s (retry %s)', key,
+                         flask.request.headers.get('X-Slack-Retry-Num'))
+                return flask.Response('', 200)
+            try:
+                DISPATCHER.raw_message(srv=service, sender=sender, channel=channel, receivers=receivers,
+                                       text=text, message_id=ts)
+            except (queue.Full, OSError):
+                # Slack will retry the delivery later
+                DEDUP.release(key)
+                return flask.Response('', status=503)
 
         else:
             LOG.debug('args are %s', {k: args[k] for k in args if k != 'token'})
@@ -87,25 +214,77 @@ def root(*args, **kwargs):
     return flask.Response('', 200)
 
 
+def owned(team):
+    cluster = get_cluster()
+    return cluster is None or cluster.owns(team)
+
+
+def forward(team, method='POST', **kwargs):
+    """Pass a request for a team owned by another node on to that node"""
+    if flask.request.headers.get(FORWARDED):
+        LOG.warning('Not forwarding request for team %s a second time (from %s)',
+                    team, flask.request.headers.get(FORWARDED))
+        return flask.Response('', status=404)
+    try:
+        response = get_cluster().forward(team, flask.request.path, method=method, **kwargs)
+    except requests.RequestException:
+        LOG.exception('Problem forwarding request for team %s', team)
+        return flask.Response('', status=503)
+    return flask.Response(response.content, status=response.status_code)
+
+
+@app.route(BASE_PATH + "/stats", methods=['GET'])
+def stats():
+    if INGRESS_FORWARD:
+        return flask.jsonify(IPC.call('stats'))
+    return flask.jsonify(owner_stats())
+
+
 @app.route(BASE_PATH + "/oauth/<team>", methods=['GET'])
 def oauth(team):
     args = flask.request.args
+    if DRAINING:
+        # As for events; the user can follow the link again
+        return flask.Response('', status=503)
+    if not owned(team):
+        return forward(team, method='GET', params=args)
     service = get_service(team)
     if service is not None:
-        DISPATCHER.oauth_callback(srv=service, code=args['code'], state=args['state'])
+        try:
+            DISPATCHER.oauth_callback(srv=service, code=args['code'], state=args['state'])
+        except (queue.Full, OSError):
+            return flask.Response('', status=503)
     return flask.Response('', 200)
 
 
 @app.before_first_request
 def activate_timer():
+    if RUNNER is None:
+        # The owner process keeps time
+        return
+
     def tick():
         while True:
+            # Sleep until the next game's phase is due to end
+            RUNNER.deadlines.wait()
             LOG.debug("Time marches on")
             DISPATCHER.tick(srv_lookup=get_service)
-            time.sleep(60)
 
-    threading.Thread(target=tick).start()
+    threading.Thread(target=tick, daemon=True).start()
 
 
 def main():
-    app.run(host='0.0.0.0', port=5002)
+    handoff.on_terminate()
+    server = make_server('0.0.0.0', 5002, app, threaded=True, fd=INHERITED[0] if INHERITED else None)
+    successor = None
+    if handoff.HANDOFF_SOCKET:
+        def stop():
+            server.shutdown()
+            shutdown()
+        successor = handoff.HandoffListener(path=handoff.HANDOFF_SOCKET, stop=stop,
+                                            fds=lambda: [server.fileno(), LEADERSHIP.fileno()], daemon=True)
+        successor.start()
+    server.serve_forever()
+    if successor is not None:
+        # Serving stopped for a handover, which exits once it is done
+        successor.join()
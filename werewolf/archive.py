@@ -0,0 +1,145 @@
+"""An archive of finished games
+
+Each finished game is appended, in its compact compressed form, to the segment file
+for the month in which it ended; a line describing it is appended to a JSON-lines
+index alongside. Listing games only reads the index, and fetching one reads just that
+game's bytes from its segment.
+
+    python -m werewolf.archive list [--team T] [--player P] [--winner W] [--since YYYY-MM-DD]
+    python -m werewolf.archive show SEGMENT OFFSET
+"""
+
+import argparse
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+
+from flock import Flock, LOCK_EX
+
+from . import persist
+from .codec import unpack
+
+LOG = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('ARCHIVE', '1') not in ('', '0')
+INDEX = 'index.jsonl'
+
+
+class Archive:
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def add(self, game, at=None):
+        """Archive a finished game; returns its index entry"""
+        at = time.time() if at is None else at
+        data = game.save()
+        segment = time.strftime('%Y-%m', time.gmtime(at)) + '.seg'
+        entry = {
+            'team': game.team,
+            'index': game.index,
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(at)),
+            'rules': game.rules.get('name'),
+            'winner': game.winner,
+            'players': {p.id: p.name for p in game.roles},
+            'roles': {p.id: role.role.name for p, role in game.roles.items()},
+            'dead': [p.id for p in game.dead],
+            'segment': segment,
+            'length': len(data),
+        }
+        with self.lock:
+            index = os.open(os.path.join(self.path, INDEX), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                # With SHARD_PROCESSES, several processes archive games; the lock on the index keeps them apart
+                with Flock(index, LOCK_EX):
+                    f = os.open(os.path.join(self.path, segment), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                    try:
+                        entry['offset'] = os.fstat(f).st_size
+                        written = 0
+                        while written < len(data):
+                            written += os.write(f, data[written:])
+                    finally:
+                        os.close(f)
+                    os.write(index, (json.dumps(entry) + '\n').encode('utf-8'))
+            finally:
+                os.close(index)
+        return entry
+
+    def entries(self, team=None, player=None, winner=None, role=None, since=None, until=None):
+        """Describe the archived games that match every condition given; dates are YYYY-MM-DD"""
+        try:
+            f = open(os.path.join(self.path, INDEX))
+        except FileNotFoundError:
+            return
+        with f:
+            for line in f:
+                entry = json.loads(line)
+                if team is not None and entry['team'] != team:
+                    continue
+                if player is not None and player not in entry['players']:
+                    continue
+                if winner is not None and entry['winner'] != winner:
+                    continue
+                if role is not None and role not in entry['roles'].values():
+                    continue
+                if since is not None and entry['finished'][:10] < since:
+                    continue
+                if until is not None and entry['finished'][:10] > until:
+                    continue
+                yield entry
+
+    def fetch(self, entry, cls=None):
+        """Load an archived game"""
+        with open(os.path.join(self.path, entry['segment']), 'rb') as f:
+            f.seek(entry['offset'])
+            data = f.read(entry['length'])
+        if cls is None:
+            from .game import SpecificWerewolf as cls
+        return unpack(data, cls=cls)
+
+
+_archives = {}
+
+
+def archive(data_dir=None):
+    path = os.path.join(data_dir or persist._data_dir(), 'archive')
+    if path not in _archives:
+        _archives[path] = Archive(path=path)
+    return _archives[path]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Look through the archive of finished games')
+    commands = parser.add_subparsers(dest='command', required=True)
+    listing = commands.add_parser('list')
+    for option in ('team', 'player', 'winner', 'role', 'since', 'until'):
+        listing.add_argument('--' + option)
+    show = commands.add_parser('show')
+    show.add_argument('segment')
+    show.add_argument('offset', type=int)
+    args = parser.parse_args(argv)
+
+    a = archive()
+    if args.command == 'list':
+        for entry in a.entries(team=args.team, player=args.player, winner=args.winner, role=args.role,
+                               since=args.since, until=args.until):
+            print(json.dumps(entry))
+    else:
+        for entry in a.entries():
+            if entry['segment'] == args.segment and entry['offset'] == args.offset:
+                game = a.fetch(entry)
+                print(json.dumps({'winner': game.winner, 'rules': game.rules.get('name'),
+                                  'players': [p.name for p in game.players],
+                                  'dead': [p.name for p in game.dead],
+                                  'roles': {p.name: r.role.name for p, r in game.roles.items()}}, indent=2))
+                break
+        else:
+            raise SystemExit('No game at {} offset {}'.format(args.segment, args.offset))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+import multiprocessing
+
+from .archive import Archive
+from .game_test import test_run_to_conclusion
+from .roles import WEREWOLF
+
+
+def test_archive_lists_and_fetches(tmp_path):
+    a = Archive(path=str(tmp_path))
+    srv, bot, players, lost = test_run_to_conclusion(cast_vote=lambda game, p: game.roles[p].role.name == WEREWOLF)
+    srv, bot, players, won = test_run_to_conclusion(cast_vote=lambda game, p: game.roles[p].role.name != WEREWOLF)
+    a.add(lost, at=1700000000)      # November 2023
+    a.add(won, at=1720000000)       # July 2024
+
+    assert [e['winner'] for e in a.entries()] == [lost.winner, won.winner]
+    assert [e['winner'] for e in a.entries(since='2024-01-01')] == [won.winner]
+    assert len({e['segment'] for e in a.entries()}) == 2
+    assert len(list(a.entries(player=players[0].id))) == 2
+    assert list(a.entries(player='NOBODY')) == []
+    assert len(list(a.entries(role='werewolf'))) == 2
+
+    entry, = a.entries(winner=won.winner)
+    game = a.fetch(entry)
+    assert game.winner == won.winner
+    assert game.dead == won.dead
+    assert {p: r.role.name for p, r in game.roles.items()} == {p: r.role.name for p, r in won.roles.items()}
+
+
+def test_processes_archive_side_by_side(tmp_path):
+    a = Archive(path=str(tmp_path))
+    srv, bot, players, game = test_run_to_conclusion(cast_vote=lambda game, p: game.roles[p].role.name != WEREWOLF)
+
+    def add(first):
+        for index in range(first, first + 50):
+            game.index = index
+            a.add(game, at=1720000000)
+
+    ctx = multiprocessing.get_context('fork')
+    processes = [ctx.Process(target=add, args=(first,)) for first in range(0, 400, 50)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+
+    entries = list(a.entries())
+    assert sorted(e['index'] for e in entries) == list(range(400))
+    assert len({e['offset'] for e in entries}) == 400
+    for entry in entries:
+        assert a.fetch(entry).index == entry['index']
@@ -0,0 +1,25 @@
+"""The time, as the games see it
+
+While a game's journal is replayed, the clock is held at the moment each recorded
+event originally happened."""
+
+from contextlib import contextmanager
+import threading
+import time
+
+_frozen = threading.local()
+
+
+def now():
+    at = getattr(_frozen, 'at', None)
+    return time.time() if at is None else at
+
+
+@contextmanager
+def frozen(at):
+    previous = getattr(_frozen, 'at', None)
+    _frozen.at = at
+    try:
+        yield
+    finally:
+        _frozen.at = previous
@@ -0,0 +1,167 @@
+"""Spread teams across several nodes
+
+Each node owns a slice of the teams, chosen by consistent hashing of the team id, and
+has its own data directory and its own games. Any node may receive an event; one for a
+team that it doesn't own is passed on to the owner. The nodes are listed in the config:
+
+    nodes:
+      a: http://10.0.0.1:5002
+      b: http://10.0.0.2:5002
+
+and each node is told which it is by the NODE environment variable.
+
+When the list of nodes changes, stop them all and run
+
+    python -m werewolf.cluster a=/data/a b=/data/b
+
+to move each team's persisted games to the data directory of its new owner."""
+
+import bisect
+from collections import namedtuple
+import hashlib
+import logging
+import os
+import sys
+
+import requests
+import yaml
+
+from .codec import pack, unpack
+from .game import SpecificWerewolf
+from .persist import load, save, drop, batch, append, entries, truncate
+
+LOG = logging.getLogger(__name__)
+
+FORWARDED = 'X-Werewolf-Forwarded'
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Each node is placed at many points on the ring; a key belongs to the next node along"""
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.points = []    # (hash, node)
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            bisect.insort(self.points, (_hash('{}#{}'.format(node, i)), node))
+
+    def remove(self, node):
+        self.points = [point for point in self.points if point[1] != node]
+
+    def owner(self, key):
+        if not self.points:
+            return None
+        i = bisect.bisect(self.points, (_hash(str(key)),))
+        return self.points[i % len(self.points)][1]
+
+
+class Cluster:
+    def __init__(self, nodes=None, node=None, replicas=64):
+        self.nodes = dict(nodes or {})     # name: base URL
+        self.node = node
+        self.ring = HashRing(sorted(self.nodes), replicas=replicas)
+        if node not in self.nodes:
+            raise ValueError('This node ({}) is not among the configured nodes'.format(node))
+
+    def owner(self, team):
+        return self.ring.owner(team)
+
+    def owns(self, team):
+        return self.owner(team) == self.node
+
+    def forward(self, team, path, method='POST', **kwargs):
+        """Pass a request on to the team's owner"""
+        headers = dict(kwargs.pop('headers', {}), **{FORWARDED: self.node})
+        url = self.nodes[self.owner(team)].rstrip('/') + path
+        return requests.request(method, url, headers=headers, timeout=10, **kwargs)
+
+    @classmethod
+    def from_config(cls, config, node=None):
+        nodes = config.get('nodes')
+        if not nodes:
+            return None
+        return cls(nodes=nodes, node=node)
+
+
+class _Stored(namedtuple('_Stored', ('value',))):
+    def save(self):
+        return self.value
+
+
+def _identity(value):
+    return value
+
+
+def move_game(item, src=None, dst=None):
+    """Move one persisted game between data directories, renumbering it for its new home
+
+    Returns the game's new entry for the destination's mux."""
+    value = load(item['target'], default=lambda: None, factory=_identity, data_dir=src)
+    if value is None:
+        LOG.warning('Game %s for team %s is missing from %s', item['target'], item['team'], src)
+        return None
+    with batch(dst):
+        index = load('default', default=lambda: 0, factory=_identity, data_dir=dst) + 1
+        save('default', _Stored(index), data_dir=dst)
+        # The game keeps its base_name, so its channels stay as they are
+        if isinstance(value, bytes):
+            # The index is part of the packed game (see werewolf.codec), so it is unpacked to change it
+            game = unpack(value, cls=SpecificWerewolf)
+            game.index = index
+            value = pack(game)
+        else:
+            value.index = index     # A game pickled whole by an earlier version
+        save(index, _Stored(value), data_dir=dst)
+        for entry in entries(item['target'], data_dir=src):
+            append(index, entry, data_dir=dst)
+    drop(item['target'], data_dir=src)
+    truncate(item['target'], data_dir=src)
+    return dict(item, target=index)
+
+
+def rebalance(data_dirs=None, ring=None):
+    """Move every persisted game to the data directory of its team's owner
+
+    The nodes must all be stopped. Returns the number of games moved."""
+    muxes = {node: load('mux', default=list, factory=_identity, data_dir=data_dir)
+             for node, data_dir in data_dirs.items()}
+    moved = 0
+    for node, items in muxes.items():
+        keep = []
+        for item in items:
+            owner = ring.owner(item['team'])
+            if owner == node or owner not in data_dirs:
+                keep.append(item)
+                continue
+            LOG.info('Moving game %s of team %s from %s to %s', item['target'], item['team'], node, owner)
+            entry = move_game(item, src=data_dirs[node], dst=data_dirs[owner])
+            if entry is not None:
+                muxes[owner].append(entry)
+                moved += 1
+        items[:] = keep
+    for node, items in muxes.items():
+        save('mux', _Stored(items), data_dir=data_dirs[node])
+    return moved
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    argv = sys.argv[1:] if argv is None else argv
+    data_dirs = dict(arg.split('=', 1) for arg in argv)
+    with open(os.environ['CONFIG']) as f:
+        config = yaml.safe_load(f)
+    nodes = config.get('nodes') or {}
+    if set(data_dirs) != set(nodes):
+        raise SystemExit('Give a data directory for each of the nodes: {}'.format(', '.join(sorted(nodes))))
+    moved = rebalance(data_dirs=data_dirs, ring=HashRing(sorted(nodes)))
+    LOG.info('Moved %d games', moved)
+
+
+if __name__ == '__main__':
+    main()
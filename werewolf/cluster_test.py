@@ -0,0 +1,100 @@
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+
+from .cluster import HashRing, Cluster, rebalance, move_game, FORWARDED, _Stored, _identity
+from .game import SpecificWerewolf
+from .game_test import factory, standard_rules
+from .persist import load, save
+
+
+class Game:
+    def __init__(self, team, index):
+        self.team = team
+        self.index = index
+        self.base_name = 'ww-{}'.format(index)
+
+
+def test_ring_spreads_teams_and_moves_few():
+    teams = ['T{}'.format(i) for i in range(1000)]
+    ring = HashRing(['a', 'b', 'c'])
+    before = {team: ring.owner(team) for team in teams}
+    assert all(200 < n < 500 for n in Counter(before.values()).values())
+
+    ring.add('d')
+    after = {team: ring.owner(team) for team in teams}
+    moved = [team for team in teams if before[team] != after[team]]
+    # Only the teams taken by the new node change hands
+    assert all(after[team] == 'd' for team in moved)
+    assert 100 < len(moved) < 400
+
+
+def test_rebalance_moves_games_to_their_owner(tmpdir):
+    dirs = {node: str(tmpdir.mkdir(node)) for node in ('a', 'b')}
+    ring = HashRing(['a', 'b'])
+    teams = ['T{}'.format(i) for i in range(20)]
+
+    # Everything starts out on node a
+    items = []
+    for index, team in enumerate(teams, 1):
+        save(index, _Stored(Game(team, index)), data_dir=dirs['a'])
+        items.append({'target': index, 'team': team, 'channels': ['C{}'.format(index)]})
+    save('mux', _Stored(items), data_dir=dirs['a'])
+    save('default', _Stored(len(teams)), data_dir=dirs['a'])
+    save(1, _Stored(Game('X', 1)), data_dir=dirs['b'])
+    save('default', _Stored(1), data_dir=dirs['b'])
+
+    moved = rebalance(data_dirs=dirs, ring=ring)
+    assert moved == sum(ring.owner(team) == 'b' for team in teams) > 0
+
+    for node in dirs:
+        for item in load('mux', factory=_identity, data_dir=dirs[node]):
+            assert ring.owner(item['team']) == node
+            game = load(item['target'], factory=_identity, data_dir=dirs[node])
+            assert (game.team, game.index) == (item['team'], item['target'])
+            assert game.base_name == item['channels'][0].replace('C', 'ww-')
+    # The game that was already on b kept its number
+    assert load(1, factory=_identity, data_dir=dirs['b']).team == 'X'
+    assert load('default', factory=_identity, data_dir=dirs['b']) == 1 + moved
+
+    # A second run has nothing to do
+    assert rebalance(data_dirs=dirs, ring=ring) == 0
+
+
+def test_events_are_forwarded_to_the_owner():
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append((self.path, self.headers[FORWARDED],
+                             self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.handle_request, daemon=True).start()
+    nodes = {'a': 'http://127.0.0.1:1', 'b': 'http://127.0.0.1:{}'.format(server.server_port)}
+    cluster = Cluster(nodes=nodes, node='a')
+    team = next(t for t in ('T{}'.format(i) for i in range(100)) if not cluster.owns(t))
+    response = cluster.forward(team, '/slack/werewolf', data=b'{"team_id": 1}')
+    assert response.status_code == 200
+    assert received == [('/slack/werewolf', 'a', b'{"team_id": 1}')]
+    server.server_close()
+
+
+def test_moved_games_are_renumbered_inside(tmpdir):
+    dirs = {node: str(tmpdir.mkdir(node)) for node in ('a', 'b')}
+    srv, bot, players, game = factory(standard_rules(name="village-of-visions", number=5))
+    game.team, game.index = 'T1', 7
+    game.start(srv=srv, bot=bot)
+    save(7, game, data_dir=dirs['a'])
+    save('default', _Stored(3), data_dir=dirs['b'])
+
+    entry = move_game({'target': 7, 'team': 'T1', 'channels': []}, src=dirs['a'], dst=dirs['b'])
+    assert entry['target'] == 4
+    moved = load(4, factory=SpecificWerewolf.load, data_dir=dirs['b'])
+    assert (moved.index, moved.base_name, moved.players) == (4, game.base_name, game.players)
+    assert load(7, default=lambda: None, data_dir=dirs['a']) is None
@@ -0,0 +1,226 @@
+"""A compact, versioned encoding of a game's state
+
+A game encodes to a dict of plain values. Agents and channels are listed once and
+otherwise referred to by id; roles refer to their player, commands and phase handlers
+are referred to by name, and the rules' schedules by their text. Nothing from the
+code - command singletons, phase handlers - is captured, so an encoded game may be
+loaded into a later version of the code.
+
+For storage, pack() compresses the encoding (most of what remains is the text of the
+rules); unpack() reverses it."""
+
+from collections import defaultdict
+import logging
+import pickle
+import zlib
+
+from .commands import COMMANDS
+from .phase import BasePhase
+from .roles import BaseRole, RoleDescription
+from .schedule import Schedule, EmptySchedule
+from .scratchpad import ScratchPad
+from .service import Agent, Channel, Notice
+
+LOG = logging.getLogger(__name__)
+
+VERSION = 1
+
+# Tags for the values found in a scratchpad
+PAD = 'p'
+ROLE = 'r'
+SET = 's'
+TUPLE = 't'
+DICT = 'd'
+LIST = 'l'
+
+
+class Encoder:
+    def __init__(self):
+        self.agents = {}    # id: [name, is_bot, real_name]
+        self.channels = {}  # id: [name, is_private, is_im]
+        self.names = {id(command): name for name, command in COMMANDS.items()}
+
+    def agent(self, agent):
+        if agent is None:
+            return None
+        self.agents[agent.id] = [agent.name, agent.is_bot, agent.real_name]
+        return agent.id
+
+    def channel(self, channel):
+        if channel is None:
+            return None
+        self.channels[channel.id] = [channel.name, channel.is_private, channel.is_im]
+        return channel.id
+
+    def command(self, command):
+        return self.names[id(command)]
+
+    def rules(self, rules):
+        encoded = dict(rules)
+        encoded['roles'] = [[role.name, [self.command(c) for c in role.commands], list(role.rooms), role.team]
+                            for role in rules['roles']]
+        for key in ('prelim', 'phases'):
+            if key in rules:
+                encoded[key] = [self.phase(phase) for phase in rules[key]]
+        return encoded
+
+    def phase(self, phase):
+        encoded = dict(phase)
+        encoded.pop('handler', None)
+        encoded['resolution'] = [self.command(c) for c in phase['resolution']]
+        schedule = phase.get('schedule')
+        encoded['schedule'] = schedule.text if isinstance(schedule, Schedule) else None
+        return encoded
+
+    def value(self, value):
+        """Encode the contents of a scratchpad"""
+        if value is None or isinstance(value, (str, int, float, bool)):
+            return value
+        if isinstance(value, BaseRole):
+            return [ROLE, self.agent(value.player)]
+        if isinstance(value, ScratchPad):
+            return [PAD, [[k, self.value(v)] for k, v in value.items()]]
+        if isinstance(value, dict):
+            return [DICT, [[self.value(k), self.value(v)] for k, v in value.items()]]
+        if isinstance(value, (set, frozenset)):
+            return [SET, [self.value(v) for v in value]]
+        if isinstance(value, tuple):
+            return [TUPLE, [self.value(v) for v in value]]
+        if isinstance(value, list):
+            return [LIST, [self.value(v) for v in value]]
+        raise TypeError('Cannot encode {!r} in a scratchpad'.format(value))
+
+
+def encode_game(game):
+    e = Encoder()
+    roles = game.rules['roles']
+    encoded = {
+        'v': VERSION,
+        'index': game.index,
+        'team': game.team,
+        'base_name': game.base_name,
+        'players': [e.agent(p) for p in game.players],
+        'dead': [e.agent(p) for p in game.dead],
+        'public': e.channel(game.public),
+        'rules': e.rules(game.rules),
+        'prelim': game.prelim,
+        'phase': game.phase,
+        'winner': game.winner,
+        'roles': [[e.agent(player), roles.index(role.role), e.channel(role.channel),
+                   {name: e.channel(c) for name, c in role.channels.items()}]
+                  for player, role in game.roles.items()],
+        'room_map': {room: [e.agent(p) for p in players] for room, players in game.room_map.items()},
+        'rooms': {room: e.channel(c) for room, c in game.rooms.items()},
+        'channels': [[e.channel(c), [e.agent(r.player) for r in rs]] for c, rs in game.channels.items()],
+        'notice': None if game.notice is None else [e.channel(game.notice.channel), game.notice.id],
+        'phase_start': game.phase_start,
+        'phase_shift': game.phase_shift,
+        'scratchpad': e.value(game.scratchpad),
+        'journal_seq': getattr(game, 'journal_seq', 0),
+        'snapshot_seq': getattr(game, 'snapshot_seq', None),
+    }
+    encoded['agents'] = e.agents
+    encoded['channel_table'] = e.channels
+    return encoded
+
+
+class Decoder:
+    def __init__(self, encoded):
+        self.agents = {id: Agent(id, *details) for id, details in encoded['agents'].items()}
+        self.channels = {id: Channel(id, *details) for id, details in encoded['channel_table'].items()}
+        self.roles = {}     # Player id: BaseRole
+
+    def agent(self, id):
+        return None if id is None else self.agents[id]
+
+    def channel(self, id):
+        return None if id is None else self.channels[id]
+
+    def commands(self, names):
+        commands = []
+        for name in names:
+            if name in COMMANDS:
+                commands.append(COMMANDS[name])
+            else:
+                LOG.warning('Dropping unknown command %s from a loaded game', name)
+        return commands
+
+    def rules(self, encoded):
+        rules = dict(encoded)
+        rules['roles'] = [RoleDescription(name, self.commands(commands), rooms, team)
+                          for name, commands, rooms, team in encoded['roles']]
+        for key in ('prelim', 'phases'):
+            if key in encoded:
+                rules[key] = [self.phase(phase) for phase in encoded[key]]
+        return rules
+
+    def phase(self, encoded):
+        phase = dict(encoded)
+        phase['handler'] = BasePhase()
+        phase['resolution'] = self.commands(encoded['resolution'])
+        phase['schedule'] = EmptySchedule() if encoded['schedule'] is None else Schedule(encoded['schedule'])
+        return phase
+
+    def value(self, value):
+        if not isinstance(value, list):
+            return value
+        tag, items = value
+        if tag == ROLE:
+            return self.roles[items]
+        if tag == PAD:
+            pad = ScratchPad()
+            for k, v in items:
+                pad[k] = self.value(v)
+            return pad
+        if tag == DICT:
+            return {self.value(k): self.value(v) for k, v in items}
+        if tag == SET:
+            return {self.value(v) for v in items}
+        if tag == TUPLE:
+            return tuple(self.value(v) for v in items)
+        return [self.value(v) for v in items]
+
+
+def decode_game(encoded, cls=None):
+    if encoded.get('v') != VERSION:
+        raise ValueError('Cannot load a game saved in version {}'.format(encoded.get('v')))
+    d = Decoder(encoded)
+    game = cls.__new__(cls)
+    game.index = encoded['index']
+    game.team = encoded['team']
+    game.base_name = encoded['base_name']
+    game.players = [d.agent(p) for p in encoded['players']]
+    game.dead = [d.agent(p) for p in encoded['dead']]
+    game.public = d.channel(encoded['public'])
+    game.rules = d.rules(encoded['rules'])
+    game.prelim = encoded['prelim']
+    game.phase = encoded['phase']
+    game.winner = encoded['winner']
+    game.roles = {}
+    for player, role_index, channel, channels in encoded['roles']:
+        role = BaseRole(d.agent(player), game.rules['roles'][role_index])
+        role.channel = d.channel(channel)
+        role.channels = {name: d.channel(c) for name, c in channels.items()}
+        game.roles[role.player] = d.roles[player] = role
+    game.room_map = defaultdict(list, {room: [d.agent(p) for p in players]
+                                       for room, players in encoded['room_map'].items()})
+    game.rooms = {room: d.channel(c) for room, c in encoded['rooms'].items()}
+    game.channels = defaultdict(list, {d.channel(c): [d.roles[p] for p in players]
+                                       for c, players in encoded['channels']})
+    notice = encoded['notice']
+    game.notice = None if notice is None else Notice(d.channel(notice[0]), notice[1])
+    game.phase_start = encoded['phase_start']
+    game.phase_shift = encoded['phase_shift']
+    game.scratchpad = d.value(encoded['scratchpad'])
+    game.journal_seq = encoded['journal_seq']
+    game.snapshot_seq = encoded['snapshot_seq']
+    game.dirty = False
+    return game
+
+
+def pack(game):
+    return zlib.compress(pickle.dumps(encode_game(game), pickle.HIGHEST_PROTOCOL), 1)
+
+
+def unpack(value, cls=None):
+    return decode_game(pickle.loads(zlib.decompress(value)), cls=cls)
@@ -0,0 +1,52 @@
+import pickle
+
+from .codec import encode_game, decode_game, VERSION
+from .game import SpecificWerewolf
+from .game_test import test_loaded_game, test_unequal_votes
+from .text import Text
+
+
+def state(game):
+    """Everything but the clock and the notice, which two games played side by side won't share"""
+    encoded = encode_game(game)
+    for key in ('phase_start', 'phase_shift', 'notice'):
+        del encoded[key]
+    return encoded
+
+
+def roundtrip(game):
+    return SpecificWerewolf.load(pickle.loads(pickle.dumps(game.save())))
+
+
+def test_roundtrip_preserves_state():
+    srv, bot, players, game = test_loaded_game()
+    loaded = roundtrip(game)
+
+    assert encode_game(loaded) == encode_game(game)
+    assert loaded.current_phase['name'] == game.current_phase['name']
+    assert all(loaded.roles[p].role == r.role for p, r in game.roles.items())
+    # Each role is a single object, shared by the role map and the channel map
+    assert all(loaded.channels[c][0] is loaded.roles[rs[0].player] for c, rs in game.channels.items())
+
+
+def test_loaded_game_plays_on():
+    srv, bot, players, game = test_unequal_votes()
+    loaded = roundtrip(game)
+    assert encode_game(loaded)['scratchpad'] == encode_game(game)['scratchpad']
+
+    for g in (game, loaded):
+        wolf = next(r for r in g.roles.values() if r.role.name == 'werewolf' and r.player in g.players)
+        victim = next(p for p in g.players if g.roles[p].role.team != 'evil')
+        g.on_message(srv=srv, channel=wolf.channel, sender=wolf.player, text=Text('kill ', victim))
+        g.phase_shift = 0
+        g.tick(srv=srv)
+        assert g.current_phase['name'] == 'day'
+    assert state(loaded) == state(game)
+
+
+def test_encoding_is_compact():
+    srv, bot, players, game = test_loaded_game()
+    encoded = encode_game(game)
+    assert encoded['v'] == VERSION
+    assert decode_game(encoded, cls=SpecificWerewolf).dead == game.dead
+    assert len(pickle.dumps(game.save())) * 2 < len(pickle.dumps(game))
@@ -20,6 +20,8 @@ def match_agent(agents=None, any_agent=False):
 
 
 class BaseCommand:
+    verbs = ()  # The words that a message handled by this command may begin with
+
     def welcome(self, srv=None, game=None, role=None):
         """Send an introductory message, if appropriate"""
         pass
@@ -7,6 +7,8 @@ LOG = logging.getLogger(__name__)
 
 
 class ConcedeCommand(BaseCommand):
+    verbs = ('concede',)
+
     def welcome(self, srv=None, game=None, role=None):
         srv.broadcast(channel=role.channel,
                       text=Text("At any point, you may CONCEDE in your private channel.\n"
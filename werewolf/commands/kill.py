@@ -7,6 +7,8 @@ LOG = logging.getLogger(__name__)
 
 
 class KillCommand(BaseCommand):
+    verbs = ('kill',)
+
     def welcome(self, srv=None, game=None, role=None):
         if EVIL in game.rooms:
             srv.broadcast(channel=role.channel,
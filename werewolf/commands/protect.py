@@ -9,6 +9,7 @@ PLAYERS = Sentinel("PLAYERS")
 
 class ProtectCommand(BaseCommand):
     matcher = reg()
+    verbs = ('protect', 'unprotect')
 
     def welcome(self, srv=None, game=None, role=None):
         srv.broadcast(channel=role.channel,
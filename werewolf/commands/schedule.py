@@ -1,5 +1,5 @@
 import logging
-import time
+from .. import clock
 from ..schedule import parse as time_parse, Schedule
 from ..text import Text, reg
 from .base import BaseCommand
@@ -9,6 +9,7 @@ LOG = logging.getLogger(__name__)
 
 class ScheduleCommand(BaseCommand):
     matcher = reg()
+    verbs = ('advance', 'schedule')
 
     def welcome(self, srv=None, game=None, role=None):
         srv.broadcast(channel=role.channel,
@@ -38,7 +39,7 @@ class ScheduleCommand(BaseCommand):
         if len(game.scratchpad.advances) == len(game.players):
             srv.broadcast(channel=game.public,
                           text=Text("By unanimous agreement of the remaining players, this phase advances."))
-            game.phase_shift = time.time()
+            game.phase_shift = clock.now()
             return True
 
     @matcher("schedule", str, str, [str])
@@ -7,6 +7,8 @@ LOG = logging.getLogger(__name__)
 
 
 class SeerCommand(BaseCommand):
+    verbs = ('scry',)
+
     def welcome(self, srv=None, game=None, role=None):
         srv.broadcast(channel=role.channel,
                       text=Text("At night, you may chose someone to SCRY in your private channel.\n"
@@ -7,6 +7,8 @@ LOG = logging.getLogger(__name__)
 
 
 class SorcerorCommand(BaseCommand):
+    verbs = ('observe',)
+
     def welcome(self, srv=None, game=None, role=None):
         srv.broadcast(channel=role.channel,
                       text=Text("At night, you may chose someone to OBSERVE in your private channel.\n"
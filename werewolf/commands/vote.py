@@ -7,6 +7,8 @@ LOG = logging.getLogger(__name__)
 
 
 class VoteCommand(BaseCommand):
+    verbs = ('vote', 'remove')
+
     def welcome(self, srv=None, game=None, role=None):
         srv.broadcast(channel=role.channel,
                       text=Text("During the day, you may VOTE in the public channel.\n"
@@ -1,12 +1,14 @@
+import asyncio
 import discord
 import logging
-import queue
+import os
 
 from .service import Agent, Channel
 from .service.discord import Service, load_config, token
-from .dispatch import QueuingDispatch, MuxDispatch
+from .dispatch import AsyncQueuingDispatch, AsyncMuxDispatch
 from .game import GeneralWerewolf, SpecificWerewolf
 from .persist import load
+from .prefilter import Prefilter, DROP
 from .rules import load_games
 
 
@@ -15,16 +17,18 @@ LOG = logging.getLogger(__name__)
 load_config()
 load_games()
 
-QUEUE = queue.Queue()
-DISPATCHER = QueuingDispatch(queue=QUEUE)
+QUEUE = asyncio.Queue()
+WORKERS = int(os.environ.get('WORKERS', 4))
+RESOLVERS = int(os.environ.get('RESOLVERS', 4))
+DISPATCHER = AsyncQueuingDispatch(queue=QUEUE)
 # RUNNER = load('mux',
-#               default=partial(MuxDispatch, queue=QUEUE, default=GeneralWerewolf()),
-#               factory=partial(MuxDispatch.load, queue=QUEUE,
+#               default=partial(AsyncMuxDispatch, queue=QUEUE, workers=WORKERS, default=GeneralWerewolf()),
+#               factory=partial(AsyncMuxDispatch.load, queue=QUEUE, workers=WORKERS,
 #                               default_type=GeneralWerewolf,
 #                               default_factory=GeneralWerewolf.load,
 #                               target_factory=SpecificWerewolf.load))
-RUNNER = MuxDispatch(queue=QUEUE, default=GeneralWerewolf())
-RUNNER.start()
+RUNNER = AsyncMuxDispatch(queue=QUEUE, workers=WORKERS, resolvers=RESOLVERS, default=GeneralWerewolf())
+PREFILTER = Prefilter(routes=RUNNER.route_ids)
 
 
 # Set up logging
@@ -45,6 +49,8 @@ logging.basicConfig(level=logging.DEBUG)
 def main():
     bot = discord.Client()
     Service.init(client=bot)
+    DISPATCHER.loop = bot.loop
+    RUNNER.start()
 
     @bot.event
     async def on_ready():
@@ -61,6 +67,8 @@ def main():
             text = message.content
             ts = message.id
             LOG.debug("raw message: %r", text)
+            if PREFILTER.classify(channel=channel, sender=sender, receivers=receivers, text=text) == DROP:
+                return
             DISPATCHER.raw_message(srv=Service(guild=message.guild),
                                    sender=sender, channel=channel, receivers=receivers,
                                    text=text, message_id=ts)
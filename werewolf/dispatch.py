@@ -1,10 +1,18 @@
-from collections import namedtuple
+import asyncio
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 import logging
+import queue
 from recordtype import recordtype
 import threading
-from .service import Channel
+import time
+from . import pool
+from .service import Agent, Channel
 from .persist import load, save
 from .text import Text
+from .timer import Deadlines
 
 
 LOG = logging.getLogger(__name__)
@@ -27,130 +35,714 @@ class BaseDispatch:
         LOG.debug("Time passes")
 
 
-QueuedOnMessage = recordtype('QueuedOnMessage', ('srv', 'sender', 'receivers', 'channel', 'text', 'message_id'))
-QueuedOauthCallback = recordtype('QueuedOauthCallback', ('srv', 'code', 'state'))
+# `seq` numbers an event in the inbound journal, if it has been journalled
+QueuedOnMessage = recordtype('QueuedOnMessage', ('srv', 'sender', 'receivers', 'channel', 'text', 'message_id',
+                                                 ('seq', None)))
+QueuedOauthCallback = recordtype('QueuedOauthCallback', ('srv', 'code', 'state', ('seq', None)))
 QueuedTick = recordtype('QueuedTick', ('srv', 'srv_lookup',))
 
 
 class QueuingDispatch(BaseDispatch):
-    def __init__(self, queue=None, *args, **kwargs):
+    """Put events onto a queue
+
+    With an `inbound` journal, every event but a tick is journalled before it is queued."""
+    def __init__(self, queue=None, inbound=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.queue = queue
+        self.inbound = inbound
+
+    def put(self, item):
+        if self.inbound is None or isinstance(item, QueuedTick):
+            self.queue.put(item, timeout=1)
+            return
+        self.inbound.append(item)
+        try:
+            queued = self.queue.put(item, timeout=1)
+        except queue.Full:
+            self.inbound.release(item.seq)
+            raise
+        if queued is False:
+            # Shed by the queue
+            self.inbound.release(item.seq)
+
+    def replay(self, srv_lookup=None):
+        """Queue again the journalled events that were not done when we last stopped"""
+        for item in self.inbound.recover(srv_lookup=srv_lookup):
+            if self.queue.put(item) is False:
+                self.inbound.release(item.seq)
 
     def raw_message(self, srv=None, sender=None, receivers=None, channel=None, text=None, message_id=None):
-        self.queue.put(QueuedOnMessage(srv, sender, receivers, channel, text, message_id), timeout=1)
+        self.put(QueuedOnMessage(srv, sender, receivers, channel, text, message_id))
 
     def oauth_callback(self, srv=None, code=None, state=None):
-        self.queue.put(QueuedOauthCallback(srv, code, state), timeout=1)
+        self.put(QueuedOauthCallback(srv, code, state))
 
     def tick(self, srv=None, srv_lookup=None):
-        self.queue.put(QueuedTick(srv, srv_lookup), timeout=1)
+        self.put(QueuedTick(srv, srv_lookup))
 
 
 class DequeuingDispatch(BaseDispatch, threading.Thread):
-    def __init__(self, queue=None, *args, **kwargs):
+    """Consume queued events on a thread of its own
+
+    If `resolvers` is non-zero, the name resolution for incoming messages (which will
+    typically require calls out to the service) is carried out concurrently on a pool
+    of that many threads. Events are still handled strictly in the order they arrived."""
+    def __init__(self, queue=None, resolvers=0, inbound=None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.queue = queue
+        self.resolvers = resolvers
+        self.inbound = inbound
+        self.current = threading.local()
 
     def run(self):
+        if self.resolvers > 0:
+            return self.run_pipeline()
+
         while True:
             try:
                 m = self.queue.get()
-                if isinstance(m, QueuedOnMessage):
-                    # Resolve names
-                    m.sender = m.srv.lookup_user(m.sender)
-                    m.receivers = [m.srv.lookup_user(rcv) for rcv in m.receivers]
-                    m.channel = m.srv.lookup_channel(m.channel)
-                    # Parse text into a rope of items
-                    m.text = Text.parse(m.text, srv=m.srv)
-                    m.text.message_id = m.message_id
-                    self.on_message(srv=m.srv, sender=m.sender, receivers=m.receivers, channel=m.channel, text=m.text)
-                elif isinstance(m, QueuedOauthCallback):
-                    self.oauth_callback(srv=m.srv, code=m.code, state=m.state)
-                elif isinstance(m, QueuedTick):
-                    self.tick(srv=m.srv, srv_lookup=m.srv_lookup)
+                with self.handling(m):
+                    self.handle(self.resolve(m))
             except Exception:
                 LOG.exception('Problem handling queued message')
 
             finally:
                 self.queue.task_done()
 
+    def run_pipeline(self):
+        resolved = queue.Queue(maxsize=self.resolvers * 4)
+        pool = ThreadPoolExecutor(max_workers=self.resolvers, thread_name_prefix='{}-resolve'.format(self.name))
+
+        def feed():
+            while True:
+                m = self.queue.get()
+                resolved.put((m, pool.submit(self.resolve, m)))
+
+        threading.Thread(target=feed, name='{}-feed'.format(self.name), daemon=self.daemon).start()
+
+        while True:
+            m, future = resolved.get()
+            try:
+                with self.handling(m):
+                    self.handle(future.result())
+            except Exception:
+                LOG.exception('Problem handling queued message')
+
+            finally:
+                self.queue.task_done()
+
+    @contextmanager
+    def handling(self, m):
+        """Handle a journalled event; it is done once this, and all the work it hands on, is finished"""
+        seq = getattr(m, 'seq', None)
+        if self.inbound is None or seq is None:
+            yield
+            return
+        self.current.seq = seq
+        try:
+            yield
+        finally:
+            self.current.seq = None
+            self.inbound.release(seq)
+
+    def follow(self, f):
+        """Wrap work that is handed on to another thread, so that its event is not done until it is"""
+        seq = getattr(self.current, 'seq', None)
+        if seq is None:
+            return f
+        self.inbound.hold(seq)
+
+        def followed(*args, **kwargs):
+            self.current.seq = seq
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.current.seq = None
+                self.inbound.release(seq)
+        return followed
+
+    def resolve(self, m):
+        """Fill in the details of a queued event ahead of handling it"""
+        if isinstance(m, QueuedOnMessage):
+            # Resolve names
+            m.sender = m.srv.lookup_user(m.sender)
+            m.receivers = [m.srv.lookup_user(rcv) for rcv in m.receivers]
+            m.channel = m.srv.lookup_channel(m.channel)
+            # Parse text into a rope of items
+            m.text = Text.parse(m.text, srv=m.srv)
+            m.text.message_id = m.message_id
+        return m
+
+    def handle(self, m):
+        if isinstance(m, QueuedOnMessage):
+            self.on_message(srv=m.srv, sender=m.sender, receivers=m.receivers, channel=m.channel, text=m.text)
+        elif isinstance(m, QueuedOauthCallback):
+            self.oauth_callback(srv=m.srv, code=m.code, state=m.state)
+        elif isinstance(m, QueuedTick):
+            self.tick(srv=m.srv, srv_lookup=m.srv_lookup)
+
 
 NewTarget = namedtuple('NewTarget', ('handler', 'channels'))
-DeleteTarget = namedtuple('DeleteTarget', ('handler',))
+DeleteTarget = namedtuple('DeleteTarget', ('handler', 'srv'), defaults=(None,))   # With srv, pool its channels
+Flush = namedtuple('Flush', ('target',))    # A deadline for writing out a target's changes
+Hibernate = namedtuple('Hibernate', ('target',))    # A deadline for swapping an idle target out of memory
+
+
+class LazyTarget:
+    """A persisted game that has not yet been loaded (or that has been swapped out)
+
+    The mux routes events to this until the first of them is handled, at which point
+    the game is loaded and takes its place."""
+    dirty = False
+
+    def __init__(self, team=None, index=None, phase_shift=None, dead=(), loader=None):
+        self.team = team
+        self.index = index
+        self.phase_shift = phase_shift
+        self.dead = list(dead)
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.game = None
+        self.loaded = False
+
+    def load(self):
+        with self.lock:
+            if not self.loaded:
+                self.game = self.loader()
+                self.loaded = True
+            return self.game
+
+    def persist(self):
+        pass
+
+    def __repr__(self):
+        return 'LazyTarget(team={!r}, index={!r})'.format(self.team, self.index)
 
 
 class MuxDispatch(DequeuingDispatch):
-    def __init__(self, default=None, *args, **kwargs):
+    """Route events to the target that owns their channel
+
+    Targets that have changed are written out no more than once per `write_window`
+    seconds (immediately, if that is 0), and always when their phase changes or they end.
+
+    With an `idle_timeout`, a game that has seen neither a message nor a tick for that
+    many seconds is written out and replaced by a LazyTarget, which keeps only its routes
+    and next deadline; `target_factory` reloads it when it is next needed.
+
+    With `snapshots` (a persist.Snapshots), the changes held back by the write window are
+    written out by forked children, so that serialising a large game holds up nothing.
+
+    A game whose tick cannot be delivered, or fails, is woken again `tick_retry` seconds later.
+
+    With an `inbound` journal, an event is not done until the changes it made to its
+    target have been written out, so that a crash inside the write window loses nothing."""
+    def __init__(self, default=None, write_window=0, idle_timeout=0, target_factory=None, snapshots=None,
+                 tick_retry=60, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.write_window = write_window
+        self.tick_retry = tick_retry
+        self.snapshots = snapshots
+        self.idle_timeout = idle_timeout
+        self.target_factory = target_factory
+        self.dirty = False
+        self.deadlines_saved = {}   # Target key: deadline, as last written in the mux
+        self.unsaved = defaultdict(list)    # Target: [inbound seq], of events whose changes are not written out
         self.channel_map = {}
         self.target_map = {}
+        self.route_ids = {}     # Channel id: target
         self.default = default
+        self.lock = threading.RLock()
+        self.deadlines = Deadlines()
+
+    def target_key(self, target):
+        """Identify a target in a way that survives it being reloaded"""
+        if target is self.default:
+            return None
+        return target.team, target.index
+
+    def dispatch(self, target, f, *args, **kwargs):
+        """Arrange for f to be run on behalf of target
+
+        This implementation runs everything inline, on the dispatcher thread."""
+        f(*args, **kwargs)
 
     def on_message(self, srv=None, sender=None, receivers=None, channel=None, text=None):
-        target = self.channel_map.get(channel, self.default)
+        # Route by id: channels reloaded from the mux are known by nothing else
+        target = self.route_ids.get(channel.id, self.default)
+        self.dispatch(target, self.target_message, target,
+                      srv=srv, sender=sender, receivers=receivers, channel=channel, text=text)
+
+    def materialise(self, target):
+        """Load a lazily-loaded game, and route to it from now on
+
+        Returns the game, or None if it can no longer be loaded."""
+        if not isinstance(target, LazyTarget):
+            return target
+        game = target.load()
+        with self.lock:
+            if target in self.target_map:
+                channels = self.target_map.pop(target)
+                self.deadlines.disarm(target)
+                if game is None:
+                    LOG.warning('Game %s for team %s could not be loaded', target.index, target.team)
+                    for c in channels:
+                        self.channel_map.pop(c, None)
+                        self.route_ids.pop(c.id, None)
+                else:
+                    LOG.debug('Loaded game %s for team %s', target.index, target.team)
+                    self.route(game, channels)
+                    self.arm(game)
+                self.dirty = True
+        return game
+
+    def target_materialise(self, target):
+        self.materialise(target)
+
+    def preload(self):
+        """Load every game that hasn't yet been, each on the thread that owns it"""
+        for target in list(self.target_map):
+            if isinstance(target, LazyTarget):
+                self.dispatch(target, self.target_materialise, target)
+
+    def target_message(self, target, srv=None, sender=None, receivers=None, channel=None, text=None):
+        target = self.materialise(target)
+        if target is None:
+            return
+        phase_shift = getattr(target, 'phase_shift', None)
         result = target.on_message(srv=srv, sender=sender, receivers=receivers, channel=channel, text=text)
 
         # Process the result
         self.process(result)
-        target.persist()
+        self.save_target(target, force=getattr(target, 'phase_shift', None) != phase_shift)
+        self.arm(target)
+        self.touch(target)
 
     def oauth_callback(self, srv=None, code=None, state=None):
+        self.dispatch(self.default, self.target_oauth_callback, srv=srv, code=code, state=state)
+
+    def target_oauth_callback(self, srv=None, code=None, state=None):
         result = self.default.oauth_callback(srv=srv, code=code, state=state)
         self.process(result)
 
     def tick(self, srv=None, srv_lookup=None):
-        self.process(self.default.tick(srv=srv))
-        self.default.persist()
-        # Dispatch the tick to everyone
-        for target in list(self.target_map):
+        self.dispatch(self.default, self.target_tick, self.default, srv=srv)
+        # Dispatch the tick to those targets whose deadline has passed
+        for target in self.deadlines.take():
+            if isinstance(target, Flush):
+                self.dispatch(target.target, self.target_flush, target.target)
+                continue
+            if isinstance(target, Hibernate):
+                self.dispatch(target.target, self.target_hibernate, target.target)
+                continue
+            if target not in self.target_map:
+                continue
             srv = srv_lookup(target.team)
             if srv is not None:
-                self.process(target.tick(srv=srv))
+                self.dispatch(target, self.target_tick, target, srv=srv)
+            else:
+                LOG.warning('No service for team %s; game %s will be woken again later', target.team, target.index)
+                self.retry(target)
+
+    def target_tick(self, target, srv=None):
+        target = self.materialise(target)
+        if target is None:
+            return
+        phase_shift = getattr(target, 'phase_shift', None)
+        try:
+            self.process(target.tick(srv=srv))
+        except Exception:
+            self.retry(target)
+            raise
+        self.save_target(target, force=getattr(target, 'phase_shift', None) != phase_shift)
+        self.arm(target)
+        self.touch(target)
+
+    def save_target(self, target, force=False):
+        """Write out a target's changes, now or once the write window has passed"""
+        if not getattr(target, 'dirty', True):
+            return
+        if force or self.write_window <= 0 or target is self.default or target not in self.target_map:
+            self.deadlines.disarm(Flush(target))
+            with self.saving(target):
+                target.persist()
+            self.note_deadline(target)
+            return
+        seq = getattr(self.current, 'seq', None)
+        if self.inbound is not None and seq is not None:
+            # The event is not done until this change is written out
+            self.inbound.hold(seq)
+            with self.lock:
+                self.unsaved[target].append(seq)
+        self.deadlines.arm(Flush(target), time.time() + self.write_window, sooner=True)
+
+    def unsaved_events(self, target):
+        """Take the events whose changes to a target are about to be written out"""
+        with self.lock:
+            return self.unsaved.pop(target, [])
+
+    def saved_events(self, seqs):
+        for seq in seqs:
+            self.inbound.release(seq)
+
+    @contextmanager
+    def saving(self, target):
+        """Write out a target; the events whose changes that includes are then done"""
+        seqs = self.unsaved_events(target)
+        try:
+            yield
+        except BaseException:
+            with self.lock:
+                self.unsaved[target][:0] = seqs
+            raise
+        self.saved_events(seqs)
+
+    def note_deadline(self, target):
+        """Rewrite the mux if a game must now wake earlier than the mux says, should we restart"""
+        phase_shift = getattr(target, 'phase_shift', None)
+        if phase_shift is not None and phase_shift < self.deadlines_saved.get(self.target_key(target), phase_shift):
+            with self.lock:
+                self.dirty = True
+                self.persist()
+
+    def target_flush(self, target, background=True):
+        if target not in self.target_map or not getattr(target, 'dirty', True):
+            return
+        if self.snapshots is None or not background:
+            with self.saving(target):
+                target.persist()
+            return
+        seqs = self.unsaved_events(target)
+        with self.snapshots.background(on_failure=partial(self.dispatch, target, self.target_resave, target, seqs),
+                                       on_success=partial(self.saved_events, seqs)):
+            target.persist()
+
+    def target_resave(self, target, seqs=()):
+        """A background save failed; try again"""
+        with self.lock:
+            self.unsaved[target][:0] = seqs
+        target.dirty = True
+        self.save_target(target)
+
+    def touch(self, target):
+        """Note that a target is in use, putting off its hibernation"""
+        if self.idle_timeout <= 0 or self.target_factory is None or isinstance(target, LazyTarget):
+            return
+        with self.lock:
+            if target in self.target_map:
+                self.deadlines.arm(Hibernate(target), time.time() + self.idle_timeout)
+
+    def target_hibernate(self, target):
+        """Write out an idle game and swap it for a stub, from which it is reloaded when next needed"""
+        if target not in self.target_map:
+            return
+        if getattr(target, 'dirty', True):
+            self.deadlines.disarm(Flush(target))
+            with self.saving(target):
                 target.persist()
+        stub = LazyTarget(team=target.team, index=target.index, phase_shift=getattr(target, 'phase_shift', None),
+                          dead=getattr(target, 'dead', ()),
+                          loader=partial(load, target.index, default=lambda: None, factory=self.target_factory))
+        with self.lock:
+            channels = self.target_map.pop(target, None)
+            if channels is None:
+                return
+            self.deadlines.disarm(target)
+            self.route(stub, channels)
+            self.arm(stub)
+        LOG.debug('Game %s for team %s is idle; swapped it out', target.index, target.team)
+
+    def stats(self):
+        with self.lock:
+            stubs = sum(isinstance(target, LazyTarget) for target in self.target_map)
+            return {'resident': len(self.target_map) - stubs, 'swapped_out': stubs}
+
+    def flush(self):
+        """Write out every pending change, eg, at shutdown"""
+        for target in list(self.target_map):
+            self.dispatch(target, self.target_flush, target, background=False)
+        self.persist()
+        if self.snapshots is not None:
+            self.snapshots.wait()
+
+    def arm(self, target):
+        """Schedule the next wake-up for a target, if it is still live"""
+        if target is self.default:
+            return
+        with self.lock:
+            if target in self.target_map:
+                self.deadlines.arm(target, getattr(target, 'phase_shift', None))
+
+    def retry(self, target):
+        """Wake a target again a little later, its deadline having been taken without a tick"""
+        with self.lock:
+            if target in self.target_map:
+                self.deadlines.arm(target, time.time() + self.tick_retry)
+
+    def advance(self, target, srv=None):
+        """Bring the current phase of a target to an immediate end"""
+        self.dispatch(target, self.target_advance, target, srv=srv)
+
+    def target_advance(self, target, srv=None):
+        target = self.materialise(target)
+        if target is None:
+            return
+        target.phase_shift = time.time()
+        self.target_tick(target, srv=srv)
 
     def process(self, response):
         if response is None:
             return
+        with self.lock:
+            self._process(response)
+        # Only once a finished game's routes are gone may its channels be claimed by another
+        for item in response:
+            if isinstance(item, DeleteTarget) and item.srv is not None:
+                pool.give_back(srv=item.srv, channels=item.handler.pooled_channels())
+
+    def _process(self, response):
         for item in response:
             if callable(item):
                 LOG.info("administrative callback running")
                 item(self)
+                self.dirty = True
             elif isinstance(item, NewTarget):
-                LOG.debug('Registering new handler, %s, for %s', item.handler, item.channels)
-                self.target_map[item.handler] = item.channels
-                for c in item.channels:
-                    self.channel_map[c] = item.handler
-                item.handler.persist()
+                self.register(item.handler, item.channels)
             elif isinstance(item, DeleteTarget):
-                channels = self.target_map.pop(item.handler)
-                LOG.debug('Unregistering handler, %s, for %s', item.handler, channels)
-                for c in channels:
-                    del self.channel_map[c]
+                self.unregister(item.handler)
             else:
                 LOG.warning('Unknown response from message: %s', item)
         self.persist()
 
+    def register(self, handler, channels):
+        LOG.debug('Registering new handler, %s, for %s', handler, channels)
+        self.route(handler, channels)
+        handler.persist()
+        self.arm(handler)
+        self.touch(handler)
+
+    def route(self, handler, channels):
+        self.dirty = True
+        self.target_map[handler] = channels
+        for c in channels:
+            self.channel_map[c] = handler
+            self.route_ids[c.id] = handler
+
+    def unregister(self, handler):
+        channels = self.target_map.pop(handler)
+        self.dirty = True
+        self.deadlines.disarm(handler)
+        self.deadlines.disarm(Flush(handler))
+        self.deadlines.disarm(Hibernate(handler))
+        LOG.debug('Unregistering handler, %s, for %s', handler, channels)
+        for c in channels:
+            del self.channel_map[c]
+            self.route_ids.pop(c.id, None)
+
+    def routed(self, channel):
+        """Is this channel (which need not have been resolved) one that a game is using?"""
+        return channel.id in self.route_ids
+
     def persist(self):
-        save('mux', self)
+        with self.lock:
+            if self.dirty:
+                self.dirty = False
+                save('mux', self)
 
     def save(self):
-        return [{'target': target.index, 'channels': [c.id for c in channels]} for target, channels in self.target_map.items()]
+        self.deadlines_saved = {self.target_key(target): target.phase_shift for target in self.target_map}
+        return [{'target': target.index, 'team': target.team, 'channels': [c.id for c in channels],
+                 'deadline': target.phase_shift, 'dead': [p.id for p in getattr(target, 'dead', ())]}
+                for target, channels in self.target_map.items()]
 
     @classmethod
-    def load(cls, value, default_type=None, default_factory=None, target_factory=None, **kwargs):
-        """This load method will drive the reload or reconstruction of everything"""
+    def load(cls, value, default_type=None, default_factory=None, target_factory=None, lazy=True, **kwargs):
+        """This load method will drive the reload or reconstruction of everything
+
+        Unless `lazy` is False, games are only loaded when they are first needed."""
         default = load('default', default=default_type, factory=default_factory)
-        loaded = cls(default=default, **kwargs)  # Pass through the queue
-        target_map = {}
-        channel_map = {}
+        loaded = cls(default=default, target_factory=target_factory, **kwargs)  # Pass through the queue
         for item in value:
-            target = load(item['target'], default=lambda: None, factory=target_factory)
+            loader = partial(load, item['target'], default=lambda: None, factory=target_factory)
+            if lazy and 'deadline' in item:
+                target = LazyTarget(team=item['team'], index=item['target'], phase_shift=item['deadline'],
+                                    dead=[Agent(id=p) for p in item['dead']], loader=loader)
+            else:
+                target = loader()
             if target is not None:
-                channels = [Channel(id=c) for c in item['channels']]
-                target_map[target] = channels
-                for channel in channels:
-                    channel_map[channel] = target
-        loaded.target_map = target_map
-        loaded.channel_map = channel_map
+                loaded.route(target, [Channel(id=c) for c in item['channels']])
+                loaded.deadlines_saved[loaded.target_key(target)] = item.get('deadline')
+        for target in loaded.target_map:
+            loaded.arm(target)
+        loaded.dirty = False
         return loaded
+
+
+class ShardWorker(threading.Thread):
+    """Run work for a fixed subset of targets, strictly in the order it arrives"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queue = queue.Queue()
+
+    def run(self):
+        while True:
+            f, args, kwargs = self.queue.get()
+            try:
+                f(*args, **kwargs)
+            except Exception:
+                LOG.exception('Problem handling work on %s', self.name)
+            finally:
+                self.queue.task_done()
+
+
+class ShardedMuxDispatch(MuxDispatch):
+    """A MuxDispatch that hands each target's work to one of several worker threads
+
+    Every event for a given target is handled by the same worker, so the events for
+    any single game are processed in order; independent games proceed in parallel.
+    The dispatcher thread itself only resolves names and routes events."""
+    def __init__(self, workers=4, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.workers = [ShardWorker(name='shard-{}'.format(i), daemon=self.daemon) for i in range(max(workers, 1))]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        super().start()
+
+    def shard(self, target):
+        if target is self.default:
+            return self.workers[0]
+        return self.workers[hash(self.target_key(target)) % len(self.workers)]
+
+    def dispatch(self, target, f, *args, **kwargs):
+        self.shard(target).queue.put((self.follow(f), args, kwargs))
+
+    def drain(self):
+        """Wait until every queued event has been completely handled"""
+        self.queue.join()
+        for worker in self.workers:
+            worker.queue.join()
+
+    def flush(self):
+        super().flush()
+        for worker in self.workers:
+            worker.queue.join()
+
+
+class AsyncQueuingDispatch(QueuingDispatch):
+    """Enqueue events onto an asyncio.Queue
+
+    Events raised on the loop's own thread are enqueued directly; from any other thread,
+    they are handed over to the loop."""
+    def __init__(self, loop=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loop = loop
+
+    def put(self, item):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        else:
+            self.queue.put_nowait(item)
+
+
+class AsyncMuxDispatch(MuxDispatch):
+    """A MuxDispatch that runs on an asyncio event loop
+
+    Its queue is an asyncio.Queue and each srv is a SyncService, whose underlying
+    AsyncBaseService is used to resolve names on the loop; any number of resolutions
+    may be in flight at once. Game logic is synchronous, so each target's work is run
+    on a pool of `workers` threads, one piece of work at a time per target and in the
+    order it arrived."""
+    def __init__(self, workers=4, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='game')
+        self.tails = {}     # target key: Task
+        self.loop = None
+
+    def start(self):
+        """Begin serving the queue on the current event loop"""
+        self.loop = asyncio.get_event_loop()
+        return asyncio.ensure_future(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        resolved = asyncio.Queue(maxsize=max(self.resolvers, 1) * 4)
+
+        async def feed():
+            while True:
+                m = await self.queue.get()
+                await resolved.put((m, asyncio.ensure_future(self.resolve_async(m))))
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            while True:
+                m, future = await resolved.get()
+                try:
+                    with self.handling(m):
+                        self.handle(await future)
+                except Exception:
+                    LOG.exception('Problem handling queued message')
+
+                finally:
+                    self.queue.task_done()
+        finally:
+            feeder.cancel()
+
+    async def resolve_async(self, m):
+        if isinstance(m, QueuedOnMessage):
+            srv = m.srv.service
+            m.sender = await srv.lookup_user(agent=m.sender)
+            m.receivers = await asyncio.gather(*(srv.lookup_user(agent=rcv) for rcv in m.receivers))
+            m.channel = await srv.lookup_channel(channel=m.channel)
+            text = Text.parse(m.text)
+            m.text = Text(*await asyncio.gather(*(self.resolve_item(item, srv) for item in text)))
+            m.text.message_id = m.message_id
+        return m
+
+    @staticmethod
+    async def resolve_item(item, srv):
+        if isinstance(item, Agent):
+            return await srv.lookup_user(agent=item)
+        elif isinstance(item, Channel):
+            return await srv.lookup_channel(channel=item)
+        return item
+
+    def dispatch(self, target, f, *args, **kwargs):
+        work = partial(self.follow(f), *args, **kwargs)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self.enqueue(target, work)
+        else:
+            # Work handed on from a game's thread, or by a background save as it fails
+            self.loop.call_soon_threadsafe(self.enqueue, target, work)
+
+    def enqueue(self, target, work):
+        """Run work for a target after all the work already queued for it; only on the loop"""
+        key = self.target_key(target)
+        task = self.loop.create_task(self.run_after(self.tails.get(key), work))
+        self.tails[key] = task
+
+        def forget(_):
+            if self.tails.get(key) is task:
+                del self.tails[key]
+        task.add_done_callback(forget)
+
+    async def run_after(self, previous, f):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self.loop.run_in_executor(self.executor, f)
+        except Exception:
+            LOG.exception('Problem handling work for target')
+
+    async def drain(self):
+        """Wait until every queued event has been completely handled"""
+        await self.queue.join()
+        await asyncio.sleep(0)  # Let any work handed over from other threads be queued
+        while self.tails:
+            await asyncio.wait(list(self.tails.values()))
@@ -0,0 +1,364 @@
+import asyncio
+import queue
+import threading
+import time
+from functools import partial
+from . import persist, pool
+from .dispatch import QueuingDispatch, MuxDispatch, ShardedMuxDispatch, AsyncQueuingDispatch, AsyncMuxDispatch, Flush, \
+    Hibernate, LazyTarget, DeleteTarget
+from .service import Agent, Channel
+from .service.base import AsyncBaseService, SyncService
+from .timer import Deadlines
+from werewolf.service.service_test import MockService
+
+
+class Recorder:
+    def __init__(self, index=None, team=None, gate=None):
+        self.index = index
+        self.team = team
+        self.gate = gate
+        self.seen = []
+        self.phase_shift = None
+
+    def on_message(self, srv=None, sender=None, receivers=None, channel=None, text=None):
+        if self.gate is not None:
+            assert self.gate.wait(timeout=5)
+        self.seen.append(str(text))
+
+    def tick(self, srv=None, srv_lookup=None):
+        self.seen.append('tick')
+        self.phase_shift = None
+
+    def persist(self):
+        pass
+
+
+def factory(workers=4, gates=()):
+    q = queue.Queue()
+    srv = MockService()
+    default = Recorder(index=0)
+    mux = ShardedMuxDispatch(queue=q, workers=workers, default=default, daemon=True)
+    games = []
+    for i in range(1, 4):
+        game = Recorder(index=i, gate=gates[i - 1] if i - 1 < len(gates) else None)
+        channel = Channel(id='C{}'.format(i), name='ww-{}'.format(i))
+        mux.route(game, [channel])
+        games.append((game, channel))
+    mux.start()
+    return srv, QueuingDispatch(queue=q), mux, default, games
+
+
+def test_messages_are_routed_in_order():
+    srv, dispatcher, mux, default, games = factory()
+    bot = Agent('B0', 'Bot', True, 'Robotkin')
+
+    for n in range(10):
+        for game, channel in games:
+            dispatcher.raw_message(srv=srv, sender=Agent('ALICE', 'alice'), receivers=[bot], channel=channel,
+                                   text='vote {}'.format(n))
+    dispatcher.raw_message(srv=srv, sender=Agent('ALICE', 'alice'), receivers=[bot],
+                           channel=Channel(id='GENERAL', name='general'), text='hello')
+    mux.drain()
+
+    for game, channel in games:
+        assert game.seen == ['vote {}'.format(n) for n in range(10)]
+    assert default.seen == ['hello']
+
+
+def test_slow_game_does_not_block_others():
+    gate = threading.Event()
+    srv, dispatcher, mux, default, games = factory(workers=3, gates=[gate])
+    slow, slow_channel = games[0]
+    bot = Agent('B0', 'Bot', True, 'Robotkin')
+
+    dispatcher.raw_message(srv=srv, sender=Agent('ALICE', 'alice'), receivers=[bot], channel=slow_channel,
+                           text='vote bob')
+    others = [(game, channel) for game, channel in games[1:] if mux.shard(game) is not mux.shard(slow)]
+    for game, channel in others:
+        dispatcher.raw_message(srv=srv, sender=Agent('ALICE', 'alice'), receivers=[bot], channel=channel,
+                               text='vote bob')
+    mux.queue.join()
+    for worker in mux.workers:
+        if worker is not mux.shard(slow):
+            worker.queue.join()
+
+    for game, channel in others:
+        assert game.seen == ['vote bob']
+    assert slow.seen == []
+
+    gate.set()
+    mux.drain()
+    assert slow.seen == ['vote bob']
+
+
+def test_tick_reaches_only_due_games():
+    srv, dispatcher, mux, default, games = factory()
+    (due, _), (later, _), (idle, _) = games
+    due.phase_shift = time.time() - 1
+    later.phase_shift = time.time() + 3600
+    for game, channel in games:
+        mux.arm(game)
+
+    dispatcher.tick(srv_lookup=lambda team: srv)
+    mux.drain()
+
+    assert due.seen == ['tick']
+    assert later.seen == []
+    assert idle.seen == []
+    assert mux.deadlines.next() == later.phase_shift
+
+
+def test_games_that_miss_a_tick_are_woken_again():
+    srv, dispatcher, mux, default, games = factory()
+    (broken, _), (orphan, _), _ = games
+
+    def tick(srv=None, srv_lookup=None):
+        raise RuntimeError('The service is down')
+    broken.tick = tick
+    broken.phase_shift = orphan.phase_shift = time.time() - 1
+    orphan.team = 'GONE'
+    mux.arm(broken)
+    mux.arm(orphan)
+
+    before = time.time()
+    dispatcher.tick(srv_lookup=lambda team: None if team == 'GONE' else srv)
+    mux.drain()
+
+    assert orphan.seen == []
+    assert before + mux.tick_retry <= mux.deadlines.next() <= time.time() + mux.tick_retry
+    assert {target for when, _, target in mux.deadlines.heap if when > before} == {broken, orphan}
+
+
+def test_finished_games_return_their_channels_once_unrouted(monkeypatch):
+    srv, dispatcher, mux, default, games = factory()
+    (ending, channel), _, _ = games
+    ending.pooled_channels = lambda: [(channel, [])]
+    ending.tick = lambda srv=None, srv_lookup=None: (DeleteTarget(ending, srv),)
+    ending.phase_shift = time.time() - 1
+    mux.arm(ending)
+    returned = []
+    monkeypatch.setattr(pool, 'give_back', lambda srv=None, channels=(): returned.extend(
+        (c, mux.routed(c)) for c, members in channels))
+
+    dispatcher.tick(srv_lookup=lambda team: srv)
+    mux.drain()
+
+    assert returned == [(channel, False)]
+
+
+class Saver(Recorder):
+    """Only commands change anything; 'next' also ends the phase"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = False
+        self.saves = 0
+
+    def on_message(self, srv=None, sender=None, receivers=None, channel=None, text=None):
+        super().on_message(srv=srv, sender=sender, receivers=receivers, channel=channel, text=text)
+        if text.startswith(('vote', 'next')):
+            self.dirty = True
+        if text == 'next':
+            self.phase_shift = time.time() + 3600
+
+    def persist(self):
+        self.dirty = False
+        self.saves += 1
+
+
+def test_writes_are_coalesced():
+    mux = MuxDispatch(default=Recorder(index=0), write_window=60)
+    game = Saver(index=1)
+    channel = Channel(id='C1')
+    mux.route(game, [channel])
+
+    for text in ['hello', 'vote a', 'vote b', 'chatter', 'vote c']:
+        mux.target_message(game, channel=channel, text=text)
+    assert game.saves == 0
+    assert mux.deadlines.take(now=time.time() + 61) == {Flush(game)}
+    mux.target_flush(game)
+    assert game.saves == 1
+
+    # Nothing has changed since
+    mux.target_message(game, channel=channel, text='hello')
+    mux.target_flush(game)
+    assert game.saves == 1
+
+    # The end of a phase is written out at once
+    mux.target_message(game, channel=channel, text='vote d')
+    mux.target_message(game, channel=channel, text='next')
+    assert game.saves == 2
+    assert Flush(game) not in mux.deadlines.when
+
+
+class Stored(Recorder):
+    def persist(self):
+        persist.save(self.index, self)
+
+    def save(self):
+        return self
+
+
+def test_games_are_loaded_when_first_needed(tmp_path, monkeypatch):
+    monkeypatch.setattr(persist, 'DATA_DIR', str(tmp_path))
+    mux = MuxDispatch(default=Recorder(index=0))
+    for i in range(1, 4):
+        game = Stored(index=i, team='T1')
+        mux.register(game, [Channel(id='C{}'.format(i))])
+    mux.persist()
+
+    loads = []
+
+    def target_factory(value):
+        loads.append(value.index)
+        return value
+
+    loaded = persist.load('mux', factory=partial(MuxDispatch.load, default_type=lambda: Recorder(index=0),
+                                                 default_factory=None, target_factory=target_factory))
+    assert loads == []
+    assert all(isinstance(target, LazyTarget) for target in loaded.target_map)
+
+    loaded.on_message(channel=Channel(id='C2', name='ww-2'), text='hello')
+    assert loads == [2]
+    game = loaded.route_ids['C2']
+    assert isinstance(game, Stored) and game.seen == ['hello']
+
+    loaded.preload()
+    assert sorted(loads) == [1, 2, 3]
+    assert not any(isinstance(target, LazyTarget) for target in loaded.target_map)
+
+
+def test_idle_games_are_swapped_out(tmp_path, monkeypatch):
+    monkeypatch.setattr(persist, 'DATA_DIR', str(tmp_path))
+    loads = []
+
+    def target_factory(value):
+        loads.append(value.index)
+        return value
+    mux = MuxDispatch(default=Recorder(index=0), idle_timeout=60, target_factory=target_factory)
+    busy, idle = Stored(index=1, team='T1'), Stored(index=2, team='T1')
+    idle.phase_shift = time.time() + 3600
+    mux.register(busy, [Channel(id='C1')])
+    mux.register(idle, [Channel(id='C2')])
+    mux.on_message(channel=Channel(id='C2'), text='vote a')
+    # As if the other game had been in use since
+    mux.deadlines.arm(Hibernate(busy), time.time() + 120)
+
+    for target in mux.deadlines.take(now=time.time() + 61):
+        assert target == Hibernate(idle)
+        mux.target_hibernate(target.target)
+    stub = mux.route_ids['C2']
+    assert isinstance(stub, LazyTarget) and mux.route_ids['C1'] is busy
+    assert mux.deadlines.when[stub] == idle.phase_shift
+    assert mux.stats() == {'resident': 1, 'swapped_out': 1}
+
+    # It is reloaded, as it was written out, by the next message
+    mux.on_message(channel=Channel(id='C2'), text='vote b')
+    assert loads == [2]
+    game = mux.route_ids['C2']
+    assert game is not idle and game.seen == ['vote a', 'vote b']
+    assert Hibernate(game) in mux.deadlines.when
+
+
+def test_deadlines_wake_when_due():
+    deadlines = Deadlines()
+    deadlines.arm('a', time.time() + 3600)
+    deadlines.arm('b', time.time() + 0.05)
+    deadlines.arm('c', time.time() + 0.1)
+    deadlines.arm('c', None)
+
+    start = time.time()
+    assert deadlines.wait(timeout=5)
+    assert 0.04 <= time.time() - start < 1
+    assert deadlines.take() == {'b'}
+    assert not deadlines.wait(timeout=0.15)
+    assert deadlines.take() == set()
+
+
+class SlowService(MockService):
+    def lookup_user(self, agent=None):
+        time.sleep(int(agent.id) / 1000)
+        return agent.replace(name='user{}'.format(agent.id))
+
+
+def test_resolution_is_concurrent_but_handling_is_ordered():
+    q = queue.Queue()
+    srv = SlowService()
+    default = Recorder(index=0)
+    mux = MuxDispatch(queue=q, resolvers=8, default=default, daemon=True)
+    mux.start()
+    dispatcher = QueuingDispatch(queue=q)
+
+    start = time.time()
+    delays = [50 - 2 * n for n in range(20)]
+    for n, delay in enumerate(delays):
+        dispatcher.raw_message(srv=srv, sender=Agent(str(delay)), receivers=[], channel=Channel(id='GENERAL'),
+                               text='message {}'.format(n))
+    q.join()
+
+    assert default.seen == ['message {}'.format(n) for n in range(20)]
+    assert time.time() - start < sum(delays) / 1000
+
+
+class AsyncSlowService(AsyncBaseService):
+    team = None
+
+    async def lookup_user(self, agent=None):
+        await asyncio.sleep(int(agent.id) / 1000)
+        return agent.replace(name='user{}'.format(agent.id))
+
+    async def lookup_channel(self, channel=None):
+        return channel
+
+    async def broadcast(self, channel=None, text=None):
+        return {'ts': 1}
+
+
+class Broadcaster(Recorder):
+    def on_message(self, srv=None, sender=None, receivers=None, channel=None, text=None):
+        super().on_message(srv=srv, sender=sender, receivers=receivers, channel=channel, text=text)
+        srv.broadcast(channel=channel, text=text)
+
+
+def test_async_dispatch_keeps_per_game_order():
+    async def main():
+        q = asyncio.Queue()
+        srv = SyncService(service=AsyncSlowService(), loop=asyncio.get_running_loop())
+        default = Broadcaster(index=0)
+        mux = AsyncMuxDispatch(queue=q, workers=4, resolvers=8, default=default)
+        games = []
+        for i in range(1, 4):
+            game = Broadcaster(index=i)
+            channel = Channel(id='C{}'.format(i), name='ww-{}'.format(i))
+            mux.route(game, [channel])
+            games.append((game, channel))
+        mux.start()
+        dispatcher = AsyncQueuingDispatch(queue=q)
+
+        start = time.time()
+        for n in range(10):
+            for game, channel in games:
+                dispatcher.raw_message(srv=srv, sender=Agent(str(20 - n)), receivers=[], channel=channel,
+                                       text='vote {}'.format(n))
+        await mux.drain()
+
+        for game, channel in games:
+            assert game.seen == ['vote {}'.format(n) for n in range(10)]
+        assert time.time() - start < sum(20 - n for n in range(10)) * 3 / 1000
+
+    asyncio.run(main())
+
+
+def test_async_dispatch_from_other_threads():
+    async def main():
+        mux = AsyncMuxDispatch(queue=asyncio.Queue(), workers=2, default=Recorder(index=0))
+        game = Recorder(index=1)
+        mux.route(game, [Channel(id='C1')])
+        mux.start()
+        # As a game's thread does, handing on an administrative callback's work
+        sent = threading.Thread(target=lambda: [mux.dispatch(game, game.seen.append, n) for n in range(5)])
+        sent.start()
+        await asyncio.get_running_loop().run_in_executor(None, sent.join)
+        await mux.drain()
+        assert game.seen == list(range(5))
+
+    asyncio.run(main())
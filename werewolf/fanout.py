@@ -0,0 +1,51 @@
+"""Make a batch of independent calls to a service at once
+
+Starting a game makes a channel for every room and every player - each a few
+round-trips to the service - and then sends every player several welcome messages.
+These calls are made concurrently on a pool of FANOUT_WORKERS threads, shared by every
+game. Messages to any one channel are still sent in the order they were written."""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+
+LOG = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get('FANOUT_WORKERS', 8))
+_pool = ThreadPoolExecutor(max_workers=max(WORKERS, 1), thread_name_prefix='fanout')
+
+
+def gather(f, calls):
+    """Call f with each of a list of keyword arguments; returns the results in the same order"""
+    futures = [_pool.submit(f, **kwargs) for kwargs in calls]
+    # Wait for every call, even once one has failed, before raising
+    errors = [future.exception() for future in futures]
+    for error in errors:
+        if error is not None:
+            raise error
+    return [future.result() for future in futures]
+
+
+class Outbox:
+    """Stand in for a service, holding back the messages broadcast through it
+
+    Every other call is passed straight on to the service. send() then delivers what has
+    been held back: to different channels at once, and to any one channel in order."""
+    def __init__(self, srv=None):
+        self.srv = srv
+        self.messages = OrderedDict()     # Channel: [Text]
+
+    def __getattr__(self, name):
+        return getattr(self.srv, name)
+
+    def broadcast(self, channel=None, text=None):
+        self.messages.setdefault(channel, []).append(text)
+
+    def send(self):
+        gather(self.send_all, [dict(channel=channel, texts=texts) for channel, texts in self.messages.items()])
+        self.messages.clear()
+
+    def send_all(self, channel=None, texts=None):
+        for text in texts:
+            self.srv.broadcast(channel=channel, text=text)
@@ -0,0 +1,56 @@
+import threading
+import time
+
+import pytest
+
+from .fanout import Outbox, gather
+from .service import Channel
+
+
+def test_calls_are_made_at_once_and_results_kept_in_order():
+    def slow(n=None):
+        time.sleep(0.1)
+        return n * 2
+
+    start = time.time()
+    assert gather(slow, [dict(n=n) for n in range(6)]) == [0, 2, 4, 6, 8, 10]
+    assert time.time() - start < 0.5
+
+
+def test_failures_are_raised_once_every_call_is_done():
+    done = []
+
+    def call(n=None):
+        if n == 0:
+            raise RuntimeError('failed')
+        time.sleep(0.05)
+        done.append(n)
+
+    with pytest.raises(RuntimeError):
+        gather(call, [dict(n=n) for n in range(3)])
+    assert sorted(done) == [1, 2]
+
+
+class Recorder:
+    team = 'T1'
+
+    def __init__(self):
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def broadcast(self, channel=None, text=None):
+        time.sleep(0.01)
+        with self.lock:
+            self.sent.append((channel.id, text))
+
+
+def test_outbox_keeps_each_channels_order():
+    srv = Recorder()
+    outbox = Outbox(srv)
+    for n in range(5):
+        for c in ('C1', 'C2', 'C3'):
+            outbox.broadcast(channel=Channel(id=c), text=n)
+    assert outbox.team == 'T1' and srv.sent == []
+    outbox.send()
+    for c in ('C1', 'C2', 'C3'):
+        assert [text for channel, text in srv.sent if channel == c] == list(range(5))
@@ -1,9 +1,12 @@
 from collections import defaultdict
 import logging
+import os
 import random
 import time
 from uuid import uuid4 as uuid
 
+from . import archive, clock, fanout, journal, pool
+from .codec import pack, unpack
 from .dispatch import BaseDispatch, NewTarget, DeleteTarget
 from .schedule import parse as time_parse
 from .persist import save, drop
@@ -12,10 +15,14 @@ from .rules import game_type
 from .schedule import EmptySchedule
 from .scratchpad import ScratchPad
 from .service import Agent
+from .service.base import supports
 from .text import Text, reg
 
 LOG = logging.getLogger(__name__)
 
+# Personal channels are direct messages with the bot, rather than private channels
+DIRECT = os.environ.get('DIRECT_MESSAGES', '') not in ('', '0')
+
 
 class GeneralWerewolf(BaseDispatch):
     matcher = reg()
@@ -25,7 +32,9 @@ class GeneralWerewolf(BaseDispatch):
         if index is None:
             index = 0
         self.index = index
-        self.oauth_state = None
+        self.oauth_state = None     # Not persisted: an oauth flow does not survive a restart
+        self.dirty = False          # The index has changed since it was last persisted
+        self.routes = {}    # Channel id: target, as routed by the dispatcher
 
     def on_message(self, srv=None, sender=None, receivers=None, channel=None, text=None):
         me = receivers[0]
@@ -52,9 +61,13 @@ class GeneralWerewolf(BaseDispatch):
         # Make a channel for those users
         LOG.info("New game starting for %s", players)
         self.index += 1
+        self.dirty = True
         game = SpecificWerewolf(team=srv.team, index=self.index, parent=channel, players=players, rules=rules)
+        # Written out now, rather than once the game has started, so that a crash while its
+        # channels are made cannot hand out the same number again
         self.persist()
-        return game.start(srv=srv, bot=bot)
+        # A player's direct messages can only be routed to one game at a time
+        return game.start(srv=srv, bot=bot, in_use=lambda channel: channel.id in self.routes)
 
     @matcher(matcher.me, "delete", str)
     def delete(self, channel_name, srv=None, channel=None, bot=None, sender=None, text=None):
@@ -93,8 +106,7 @@ class GeneralWerewolf(BaseDispatch):
         def find_and_advance_game(driver):
             game = locate_target(driver, channel_name)
             if game is not None:
-                game.phase_shift = time.time()
-                game.tick(srv=srv)
+                driver.advance(game, srv=srv)
 
         return find_and_advance_game,
 
@@ -106,6 +118,7 @@ class GeneralWerewolf(BaseDispatch):
         LOG.info("oauth response: %s", response)
 
     def persist(self):
+        self.dirty = False
         save('default', self)
 
     def save(self):
@@ -129,9 +142,13 @@ class SpecificWerewolf(BaseDispatch):
         self.prelim = 0     # Walk once through preliminary phases
         self.phase = 0      # Cycle through main phases
         self.winner = None
+        self.dirty = True   # Changed since it was last persisted
+        self.journal_seq = 0    # The last event journalled
+        self.snapshot_seq = None    # The last event included in a saved snapshot
 
         # Allocate roles to players
         random.shuffle(players)
+        journal.deal(self, players)
         self.roles = {}     # Player: BaseRole
         self.room_map = defaultdict(list)   # room_name: [Player]
         self.rooms = {}     # room_name: Channel
@@ -147,31 +164,53 @@ class SpecificWerewolf(BaseDispatch):
         for phase in self.rules.get('prelim', []) + self.rules['phases']:
             phase['schedule'] = EmptySchedule()
 
-    def start(self, srv=None, bot=None):
-        self.public = srv.new_channel(name=self.base_name, invite=[bot] + self.players)
+    def start(self, srv=None, bot=None, direct=None, in_use=None):
+        """Make the game's channels, welcome its players and begin the first phase
+
+        With `direct` (or DIRECT_MESSAGES), each player's personal channel is their direct
+        messages with the bot, unless `in_use` says another game has those already."""
+        started = time.time()
+        direct = DIRECT if direct is None else direct
+        # Every channel is made at once; the game itself is only changed on this thread
+        rooms = list(self.room_map.items())
+        roles = list(self.roles.items())
+        opened = {}     # Player: Channel
+        if direct and supports(srv, 'open_direct'):
+            ims = fanout.gather(srv.open_direct, [dict(agent=player) for player, role in roles])
+            opened = {player: im for (player, role), im in zip(roles, ims) if in_use is None or not in_use(im)}
+        channels = fanout.gather(pool.new_channel(srv),
+                                 [dict(name=self.base_name, invite=[bot] + self.players)] +
+                                 [dict(name='{}-{}'.format(self.base_name, room), private=True, invite=[bot] + players)
+                                  for room, players in rooms] +
+                                 [dict(name='{}-{}'.format(self.base_name, player.name), private=True,
+                                       invite=[bot, player])
+                                  for player, role in roles if player not in opened])
+        made = iter(channels[1 + len(rooms):])
+        personal = [opened[player] if player in opened else next(made) for player, role in roles]
+        provisioned = time.time()
+
+        outbox = fanout.Outbox(srv)
+        self.public = channels[0]
         text = Text("A new game begins with ") + self.players + Text("\n")
         blurb = self.rules.get('blurb')
         if blurb is not None:
             text.append(blurb)
-        srv.broadcast(self.public, text)
+        outbox.broadcast(self.public, text)
 
-        for room, players in self.room_map.items():
-            channel = srv.new_channel(name='{}-{}'.format(self.base_name, room),
-                                      private=True,
-                                      invite=[bot] + players)
+        for (room, players), channel in zip(rooms, channels[1:]):
             self.rooms[room] = channel
             self.channels[channel] = [self.roles[player] for player in players]
 
         personal_channels = []
-        for player, role in self.roles.items():
-            channel = srv.new_channel(name='{}-{}'.format(self.base_name, player.name),
-                                      private=True,
-                                      invite=[bot, player])
-            role.welcome(srv=srv, channel=channel, game=self)
+        for (player, role), channel in zip(roles, personal):
+            role.welcome(srv=outbox, channel=channel, game=self)
             personal_channels.append(role.channel)
             self.channels[channel] = [self.roles[player]]
+        outbox.send()
 
         self.enter_phase(srv=srv)
+        LOG.info('Game %s started in %.2fs (%d channels made and %d opened in %.2fs)', self.index,
+                 time.time() - started, len(channels), len(opened), provisioned - started)
         return NewTarget(self, [self.public] + list(self.rooms.values()) + personal_channels),
 
     def on_message(self, srv=None, sender=None, receivers=None, channel=None, text=None):
@@ -191,9 +230,17 @@ class SpecificWerewolf(BaseDispatch):
             return
 
         LOG.info("dispatching message on %s from %s: %s to %s", channel, sender, text, self.roles[sender])
-        if self.roles[sender].on_message(srv=srv, game=self, channel=channel, text=text.split()):
-            # If something happened, let's potentially advance the game state in response
-            return self.tick(srv=srv)
+        # The whole of an event happens at a single moment, so that it may be replayed exactly
+        at, notice = clock.now(), self.notice
+        with clock.frozen(at):
+            if self.roles[sender].on_message(srv=srv, game=self, channel=channel, text=text.split()):
+                self.dirty = True
+                journal.message(self, sender=sender, receivers=receivers, channel=channel, text=text, at=at)
+                # If something happened, let's potentially advance the game state in response
+                result = self.check_phase(srv=srv)
+                if self.notice != notice:
+                    journal.notice(self)
+                return result
         return
 
     @property
@@ -211,7 +258,7 @@ class SpecificWerewolf(BaseDispatch):
     def enter_phase(self, srv=None):
         self.notice = None
         phase = self.current_phase
-        self.phase_start = time.time()
+        self.phase_start = clock.now()
         self.phase_shift = phase['schedule'].next_time_in_period(delta=time_parse(phase['duration']))
         self.current_phase['handler'].on_entry(srv=srv, game=self)
         self.update_notice(srv=srv)
@@ -226,12 +273,12 @@ class SpecificWerewolf(BaseDispatch):
         for p in self.dead:
             notice.extend((' ', p, ' (', self.roles[p].role.name, ')'))
         notice.append('\n')
-        now = time.time()
+        now = clock.now()
         running = True
         if self.phase_shift > now:
             notice.extend(('This phase will end at ', time.strftime("%I:%M%p on %A", time.gmtime(self.phase_shift)),
 
-                           ' (', int((self.phase_shift - time.time() + 59) // 60), ' minutes from now)\n'))
+                           ' (', int((self.phase_shift - now + 59) // 60), ' minutes from now)\n'))
         else:
             running = False
             notice.append('This phase has ended\n')
@@ -243,14 +290,27 @@ class SpecificWerewolf(BaseDispatch):
         self.notice = srv.post_notice(channel=self.public, notice=self.notice, text=notice)
 
     def tick(self, srv=None, srv_lookup=None):
+        at, phase_shift, phase = clock.now(), self.phase_shift, (self.prelim, self.phase, self.phase_start)
+        notice = self.notice
+        with clock.frozen(at):
+            result = self.check_phase(srv=srv)
+        if result is not None or (self.prelim, self.phase, self.phase_start) != phase:
+            journal.tick(self, phase_shift, at=at)
+        if self.notice != notice:
+            journal.notice(self)
+        return result
+
+    def check_phase(self, srv=None):
+        """Update the notice, and end the phase (or the game) if it's time"""
+        self.dirty = True
         self.update_notice(srv=srv)
 
         # Possibly, one side has conceded. Hand the victory to the other side.
         if self.winner is not None:
-            return DeleteTarget(self),
+            return DeleteTarget(self, srv),
 
         # Possibly, end the phase. If so, we may want to stop the game.
-        if self.phase_shift > time.time():
+        if self.phase_shift > clock.now():
             return
 
         self.winner = self.current_phase['handler'].on_exit(srv=srv, game=self)
@@ -267,21 +327,41 @@ class SpecificWerewolf(BaseDispatch):
             notice.extend(("A side emerges victorious: ", self.winner))
 
             srv.post_notice(channel=self.public, text=notice)
-            return DeleteTarget(self),
+            return DeleteTarget(self, srv),
 
         # Shift phases
         self.advance_phase()
         self.enter_phase(srv=srv)
 
+    def pooled_channels(self):
+        """The private channels that a pool may take back at the end of the game, each with its members"""
+        return [(channel, [role.player for role in roles]) for channel, roles in self.channels.items()
+                if channel.is_private]
+
     def persist(self):
-        if self.winner is None:
-            save(self.index, self)
-        else:
+        self.dirty = False
+        if self.winner is not None:
+            if archive.ENABLED and not getattr(self, 'archived', False):
+                try:
+                    archive.archive().add(self)
+                    self.archived = True
+                except Exception:
+                    LOG.exception('Problem archiving game %s', self.index)
             drop(self.index)
+            journal.discard(self)
+        elif journal.snapshot_due(self):
+            snapshot_seq, self.snapshot_seq = self.snapshot_seq, self.journal_seq
+            if save(self.index, self):
+                journal.discard(self)
+            else:
+                self.snapshot_seq = snapshot_seq
 
     def save(self):
-        return self
+        return pack(self)
 
     @classmethod
     def load(cls, value):
-        return value
+        if isinstance(value, bytes):
+            value = unpack(value, cls=cls)
+        # Otherwise, this is a game pickled whole by an earlier version
+        return journal.recover(value)
@@ -6,6 +6,7 @@ import unittest.mock
 import yaml
 from .service import Agent
 from werewolf.service.service_test import MockService
+from . import journal, persist
 from .game import SpecificWerewolf
 from .roles import VILLAGERS, EVIL, HERO, WEREWOLF, VILLAGER, SORCEROR, SEER
 from .rules import load_game, load_games, game_type
@@ -320,3 +321,48 @@ def test_loaded_game(rules=standard_rules(name="village-of-visions", number=5)):
 
     assert game.dead == [players[0]]
     return srv, bot, players, game
+
+
+def test_journal_replay(tmp_path, monkeypatch, rules=standard_rules(name="village-of-visions", number=5)):
+    monkeypatch.setattr(persist, 'DATA_DIR', str(tmp_path))
+    monkeypatch.setattr(journal, 'ENABLED', True)
+    srv, bot, players, game = factory(rules)
+    game.start(srv=srv, bot=bot)
+    game.persist()      # The first snapshot
+
+    seer, wolf = game.roles[players[3]], game.roles[players[4]]
+    game.on_message(srv=srv, channel=seer.channel, sender=seer.player, text=Text("scry alice"))
+    game.on_message(srv=srv, channel=wolf.channel, sender=wolf.player, text=Text("observe delia"))
+    game.phase_shift = 0
+    game.tick(srv=srv)
+    game.phase_shift = 0
+    game.tick(srv=srv)
+    game.on_message(srv=srv, channel=wolf.channel, sender=wolf.player, text=Text("kill alice"))
+    game.phase_shift = 0
+    game.tick(srv=srv)
+    assert game.dead == [players[0]]
+    game.persist()      # Not yet due for another snapshot
+
+    loaded = persist.load(game.index, factory=SpecificWerewolf.load)
+    assert loaded.dead == [players[0]]
+    assert loaded.players == game.players
+    assert loaded.current_phase['name'] == game.current_phase['name'] == 'day'
+    assert (loaded.phase_start, loaded.phase_shift) == (game.phase_start, game.phase_shift)
+    assert loaded.journal_seq == game.journal_seq
+    # The notice of the phase that began since the snapshot is updated, not posted again
+    assert game.notice is not None
+    assert loaded.notice == game.notice
+
+
+def test_direct_messages(rules=simple_rules):
+    srv, bot, players, game = factory(rules)
+    busy = srv.open_direct(agent=players[0])
+
+    new_target, = game.start(srv=srv, bot=bot, direct=True, in_use=lambda channel: channel == busy)
+
+    # Every player but the one already in another game is welcomed in their direct messages
+    assert not game.roles[players[0]].channel.is_im
+    assert all(game.roles[p].channel == srv.open_direct(agent=p) for p in players[1:])
+    assert srv._messages[game.roles[players[1]].channel][0] == ['Your role: ', game.roles[players[1]].role.name]
+    assert sum(c.is_private for c in srv._channel_cache.values()) == 2     # Evil, and the one private channel
+    assert set(new_target.channels) >= {game.roles[p].channel for p in players}
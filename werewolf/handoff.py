@@ -0,0 +1,88 @@
+"""Shut down cleanly, or hand over to a new process without a gap
+
+On SIGTERM (or, under gunicorn, as its worker exits), a process stops taking new events,
+lets its queue drain for up to DRAIN_TIMEOUT seconds and writes out every pending change
+before it exits. Any events still queued at the deadline are not lost: they remain in
+the inbound journal (see werewolf.inbound) and are replayed by the next process to start.
+
+With HANDOFF_SOCKET naming a unix socket, a running process also waits there for its
+successor. A new process started with the same setting connects to it before it loads
+any games. The old process stops accepting, drains and writes out as above, and then
+passes its listening sockets (and its lock on DATA_DIR; see werewolf.leader) across and
+exits; the new process loads the games and serves from those same sockets. Connections
+made during the handover wait in the sockets' backlog, rather than being refused.
+"""
+
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+
+LOG = logging.getLogger(__name__)
+
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', 20))
+HANDOFF_SOCKET = os.environ.get('HANDOFF_SOCKET')
+MAX_FDS = 8
+
+
+def within(f, timeout=None):
+    """Run f, giving up on waiting for it after the timeout; returns True if it finished"""
+    t = threading.Thread(target=f, name='drain', daemon=True)
+    t.start()
+    t.join(timeout)
+    return not t.is_alive()
+
+
+def on_terminate():
+    """Exit (running the atexit hooks, which drain and write out) on SIGTERM"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+
+def take_over(path=None, timeout=None):
+    """Wait for any process already running to finish up, and return the fds it passes over
+
+    Returns an empty list if there is no such process."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return []
+    LOG.info('Taking over from the process listening on %s', path)
+    sock.settimeout(2 * DRAIN_TIMEOUT + 10 if timeout is None else timeout)
+    with sock:
+        try:
+            msg, fds, flags, addr = socket.recv_fds(sock, 16, MAX_FDS)
+        except socket.timeout:
+            raise RuntimeError('The process on {} did not hand over in time'.format(path))
+    if not msg:
+        raise RuntimeError('The process on {} exited without handing over'.format(path))
+    LOG.info('Took over %d file descriptors', len(fds))
+    return fds
+
+
+class HandoffListener(threading.Thread):
+    """Wait for a successor; then `stop` accepting and finishing up, pass it the `fds` and exit"""
+    def __init__(self, path=None, stop=None, fds=None, exit=os._exit, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self.stop = stop
+        self.fds = fds
+        self.exit = exit
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(1)
+
+    def run(self):
+        conn, _ = self.server.accept()
+        with conn:
+            LOG.info('Handing over to a new process')
+            self.stop()
+            socket.send_fds(conn, [b'ok'], self.fds())
+        self.server.close()
+        LOG.info('Handed over; exiting')
+        self.exit(0)
@@ -0,0 +1,63 @@
+import os
+import socket
+import threading
+
+from .dispatch import QueuingDispatch
+from .handoff import HandoffListener, take_over, within
+from .ingress import IngressQueue, Deduplicator
+from .ipc import IPCClient, IPCListener
+from .ipc_test import Srv
+
+
+def test_nobody_to_take_over_from(tmpdir):
+    assert take_over(os.path.join(str(tmpdir), 'handoff')) == []
+
+
+def test_listening_sockets_are_handed_over(tmpdir):
+    path = os.path.join(str(tmpdir), 'handoff')
+    listening = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening.bind(('127.0.0.1', 0))
+    listening.listen(8)
+    steps = []
+    old = HandoffListener(path=path, stop=lambda: steps.append('stop'), fds=lambda: [listening.fileno()],
+                          exit=lambda code: steps.append('exit'), daemon=True)
+    old.start()
+
+    fds = take_over(path, timeout=5)
+    old.join(timeout=5)
+    assert steps == ['stop', 'exit']
+    taken = socket.socket(fileno=fds[0])
+    assert taken.getsockname() == listening.getsockname()
+
+    # A connection to the old socket is accepted by the new owner
+    with socket.create_connection(listening.getsockname()):
+        conn, _ = taken.accept()
+        conn.close()
+
+
+def test_requests_move_to_the_new_owner(tmpdir):
+    path = os.path.join(str(tmpdir), 'sock')
+    services = {'T1': Srv('T1')}
+
+    def owner(sock=None):
+        q = IngressQueue(maxsize=10)
+        listener = IPCListener(path=path, dispatcher=QueuingDispatch(queue=q), dedup=Deduplicator(), routes={},
+                               stats=q.stats, srv_lookup=services.get, sock=sock, daemon=True)
+        listener.start()
+        return listener, q
+
+    old, old_queue = owner()
+    client = IPCClient(path=path)
+    assert client.call('claim', 'E1')
+    old.stop()
+    new, new_queue = owner(sock=old.server)
+    # The client's open connection is refused, and it reconnects to the new owner
+    assert client.call('claim', 'E1')
+    assert client.call('stats')['depth'] == 0
+
+
+def test_within():
+    gate = threading.Event()
+    assert within(lambda: None, 1)
+    assert not within(gate.wait, 0.1)
+    gate.set()
@@ -0,0 +1,186 @@
+"""A durable journal of the events accepted from the service
+
+With INBOUND_JOURNAL set (the default), each incoming event is appended to a journal under
+DATA_DIR/inbound, and synced to disk, before the service is told that it has been
+accepted. Requests that arrive together share a single sync (a group commit): while one
+is being made, the appends behind it accumulate, and the next sync covers all of them.
+
+As events are completely handled, a checkpoint records the sequence number up to which
+everything is done - the low watermark. On startup, any journalled events beyond the
+checkpoint are queued again, so that nothing accepted before a crash or a restart is lost.
+Events are therefore handled at least once: one that was handled just before a crash,
+while the checkpoint still lagged behind it, is handled a second time.
+
+The journal is kept in segments of about INBOUND_SEGMENT bytes; a segment is removed once
+the checkpoint has passed every event in it."""
+
+import heapq
+import json
+import logging
+import os
+import os.path
+import struct
+import threading
+
+from . import persist
+from .ipc import encode_record, decode_record
+
+LOG = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('INBOUND_JOURNAL', '1') not in ('', '0')
+SEGMENT_SIZE = int(os.environ.get('INBOUND_SEGMENT', 4 * 1024 * 1024))
+CHECKPOINT = 'checkpoint'
+SUFFIX = '.log'
+MARK = struct.Struct('>Q')
+
+
+class InboundJournal:
+    def __init__(self, path=None, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()            # Guards the segment being written
+        self.progress = threading.Lock()        # Guards the events in hand and the checkpoint
+        self.sync_done = threading.Condition()
+        self.syncing = False
+        self.synced = 0
+        self.syncs = 0
+        self.appended = 0
+        self.outstanding = {}   # seq: pieces of work still to be done for that event
+        self.heap = []          # Those seqs, lowest first (some may already be done)
+        self.checkpoint_fd = os.open(os.path.join(path, CHECKPOINT), os.O_RDWR | os.O_CREAT, 0o644)
+        data = os.pread(self.checkpoint_fd, MARK.size, 0)
+        self.mark = MARK.unpack(data)[0] if len(data) == MARK.size else 0
+        self.segments = sorted(int(name[:-len(SUFFIX)]) for name in os.listdir(path) if name.endswith(SUFFIX))
+        self.seq = self.last = max([self.mark] + [seq for seq, record in self.records()])
+        self.file = None
+
+    def records(self):
+        """Every complete record in the journal, oldest first"""
+        for first in self.segments:
+            try:
+                with open(self.segment(first), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            offset = 0
+            while offset + persist.RECORD.size <= len(data):
+                size, = persist.RECORD.unpack_from(data, offset)
+                if offset + persist.RECORD.size + size > len(data):
+                    LOG.warning('Ignoring a partial record at the end of %s', self.segment(first))
+                    break
+                seq, record = json.loads(data[offset + persist.RECORD.size:offset + persist.RECORD.size + size])
+                yield seq, record
+                offset += persist.RECORD.size + size
+
+    def segment(self, first):
+        return os.path.join(self.path, '{:020d}{}'.format(first, SUFFIX))
+
+    def recover(self, srv_lookup=None):
+        """The events that were accepted but not done when the journal was last open
+
+        Each is marked as being in hand, just as if it had been newly appended."""
+        pending = []
+        for seq, record in self.records():
+            if seq <= self.mark:
+                continue
+            m = decode_record(record, srv_lookup=srv_lookup)
+            if m is None:
+                LOG.warning('Dropping journalled event %d for an unknown team', seq)
+                continue
+            m.seq = seq
+            self.hold(seq)
+            pending.append(m)
+        if pending:
+            LOG.info('Recovered %d events accepted after event %d', len(pending), self.mark)
+        return pending
+
+    def append(self, m):
+        """Journal an event, returning once it is safely on disk"""
+        with self.lock:
+            self.seq += 1
+            seq = m.seq = self.seq
+            data = json.dumps([seq, encode_record(m)]).encode('utf-8')
+            if self.file is None or self.file.tell() >= self.segment_size:
+                self.rotate(seq)
+            self.file.write(persist.RECORD.pack(len(data)) + data)
+            self.hold(seq)
+            self.appended += 1
+        self.sync(seq)
+        return seq
+
+    def sync(self, seq):
+        with self.sync_done:
+            while self.synced < seq and self.syncing:
+                self.sync_done.wait()
+            if self.synced >= seq:
+                return
+            self.syncing = True
+        upto = self.synced
+        try:
+            with self.lock:
+                upto = self.seq
+                self.file.flush()
+                os.fdatasync(self.file.fileno())
+            self.syncs += 1
+        finally:
+            with self.sync_done:
+                self.synced = max(self.synced, upto)
+                self.syncing = False
+                self.sync_done.notify_all()
+
+    def rotate(self, first):
+        """Start a new segment, and remove those that are entirely done; the caller holds the lock"""
+        if self.file is not None:
+            self.file.flush()
+            os.fdatasync(self.file.fileno())
+            self.file.close()
+        with self.progress:
+            mark = self.mark
+        while len(self.segments) > 1 and self.segments[1] - 1 <= mark:
+            try:
+                os.unlink(self.segment(self.segments.pop(0)))
+            except FileNotFoundError:
+                pass
+        self.segments.append(first)
+        self.file = open(self.segment(first), 'ab')
+
+    def hold(self, seq):
+        """Note one more piece of work to be done for an event"""
+        with self.progress:
+            if seq not in self.outstanding:
+                self.outstanding[seq] = 0
+                heapq.heappush(self.heap, seq)
+                self.last = max(self.last, seq)
+            self.outstanding[seq] += 1
+
+    def release(self, seq):
+        """Note that a piece of work for an event is done, moving the checkpoint on if we can"""
+        with self.progress:
+            self.outstanding[seq] -= 1
+            if self.outstanding[seq] > 0:
+                return
+            del self.outstanding[seq]
+            while self.heap and self.heap[0] not in self.outstanding:
+                heapq.heappop(self.heap)
+            mark = self.heap[0] - 1 if self.heap else self.last
+            if mark > self.mark:
+                self.mark = mark
+                # Not synced: should this be lost, we only replay more than we need to
+                os.pwrite(self.checkpoint_fd, MARK.pack(mark), 0)
+
+    def stats(self):
+        with self.progress:
+            return {'seq': self.last, 'checkpoint': self.mark, 'outstanding': len(self.outstanding),
+                    'appended': self.appended, 'syncs': self.syncs}
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        os.close(self.checkpoint_fd)
+
+
+def journal(data_dir=None):
+    return InboundJournal(path=os.path.join(data_dir or persist._data_dir(), 'inbound'))
@@ -0,0 +1,113 @@
+import os
+import queue
+import threading
+
+from .dispatch import QueuingDispatch, ShardedMuxDispatch, QueuedOnMessage
+from .dispatch_test import Recorder
+from .inbound import InboundJournal
+from .service import Agent, Channel
+
+
+class Srv:
+    def __init__(self, team):
+        self.team = team
+
+    def lookup_user(self, agent=None):
+        return agent
+
+    def lookup_channel(self, channel=None):
+        return channel
+
+
+SERVICES = {'T1': Srv('T1')}
+
+
+def message(text):
+    return QueuedOnMessage(SERVICES['T1'], Agent(id='U1'), [], Channel(id='C1'), text, None)
+
+
+def test_unfinished_events_survive_a_restart(tmpdir):
+    journal = InboundJournal(path=str(tmpdir))
+    for text in ('a', 'b', 'c', 'd'):
+        journal.append(message(text))
+    journal.release(1)
+    journal.release(3)
+    # Event 2 is not yet done, so the checkpoint cannot pass it
+    assert journal.stats()['checkpoint'] == 1
+    journal.close()
+
+    journal = InboundJournal(path=str(tmpdir))
+    pending = journal.recover(srv_lookup=SERVICES.get)
+    assert [(m.seq, m.text) for m in pending] == [(2, 'b'), (3, 'c'), (4, 'd')]
+    assert pending[0].srv is SERVICES['T1']
+    for m in pending:
+        journal.release(m.seq)
+    assert journal.append(message('e')) == 5
+    journal.release(5)
+    journal.close()
+
+    assert InboundJournal(path=str(tmpdir)).recover(srv_lookup=SERVICES.get) == []
+
+
+def test_appends_share_syncs(tmpdir):
+    journal = InboundJournal(path=str(tmpdir))
+
+    def send(n):
+        for i in range(n):
+            journal.append(message(str(i)))
+    threads = [threading.Thread(target=send, args=(25,)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats = journal.stats()
+    assert stats['appended'] == 200
+    assert stats['syncs'] <= 200
+    assert len(InboundJournal(path=str(tmpdir)).recover(srv_lookup=SERVICES.get)) == 200
+
+
+def test_finished_segments_are_removed(tmpdir):
+    journal = InboundJournal(path=str(tmpdir), segment_size=100)
+    for i in range(20):
+        journal.release(journal.append(message('vote {}'.format(i))))
+    segments = [name for name in os.listdir(str(tmpdir)) if name.endswith('.log')]
+    assert 1 <= len(segments) <= 2
+
+
+def test_events_are_done_once_their_game_has_handled_them(tmpdir):
+    journal = InboundJournal(path=str(tmpdir))
+    q = queue.Queue()
+    gate = threading.Event()
+    game = Recorder(index=1, team='T1', gate=gate)
+    mux = ShardedMuxDispatch(queue=q, workers=2, default=Recorder(index=0), inbound=journal, daemon=True)
+    mux.route(game, [Channel(id='C1')])
+    mux.start()
+    dispatcher = QueuingDispatch(queue=q, inbound=journal)
+    dispatcher.raw_message(srv=SERVICES['T1'], sender=Agent(id='U1'), receivers=[], channel=Channel(id='C1'),
+                           text='vote bob')
+    q.join()
+    # Routed to its game's worker, but not yet handled there
+    assert journal.stats()['checkpoint'] == 0
+    gate.set()
+    mux.drain()
+    assert game.seen == ['vote bob']
+    assert journal.stats() == dict(journal.stats(), checkpoint=1, outstanding=0)
+
+
+def test_events_are_done_once_their_changes_are_written_out(tmpdir):
+    journal = InboundJournal(path=str(tmpdir))
+    q = queue.Queue()
+    game = Recorder(index=1, team='T1')
+    mux = ShardedMuxDispatch(queue=q, workers=2, default=Recorder(index=0), inbound=journal, write_window=60,
+                             daemon=True)
+    mux.route(game, [Channel(id='C1')])
+    mux.start()
+    dispatcher = QueuingDispatch(queue=q, inbound=journal)
+    dispatcher.raw_message(srv=SERVICES['T1'], sender=Agent(id='U1'), receivers=[], channel=Channel(id='C1'),
+                           text='vote bob')
+    mux.drain()
+    # Handled, but its change to the game is held back by the write window
+    assert game.seen == ['vote bob']
+    assert journal.stats()['checkpoint'] == 0
+    mux.flush()
+    assert journal.stats() == dict(journal.stats(), checkpoint=1, outstanding=0)
@@ -0,0 +1,110 @@
+import cachetools
+import logging
+import queue
+import threading
+from .dispatch import QueuedTick
+
+LOG = logging.getLogger(__name__)
+
+REJECT = 'reject'
+SHED = 'shed'
+
+
+class IngressQueue(queue.Queue):
+    """A bounded queue for incoming events
+
+    At most one QueuedTick is ever pending; further ticks are merged into it, and ticks
+    are never refused. When the queue is full, other events are refused (put raises
+    queue.Full once the timeout expires) - unless the policy is SHED and the `shed`
+    predicate says the event is expendable, in which case it is silently dropped. put
+    returns False if the event was merged or dropped, and True if it was queued."""
+    def __init__(self, maxsize=1000, policy=REJECT, shed=None):
+        super().__init__(maxsize=maxsize)
+        self.policy = policy
+        self.shed = shed
+        self.ticks = 0
+        self.high_water = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def put(self, item, block=True, timeout=None):
+        with self.mutex:
+            if isinstance(item, QueuedTick):
+                if self.ticks > 0:
+                    self.coalesced += 1
+                    return False
+                self._enqueue(item)
+                return True
+            if (self.policy == SHED and self.shed is not None and
+                    0 < self.maxsize <= self._qsize() and self.shed(item)):
+                self.dropped += 1
+                return False
+        try:
+            super().put(item, block=block, timeout=timeout)
+            return True
+        except queue.Full:
+            with self.mutex:
+                self.rejected += 1
+            LOG.warning('Ingress queue is full; rejecting %s', type(item).__name__)
+            raise
+
+    def _enqueue(self, item):
+        # Bypass the size limit; the caller holds the mutex
+        self._put(item)
+        self.unfinished_tasks += 1
+        self.not_empty.notify()
+
+    def _put(self, item):
+        if isinstance(item, QueuedTick):
+            self.ticks += 1
+        self._push(item)
+        self.high_water = max(self.high_water, self._qsize())
+
+    def _get(self):
+        item = self._pop()
+        if isinstance(item, QueuedTick):
+            self.ticks -= 1
+        return item
+
+    def _push(self, item):
+        self.queue.append(item)
+
+    def _pop(self):
+        return self.queue.popleft()
+
+    def stats(self):
+        with self.mutex:
+            return {'depth': self._qsize(), 'maxsize': self.maxsize, 'high_water': self.high_water,
+                    'coalesced': self.coalesced, 'dropped': self.dropped, 'rejected': self.rejected}
+
+
+class Deduplicator:
+    """Remember recently-accepted event keys, so that redelivered events may be dropped
+
+    The memory is bounded both in size and in time."""
+    def __init__(self, maxsize=10000, ttl=600):
+        self.seen = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        self.accepted = 0
+        self.duplicates = 0
+
+    def claim(self, key):
+        """Return True if this key has not been seen recently, and remember it"""
+        with self.lock:
+            if key in self.seen:
+                self.duplicates += 1
+                return False
+            self.seen[key] = True
+            self.accepted += 1
+            return True
+
+    def release(self, key):
+        """Forget a claimed key, if its event could not be accepted after all"""
+        with self.lock:
+            if self.seen.pop(key, None) is not None:
+                self.accepted -= 1
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.seen), 'accepted': self.accepted, 'duplicates': self.duplicates}
@@ -0,0 +1,154 @@
+import queue
+import pytest
+from .dispatch import QueuingDispatch, QueuedTick
+from .ingress import IngressQueue, Deduplicator, SHED
+from .prefilter import Prefilter, CHATTER, DROP
+from .scheduler import FairScheduler, ADMIN, COMMAND, BACKGROUND
+from .service import Agent, Channel
+
+
+def chatter(m):
+    return m.channel.id == 'CHATTER'
+
+
+def test_ticks_are_coalesced():
+    q = IngressQueue(maxsize=2)
+    dispatcher = QueuingDispatch(queue=q)
+
+    for _ in range(5):
+        dispatcher.tick()
+    dispatcher.raw_message(sender=Agent('ALICE'), receivers=[], channel=Channel(id='C1'), text='vote bob')
+    dispatcher.tick()
+
+    assert q.qsize() == 2
+    assert q.stats()['coalesced'] == 5
+    assert isinstance(q.get(), QueuedTick)
+
+    # Once the pending tick is taken, another may be queued
+    dispatcher.tick()
+    assert q.qsize() == 2
+
+
+def test_full_queue_rejects():
+    q = IngressQueue(maxsize=1)
+    dispatcher = QueuingDispatch(queue=q)
+
+    dispatcher.raw_message(sender=Agent('ALICE'), receivers=[], channel=Channel(id='C1'), text='vote bob')
+    with pytest.raises(queue.Full):
+        q.put(q.queue[0], timeout=0.01)
+    assert q.stats()['rejected'] == 1
+
+    # Ticks still get through
+    dispatcher.tick()
+    assert q.stats()['depth'] == 2
+
+
+def test_full_queue_sheds_chatter():
+    q = IngressQueue(maxsize=1, policy=SHED, shed=chatter)
+    dispatcher = QueuingDispatch(queue=q)
+
+    dispatcher.raw_message(sender=Agent('ALICE'), receivers=[], channel=Channel(id='C1'), text='vote bob')
+    dispatcher.raw_message(sender=Agent('ALICE'), receivers=[], channel=Channel(id='CHATTER'), text='hello')
+    assert q.stats()['dropped'] == 1
+    assert q.stats()['high_water'] == 1
+
+    with pytest.raises(queue.Full):
+        dispatcher.raw_message(sender=Agent('ALICE'), receivers=[], channel=Channel(id='C1'), text='vote bob')
+
+
+class Team:
+    def __init__(self, team):
+        self.team = team
+
+
+def test_teams_take_turns():
+    q = FairScheduler(maxsize=100)
+    dispatcher = QueuingDispatch(queue=q)
+    busy, quiet = Team('BUSY'), Team('QUIET')
+
+    for n in range(6):
+        dispatcher.raw_message(srv=busy, sender=Agent('ALICE'), receivers=[], channel=Channel(id='C1'),
+                               text='vote {}'.format(n))
+    for n in range(2):
+        dispatcher.raw_message(srv=quiet, sender=Agent('BOB'), receivers=[], channel=Channel(id='C2'),
+                               text='vote {}'.format(n))
+    dispatcher.tick()
+
+    order = [q.get() for _ in range(9)]
+    assert isinstance(order[0], QueuedTick)
+    assert [(m.srv.team, m.text) for m in order[1:]] == [
+        ('BUSY', 'vote 0'), ('QUIET', 'vote 0'), ('BUSY', 'vote 1'), ('QUIET', 'vote 1'),
+        ('BUSY', 'vote 2'), ('BUSY', 'vote 3'), ('BUSY', 'vote 4'), ('BUSY', 'vote 5')]
+    assert q.stats()['lanes'][COMMAND]['served'] == {'BUSY': 6, 'QUIET': 2}
+
+
+def test_admin_commands_go_ahead_of_players():
+    q = FairScheduler(maxsize=100)
+    dispatcher = QueuingDispatch(queue=q)
+    team, bot = Team('T'), Agent('B0', is_bot=True)
+
+    for n in range(3):
+        dispatcher.raw_message(srv=team, sender=Agent('ALICE'), receivers=[bot], channel=Channel(id='C1'),
+                               text='vote {}'.format(n))
+    dispatcher.raw_message(srv=team, sender=Agent('ADMIN'), receivers=[bot], channel=Channel(id='C0'),
+                           text='<@B0> advance ww-1')
+
+    assert [q.get().text for _ in range(4)] == ['<@B0> advance ww-1', 'vote 0', 'vote 1', 'vote 2']
+    assert q.stats()['lanes'][ADMIN]['served'] == {'T': 1}
+
+
+def test_background_is_not_starved():
+    q = FairScheduler(maxsize=100, classify=lambda m: BACKGROUND if m.text == 'chatter' else COMMAND,
+                      lane_weights={COMMAND: 3})
+    dispatcher = QueuingDispatch(queue=q)
+    team = Team('T')
+
+    for n in range(8):
+        dispatcher.raw_message(srv=team, sender=Agent('ALICE'), receivers=[], channel=Channel(id='C1'),
+                               text='vote')
+    for n in range(2):
+        dispatcher.raw_message(srv=team, sender=Agent('ALICE'), receivers=[], channel=Channel(id='C1'),
+                               text='chatter')
+
+    assert [q.get().text for _ in range(10)] == ['vote'] * 3 + ['chatter'] + ['vote'] * 3 + ['chatter'] + ['vote'] * 2
+
+
+def test_duplicates_are_dropped():
+    dedup = Deduplicator(maxsize=10, ttl=60)
+
+    assert dedup.claim('Ev1')
+    assert not dedup.claim('Ev1')
+    assert dedup.claim('Ev2')
+
+    # An event which could not be queued may be redelivered
+    dedup.release('Ev2')
+    assert dedup.claim('Ev2')
+
+    assert dedup.stats() == {'size': 2, 'accepted': 2, 'duplicates': 1}
+
+
+def test_duplicates_are_forgotten():
+    dedup = Deduplicator(maxsize=2, ttl=60)
+
+    for key in 'Ev1 Ev2 Ev3'.split():
+        assert dedup.claim(key)
+    assert dedup.claim('Ev1')
+
+
+class Game:
+    def __init__(self, dead=()):
+        self.dead = list(dead)
+
+
+def test_prefilter():
+    bot = Agent('B0', is_bot=True)
+    alice, bob = Agent('ALICE'), Agent('BOB')
+    prefilter = Prefilter(routes={'C1': Game(dead=[bob])})
+    game, lobby = Channel(id='C1'), Channel(id='GENERAL')
+
+    assert prefilter.classify(channel=lobby, sender=alice, receivers=[bot], text='<@B0> start standard') == COMMAND
+    assert prefilter.classify(channel=lobby, sender=alice, receivers=[bot], text='vote bob') == DROP
+    assert prefilter.classify(channel=game, sender=alice, receivers=[bot], text='vote <@BOB>') == COMMAND
+    assert prefilter.classify(channel=game, sender=alice, receivers=[bot], text='remove vote') == COMMAND
+    assert prefilter.classify(channel=game, sender=alice, receivers=[bot], text='I think bob did it') == CHATTER
+    assert prefilter.classify(channel=game, sender=bob, receivers=[bot], text='it was alice!') == COMMAND
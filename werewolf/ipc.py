@@ -0,0 +1,283 @@
+"""Forward incoming events from any number of HTTP worker processes to one game-owner process
+
+The owner listens on a unix socket. Each request is a single line of JSON and receives a
+single line of JSON in reply:
+
+    ["put", record, id] -> true, or false if the owner's queue is full
+    ["claim", key]      -> true if the event key has not been seen recently
+    ["release", key]    -> null
+    ["routes"]          -> {channel id: [ids of dead players]}
+    ["route", id]       -> [ids of dead players], or null if no game uses the channel
+    ["stats"]           -> the owner's statistics
+
+Records are encoded as
+
+    ["m", team, sender, receivers, channel, text, message_id]
+    ["o", team, code, state]
+
+with agents and channels encoded by werewolf.wire. A request whose connection fails is
+made again; each put carries an id of its own, by which the owner drops a put that it
+has already accepted.
+"""
+
+from collections import namedtuple
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from uuid import uuid4
+
+from .dispatch import QueuingDispatch, QueuedOnMessage, QueuedOauthCallback
+from .ingress import Deduplicator
+from .wire import encode_agent, decode_agent, encode_channel, decode_channel
+
+LOG = logging.getLogger(__name__)
+
+Route = namedtuple('Route', ('dead',))
+
+
+def encode_record(m):
+    if isinstance(m, QueuedOnMessage):
+        return ['m', m.srv.team, encode_agent(m.sender), [encode_agent(r) for r in m.receivers or ()],
+                encode_channel(m.channel), m.text, m.message_id]
+    elif isinstance(m, QueuedOauthCallback):
+        return ['o', m.srv.team, m.code, m.state]
+    raise ValueError('Cannot forward {}'.format(type(m).__name__))
+
+
+def decode_record(value, srv_lookup=None):
+    op, team = value[:2]
+    srv = srv_lookup(team)
+    if srv is None:
+        return None
+    if op == 'm':
+        sender, receivers, channel, text, message_id = value[2:]
+        return QueuedOnMessage(srv, decode_agent(sender), [decode_agent(r) for r in receivers or ()],
+                               decode_channel(channel), text, message_id)
+    elif op == 'o':
+        code, state = value[2:]
+        return QueuedOauthCallback(srv, code, state)
+    raise ValueError('Unknown record {}'.format(op))
+
+
+class IPCClient:
+    """The ingress end of the connection; each thread has its own socket"""
+    def __init__(self, path=None, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.local.sock = sock
+        self.local.reader = sock.makefile('rb')
+        return sock
+
+    def call(self, *request):
+        line = json.dumps(request).encode('utf-8') + b'\n'
+        for attempt in range(2):
+            sock = getattr(self.local, 'sock', None)
+            try:
+                if sock is None:
+                    sock = self._connect()
+                sock.sendall(line)
+                reply = self.local.reader.readline()
+                if not reply:
+                    raise ConnectionError('Owner closed the connection')
+                return json.loads(reply)
+            except OSError:
+                self.close()
+                if attempt > 0:
+                    raise
+
+    def close(self):
+        sock = getattr(self.local, 'sock', None)
+        if sock is not None:
+            sock.close()
+        self.local.sock = None
+
+
+class ForwardingDispatch(QueuingDispatch):
+    """Enqueue events in the owner process rather than locally"""
+    def __init__(self, client=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.client = client
+
+    def put(self, item):
+        try:
+            accepted = self.client.call('put', encode_record(item), uuid4().hex)
+        except OSError:
+            LOG.exception('Problem forwarding event to the owner')
+            accepted = False
+        if not accepted:
+            raise queue.Full()
+
+
+class RemoteDeduplicator:
+    """Claim event keys in the owner, so that all ingress processes share one memory"""
+    def __init__(self, client=None):
+        self.client = client
+
+    def claim(self, key):
+        try:
+            return self.client.call('claim', key)
+        except OSError:
+            # The event will not be accepted anyway
+            return True
+
+    def release(self, key):
+        try:
+            self.client.call('release', key)
+        except OSError:
+            pass
+
+    def stats(self):
+        return {}
+
+
+class RemoteRoutes:
+    """A periodically-refreshed copy of the owner's routing table, for the ingress Prefilter
+
+    A channel missing from the copy is looked up in the owner, so that the channels of a
+    game that has just started are not taken for chatter. Channels that no game uses are
+    remembered as such until the next refresh, so that chatter costs no more than that."""
+    def __init__(self, client=None, ttl=2):
+        self.client = client
+        self.ttl = ttl
+        self.routes = {}
+        self.misses = set()     # Channel ids that no game used when last looked up
+        self.fetched = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def route(dead):
+        return Route(dead=[decode_agent([pid]) for pid in dead])
+
+    def refresh(self):
+        """Fetch the routing table again, if it is due; only one thread does so at a time"""
+        with self.lock:
+            if self.refreshing or (self.fetched is not None and time.time() - self.fetched <= self.ttl):
+                return
+            self.refreshing = True
+        try:
+            routes = self.client.call('routes')
+            routes = {cid: self.route(dead) for cid, dead in routes.items()}
+            with self.lock:
+                self.routes = routes
+                self.misses = set()
+                self.fetched = time.time()
+        except OSError:
+            LOG.exception('Problem fetching routes from the owner')
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def get(self, channel_id, default=None):
+        self.refresh()
+        channel_id = str(channel_id)
+        with self.lock:
+            route = self.routes.get(channel_id)
+            if route is not None:
+                return route
+            if channel_id in self.misses:
+                return default
+        try:
+            dead = self.client.call('route', channel_id)
+        except OSError:
+            LOG.exception('Problem fetching a route from the owner')
+            return default
+        with self.lock:
+            if dead is None:
+                self.misses.add(channel_id)
+                return default
+            route = self.routes[channel_id] = self.route(dead)
+        return route
+
+
+class IPCListener(threading.Thread):
+    """The owner end of the connection
+
+    The listening socket may be passed in as `sock` (eg, by a process that we replace)."""
+    def __init__(self, path=None, dispatcher=None, dedup=None, routes=None, stats=None, srv_lookup=None, sock=None,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self.dispatcher = dispatcher
+        self.dedup = dedup
+        self.routes = routes
+        self.stats = stats
+        self.srv_lookup = srv_lookup
+        self.puts = Deduplicator(ttl=60)   # Ids of puts accepted, should a client make one again
+        self.stopping = False
+        if sock is not None:
+            self.server = sock
+            return
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(64)
+
+    def run(self):
+        while True:
+            conn, _ = self.server.accept()
+            if self.stopping:
+                conn.close()
+                return
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def stop(self):
+        """Stop taking requests, leaving the listening socket open for whoever takes it over
+
+        Requests on connections already open are refused by closing the connection, which
+        the client will then make afresh."""
+        self.stopping = True
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as wake:
+            wake.connect(self.path)
+        self.join()
+
+    def serve(self, conn):
+        with conn, conn.makefile('rb') as reader:
+            for line in reader:
+                if self.stopping:
+                    return
+                try:
+                    reply = self.handle(*json.loads(line))
+                except Exception:
+                    LOG.exception('Problem handling IPC request %r', line)
+                    reply = None
+                conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
+
+    def handle(self, op, *args):
+        if op == 'put':
+            if len(args) > 1 and not self.puts.claim(args[1]):
+                return True
+            record = decode_record(args[0], srv_lookup=self.srv_lookup)
+            if record is None:
+                return True
+            try:
+                self.dispatcher.put(record)
+            except queue.Full:
+                if len(args) > 1:
+                    self.puts.release(args[1])
+                return False
+            return True
+        elif op == 'claim':
+            return self.dedup.claim(args[0])
+        elif op == 'release':
+            self.dedup.release(args[0])
+        elif op == 'routes':
+            return {str(cid): [p.id for p in getattr(target, 'dead', ())] for cid, target in list(self.routes.items())}
+        elif op == 'route':
+            target = self.routes.get(args[0])
+            return None if target is None else [p.id for p in getattr(target, 'dead', ())]
+        elif op == 'stats':
+            return self.stats() if self.stats is not None else {}
+        else:
+            raise ValueError('Unknown IPC request {}'.format(op))
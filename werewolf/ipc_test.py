@@ -0,0 +1,92 @@
+import os
+import queue
+
+import pytest
+
+from .dispatch import QueuingDispatch, QueuedOnMessage
+from .ingress import IngressQueue, Deduplicator
+from .ipc import IPCClient, IPCListener, ForwardingDispatch, RemoteDeduplicator, RemoteRoutes
+from .prefilter import Prefilter, COMMAND
+from .service import Agent, Channel
+
+
+class Srv:
+    def __init__(self, team):
+        self.team = team
+
+
+class Game:
+    dead = [Agent(id='U2')]
+
+
+@pytest.fixture
+def owner(tmpdir):
+    q = IngressQueue(maxsize=1)
+    services = {'T1': Srv('T1')}
+    listener = IPCListener(path=os.path.join(str(tmpdir), 'sock'), dispatcher=QueuingDispatch(queue=q),
+                           dedup=Deduplicator(), routes={'C1': Game()}, stats=q.stats,
+                           srv_lookup=services.get, daemon=True)
+    listener.start()
+    return q, services, IPCClient(path=listener.path)
+
+
+def test_events_are_forwarded(owner):
+    q, services, client = owner
+    d = ForwardingDispatch(client=client)
+    d.raw_message(srv=Srv('T1'), sender=Agent(id='U1'), receivers=[Agent(id='B1', is_bot=True)],
+                  channel=Channel(id='C1', is_private=True), text='vote <@U3>', message_id='1.2')
+    m = q.get_nowait()
+    assert isinstance(m, QueuedOnMessage)
+    assert m.srv is services['T1']
+    assert m.sender == Agent(id='U1')
+    assert m.receivers == [Agent(id='B1', is_bot=True)]
+    assert m.channel == Channel(id='C1', is_private=True)
+    assert (m.text, m.message_id) == ('vote <@U3>', '1.2')
+
+    # The owner's queue holds one event; a second is refused
+    d.raw_message(srv=Srv('T1'), sender=Agent(id='U1'), channel=Channel(id='C1'), text='a')
+    with pytest.raises(queue.Full):
+        d.raw_message(srv=Srv('T1'), sender=Agent(id='U1'), channel=Channel(id='C1'), text='b')
+    assert client.call('stats')['rejected'] == 1
+
+
+def test_dedup_and_routes_are_shared(owner):
+    q, services, client = owner
+    dedup = RemoteDeduplicator(client=client)
+    other = RemoteDeduplicator(client=IPCClient(path=client.path))
+    assert dedup.claim('E1')
+    assert not other.claim('E1')
+    other.release('E1')
+    assert dedup.claim('E1')
+
+    p = Prefilter(routes=RemoteRoutes(client=client))
+    assert p.classify(channel=Channel(id='C1'), sender=Agent(id='U2'), text='hello') == COMMAND
+    assert p.classify(channel=Channel(id='C9'), sender=Agent(id='U2'), text='hello') == 'drop'
+
+
+def test_new_routes_are_seen_at_once_and_puts_are_not_doubled(tmpdir):
+    q = IngressQueue(maxsize=10)
+    routes = {}
+    listener = IPCListener(path=os.path.join(str(tmpdir), 'sock'), dispatcher=QueuingDispatch(queue=q),
+                           dedup=Deduplicator(), routes=routes, srv_lookup={'T1': Srv('T1')}.get, daemon=True)
+    listener.start()
+    client = IPCClient(path=listener.path)
+
+    p = Prefilter(routes=RemoteRoutes(client=client, ttl=3600))
+    assert p.classify(channel=Channel(id='C9'), sender=Agent(id='U1'), text='vote bob') == 'drop'
+    # A game starts, well within the copy's ttl
+    routes['C2'] = Game()
+    assert p.classify(channel=Channel(id='C2'), sender=Agent(id='U1'), text='vote bob') == COMMAND
+
+    # Chatter in a channel that no game uses is not looked up again before the next refresh
+    calls = []
+    call = client.call
+    client.call = lambda *args: calls.append(args) or call(*args)
+    assert p.classify(channel=Channel(id='C9'), sender=Agent(id='U1'), text='vote bob') == 'drop'
+    assert calls == []
+
+    # A put made again, as after its connection failed, is only queued once
+    record = ['m', 'T1', ['U1'], [], ['C2'], 'vote bob', '1.2']
+    assert client.call('put', record, 'P1')
+    assert client.call('put', record, 'P1')
+    assert q.stats()['depth'] == 1
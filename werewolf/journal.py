@@ -0,0 +1,145 @@
+"""An append-only journal of the events that change a game
+
+With JOURNAL set, a game records the order in which its roles were dealt, each command
+it accepts, each tick that ends a phase and each new notice it posts. Those records are small appends; the
+whole game is only written out (as a snapshot) once every SNAPSHOT_EVERY events, after
+which its journal is discarded. When a game is loaded, any journal entries newer than
+the snapshot are replayed against it, with the clock held at the moment each event
+first happened and a service that discards everything the game says. The notices that
+the game posted are restored, so that it goes on updating them rather than posting more."""
+
+import logging
+import os
+import threading
+
+from . import clock
+from .persist import append, entries, truncate
+from .service import Channel, Notice
+from .service.base import BaseService
+from .wire import encode_agent, decode_agent, encode_channel, decode_channel, encode_text, decode_text
+
+LOG = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('JOURNAL', '') not in ('', '0')
+SNAPSHOT_EVERY = int(os.environ.get('SNAPSHOT_EVERY', 100))
+
+DEAL = 'deal'
+MESSAGE = 'message'
+TICK = 'tick'
+NOTICE = 'notice'
+
+_replay = threading.local()
+
+
+class ReplayService(BaseService):
+    """Stand in for the real service while a game's history is re-run"""
+    def __init__(self, team=None):
+        self.team = team
+
+    def broadcast(self, channel=None, text=None):
+        return None
+
+    def new_channel(self, name=None, private=False, invite=None):
+        return Channel(name=name, is_private=private)
+
+    def delete_channel(self, channel=None):
+        pass
+
+    def invite_to_channel(self, channel=None, invite=None):
+        pass
+
+    def lookup_channel(self, channel=None):
+        return channel
+
+    def lookup_user(self, agent=None):
+        return agent
+
+    def post_notice(self, channel=None, notice=None, text=None):
+        return notice
+
+    def delete_message(self, channel=None, message_id=None):
+        pass
+
+    def whisper(self, channel=None, agent=None, text=None):
+        pass
+
+
+def replaying():
+    return getattr(_replay, 'active', False)
+
+
+def record(game, kind, *args, at=None):
+    """Journal an event, which happened at the given time (or now)"""
+    if not ENABLED or replaying():
+        return
+    game.journal_seq = getattr(game, 'journal_seq', 0) + 1
+    append(game.index, (game.journal_seq, kind, clock.now() if at is None else at, args))
+
+
+def deal(game, players):
+    record(game, DEAL, [encode_agent(p) for p in players])
+
+
+def message(game, sender=None, receivers=None, channel=None, text=None, at=None):
+    record(game, MESSAGE, encode_agent(sender), [encode_agent(r) for r in receivers or ()],
+           encode_channel(channel), encode_text(text), getattr(text, 'message_id', None), at=at)
+
+
+def tick(game, phase_shift=None, at=None):
+    record(game, TICK, phase_shift, at=at)
+
+
+def notice(game):
+    """Record the notice that a game posted, after the event that led it to do so"""
+    record(game, NOTICE, None if game.notice is None else [encode_channel(game.notice.channel), game.notice.id])
+
+
+def snapshot_due(game):
+    """Should the whole game be written out now?"""
+    if not ENABLED or getattr(game, 'snapshot_seq', None) is None:
+        return True
+    return game.journal_seq - game.snapshot_seq >= SNAPSHOT_EVERY
+
+
+def discard(game):
+    truncate(game.index)
+
+
+def recover(game):
+    """Bring a freshly-loaded game up to date with its journal"""
+    if not hasattr(game, 'journal_seq'):
+        game.journal_seq = 0
+    replayed = 0
+    srv = ReplayService(team=game.team)
+    _replay.active = True
+    try:
+        for seq, kind, at, args in entries(game.index):
+            if seq <= game.journal_seq:
+                continue
+            with clock.frozen(at):
+                apply(game, kind, args, srv=srv)
+            game.journal_seq = seq
+            replayed += 1
+    finally:
+        _replay.active = False
+    if replayed > 0:
+        LOG.info('Replayed %d events for game %s', replayed, game.index)
+        game.dirty = True
+    return game
+
+
+def apply(game, kind, args, srv=None):
+    if kind == MESSAGE:
+        sender, receivers, channel, text, message_id = args
+        game.on_message(srv=srv, sender=decode_agent(sender), receivers=[decode_agent(r) for r in receivers],
+                        channel=decode_channel(channel), text=decode_text(text, message_id))
+    elif kind == TICK:
+        game.phase_shift, = args
+        game.check_phase(srv=srv)
+    elif kind == NOTICE:
+        notice, = args
+        game.notice = None if notice is None else Notice(decode_channel(notice[0]), notice[1])
+    elif kind == DEAL:
+        pass    # The deal is already part of the first snapshot
+    else:
+        LOG.warning('Unknown journal entry %s for game %s', kind, game.index)
@@ -0,0 +1,129 @@
+"""Make sure that only one process at a time works on DATA_DIR
+
+The process that works on the games - the leader - holds an exclusive flock on
+DATA_DIR/leader.lock for as long as it runs. Another process started on the same
+DATA_DIR refuses to start, unless STANDBY is set.
+
+A standby waits for the lock while keeping a copy of everything persisted in memory.
+It refreshes the copy every STANDBY_INTERVAL seconds, reading only what has changed.
+The kernel releases the lock the moment the leader exits, however it exits. The
+standby then reads the leader's last few writes and starts from its copy, without
+reading everything from disk again. The leader no longer runs by then, so no event is
+handled by both. As after any crash, events that the leader had not finished are
+replayed from the inbound journal.
+
+Run a standby as `slackbot` or `werewolf-owner`: it waits as the app is imported, which
+a gunicorn worker is not given time to do."""
+
+from contextlib import ExitStack
+import logging
+import os
+import os.path
+import threading
+import weakref
+
+from flock import Flock, LOCK_EX, LOCK_NB
+
+from . import persist
+
+LOG = logging.getLogger(__name__)
+
+STANDBY = os.environ.get('STANDBY', '') not in ('', '0')
+STANDBY_INTERVAL = float(os.environ.get('STANDBY_INTERVAL', 1))
+LOCK = 'leader' + persist.LOCK
+
+
+class Leadership:
+    """The lock on a data directory; `fd` may be an open lock file that is already held"""
+    def __init__(self, data_dir=None, fd=None):
+        self.path = os.path.join(data_dir or persist._data_dir(), LOCK)
+        self.file = open(self.path, 'a') if fd is None else os.fdopen(fd, 'a')
+        self.locks = ExitStack()
+        self.held = fd is not None
+        # The lock belongs to the open file, which a forked child (a shard, or a background
+        # save) shares; it must not keep the lock alive should we die
+        ref = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: ref() is not None and ref().forget())
+
+    def forget(self):
+        """In a forked child, let go of the lock file without unlocking it for the parent"""
+        self.locks.pop_all()
+        self.file.close()
+        self.held = False
+
+    def acquire(self, block=True):
+        """Returns True if we now hold the lock"""
+        try:
+            self.locks.enter_context(Flock(self.file, LOCK_EX if block else LOCK_EX | LOCK_NB))
+        except BlockingIOError:
+            return False
+        self.held = True
+        return True
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def release(self):
+        self.locks.close()
+        self.held = False
+
+
+class Follower(threading.Thread):
+    """Keep a copy of everything persisted in a data directory, as it changes"""
+    def __init__(self, data_dir=None, interval=STANDBY_INTERVAL, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.data_dir = data_dir or persist._data_dir()
+        self.interval = interval
+        self.copies = {}    # key: data
+        self.versions = {}  # key: version
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Bring the copy up to date; returns the number of keys read"""
+        with self.lock:
+            store = persist.backend(self.data_dir)
+            versions = store.versions()
+            for key in set(self.copies) - set(versions):
+                del self.copies[key]
+            read = 0
+            for key, version in versions.items():
+                if self.versions.get(key) != version:
+                    data = store.get(key)
+                    if data is not None:
+                        self.copies[key] = data
+                        read += 1
+            self.versions = versions
+            return read
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.refresh()
+            except Exception:
+                LOG.exception('Problem following %s', self.data_dir)
+
+    def stop(self):
+        """Stop following; returns a copy that is up to date"""
+        self.stopping.set()
+        self.refresh()
+        return self.copies
+
+
+def lead(data_dir=None, fd=None, standby=None):
+    """Take the lock on the data directory, standing by for it if we must"""
+    standby = STANDBY if standby is None else standby
+    leadership = Leadership(data_dir=data_dir, fd=fd)
+    if leadership.held or leadership.acquire(block=False):
+        return leadership
+    if not standby:
+        raise RuntimeError('Another process is working on {}; set STANDBY to wait for it'.format(
+            os.path.dirname(leadership.path)))
+    follower = Follower(data_dir=data_dir, name='standby', daemon=True)
+    LOG.info('Standing by, with %d keys read', follower.refresh())
+    follower.start()
+    leadership.acquire()
+    copies = follower.stop()
+    persist.warm(copies, data_dir=data_dir)
+    LOG.info('Taking over, with %d keys already read', len(copies))
+    return leadership
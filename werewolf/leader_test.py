@@ -0,0 +1,80 @@
+import os
+import threading
+
+import pytest
+
+from . import persist
+from .leader import Follower, Leadership, lead
+from .persist_test import Value, data_dir  # noqa: F401
+
+
+def test_only_one_leader(data_dir):
+    first = lead(data_dir=data_dir)
+    with pytest.raises(RuntimeError):
+        lead(data_dir=data_dir, standby=False)
+    first.release()
+    lead(data_dir=data_dir, standby=False).release()
+
+
+def test_follower_reads_only_changes(data_dir):
+    persist.save(1, Value({'game': 1}), data_dir=data_dir)
+    persist.save(2, Value({'game': 2}), data_dir=data_dir)
+    follower = Follower(data_dir=data_dir)
+    assert follower.refresh() == 2
+    assert follower.refresh() == 0
+    persist.save(2, Value({'game': 'two'}), data_dir=data_dir)
+    persist.drop(1, data_dir=data_dir)
+    assert follower.refresh() == 1
+    assert sorted(follower.copies) == ['2']
+
+
+def test_standby_takes_over_with_what_it_has_read(data_dir):
+    leader = lead(data_dir=data_dir)
+    persist.save(1, Value({'game': 1}), data_dir=data_dir)
+    standby = []
+    t = threading.Thread(target=lambda: standby.append(lead(data_dir=data_dir, standby=True)), daemon=True)
+    t.start()
+    t.join(timeout=0.2)
+    assert standby == []
+
+    # The leader's last write is picked up as it goes
+    persist.save(1, Value({'game': 'last'}), data_dir=data_dir)
+    leader.release()
+    t.join(timeout=5)
+    assert standby[0].held
+    assert persist._warm[data_dir, '1'] is not None
+    assert persist.load(1, factory=dict, data_dir=data_dir) == {'game': 'last'}
+    assert (data_dir, '1') not in persist._warm
+    standby[0].release()
+
+
+def test_a_held_lock_can_be_passed_on(data_dir):
+    leader = lead(data_dir=data_dir)
+    successor = Leadership(data_dir=data_dir, fd=leader.fileno())
+    assert successor.held
+    with pytest.raises(RuntimeError):
+        lead(data_dir=data_dir, standby=False)
+
+
+def test_forked_children_do_not_keep_the_lock(data_dir):
+    leader = lead(data_dir=data_dir)
+    r, w = os.pipe()
+    ready_r, ready_w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Stand in for a shard process, outliving its parent
+        os.close(w)
+        os.write(ready_w, b'.')
+        os.read(r, 1)
+        os._exit(0)
+    os.close(r)
+    os.read(ready_r, 1)
+    try:
+        # The leader dies without unlocking; the child lives on
+        leader.file.close()
+        lead(data_dir=data_dir, standby=False).release()
+    finally:
+        os.close(w)
+        os.waitpid(pid, 0)
+        os.close(ready_r)
+        os.close(ready_w)
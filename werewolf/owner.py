@@ -0,0 +1,44 @@
+"""The game-owner process, for when the HTTP ingress is run with several workers
+
+Run this with INGRESS_LISTEN naming a unix socket, and run the HTTP workers
+(eg, `gunicorn --workers 8 werewolf.app:app`) with INGRESS_FORWARD naming the same socket.
+The owner holds the queue and every game; the workers validate and decode events, then
+pass them on."""
+
+import logging
+import os
+import socket
+
+from . import handoff
+from .ipc import IPCListener
+
+LOG = logging.getLogger(__name__)
+
+
+def main():
+    if os.environ.get('INGRESS_FORWARD'):
+        raise RuntimeError('The owner process must not itself forward events')
+    from . import app
+    from .service.slack import get_service
+
+    handoff.on_terminate()
+    sock = socket.socket(fileno=app.INHERITED[0]) if app.INHERITED else None
+    listener = IPCListener(path=os.environ.get('INGRESS_LISTEN', '/tmp/werewolf.sock'),
+                           dispatcher=app.DISPATCHER, dedup=app.DEDUP, routes=app.RUNNER.route_ids,
+                           stats=app.owner_stats, srv_lookup=get_service, sock=sock, daemon=True)
+    listener.start()
+    LOG.info('Accepting events on %s', listener.path)
+    successor = None
+    if handoff.HANDOFF_SOCKET:
+        def stop():
+            listener.stop()
+            app.shutdown()
+        successor = handoff.HandoffListener(path=handoff.HANDOFF_SOCKET, stop=stop,
+                                            fds=lambda: [listener.server.fileno(), app.LEADERSHIP.fileno()],
+                                            daemon=True)
+        successor.start()
+    app.activate_timer()
+    listener.join()
+    if successor is not None:
+        # The listener stopped for a handover, which exits once it is done
+        successor.join()
@@ -1,12 +1,39 @@
+"""Keep objects between runs
+
+Each object is pickled and stored under a key in a backend; alongside each key, a
+backend also keeps a journal, to which records may be appended. The backend is chosen by
+PERSIST_BACKEND: 'file' (the default) keeps one file per key in DATA_DIR; 'sqlite' keeps
+one row per key in a single database in DATA_DIR, in write-ahead-logging mode.
+
+With BGSAVE set, whole objects written out in the background (see Snapshots) are
+serialised and saved by a forked child process, from its copy-on-write image of the
+parent, while the parent carries on.
+
+To move an existing data directory from one backend to the other, run
+
+    python -m werewolf.persist migrate file sqlite
+"""
+
+from contextlib import contextmanager
 import logging
 import os
 import os.path
 import pickle
+import sqlite3
+import struct
+import sys
 import tempfile
+import threading
+import time
 
 LOG = logging.getLogger(__name__)
 
 DATA_DIR = None
+BACKEND = None
+DATABASE = 'werewolf.db'
+JOURNAL = '.journal'
+LOCK = '.lock'
+RECORD = struct.Struct('>I')    # The length of each journal record
 
 
 def _data_dir():
@@ -15,42 +42,376 @@ def _data_dir():
     return DATA_DIR
 
 
-def save(key, obj):
-    dir = _data_dir()
+class FileBackend:
+    """One file per key; each is replaced by renaming a new version over it"""
+    def __init__(self, data_dir=None):
+        self.data_dir = data_dir
+
+    def get(self, key):
+        try:
+            with open(os.path.join(self.data_dir, key), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def put(self, key, data):
+        file = os.path.join(self.data_dir, key)
+        temp = os.path.join(self.data_dir, key + "~")
+        try:
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.rename(temp, file)
+        except Exception:
+            try:
+                os.unlink(temp)
+            except IOError:
+                LOG.exception("Problem unlinking temporary file {}".format(temp))
+            raise
+
+    def delete(self, key):
+        os.unlink(os.path.join(self.data_dir, key))
+
+    def keys(self):
+        return [entry.name for entry in os.scandir(self.data_dir) if self.is_key(entry)]
+
+    @staticmethod
+    def is_key(entry):
+        return (not entry.name.endswith(('~', JOURNAL, LOCK)) and not entry.name.startswith(DATABASE) and
+                entry.is_file())
+
+    def versions(self):
+        """Something for each key that changes whenever it is written"""
+        versions = {}
+        for entry in os.scandir(self.data_dir):
+            if self.is_key(entry):
+                stat = entry.stat()
+                versions[entry.name] = stat.st_mtime_ns, stat.st_size, stat.st_ino
+        return versions
+
+    def append(self, key, data):
+        with open(os.path.join(self.data_dir, key + JOURNAL), 'ab') as f:
+            f.write(RECORD.pack(len(data)) + data)
+
+    def entries(self, key):
+        try:
+            with open(os.path.join(self.data_dir, key + JOURNAL), 'rb') as f:
+                journal = f.read()
+        except IOError:
+            return []
+        entries = []
+        offset = 0
+        while offset + RECORD.size <= len(journal):
+            size, = RECORD.unpack_from(journal, offset)
+            if offset + RECORD.size + size > len(journal):
+                LOG.warning('Ignoring a partial record at the end of the journal for %s', key)
+                break
+            entries.append(journal[offset + RECORD.size:offset + RECORD.size + size])
+            offset += RECORD.size + size
+        return entries
+
+    def truncate(self, key):
+        try:
+            os.unlink(os.path.join(self.data_dir, key + JOURNAL))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def batch(self):
+        yield self
+
+
+class SqliteBackend:
+    """One row per key in a SQLite database; a batch of changes is made in one transaction"""
+    def __init__(self, data_dir=None, synchronous=None):
+        self.data_dir = data_dir
+        self.db = sqlite3.connect(os.path.join(data_dir, DATABASE), timeout=30,
+                                  isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous={}'.format(synchronous or os.environ.get('PERSIST_SYNCHRONOUS', 'NORMAL')))
+        self.db.execute('CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS journal '
+                        '(seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL, value BLOB NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS journal_key ON journal (key, seq)')
+        self.lock = threading.RLock()
+        self.depth = 0
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute('SELECT value FROM store WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, key, data):
+        with self.batch():
+            self.db.execute('INSERT OR REPLACE INTO store (key, value) VALUES (?, ?)', (key, data))
+
+    def delete(self, key):
+        with self.batch():
+            if self.db.execute('DELETE FROM store WHERE key = ?', (key,)).rowcount == 0:
+                raise KeyError(key)
+
+    def keys(self):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT key FROM store')]
+
+    def versions(self):
+        # Replacing a row gives it a new rowid
+        with self.lock:
+            return dict(self.db.execute('SELECT key, rowid FROM store'))
+
+    def append(self, key, data):
+        with self.batch():
+            self.db.execute('INSERT INTO journal (key, value) VALUES (?, ?)', (key, data))
+
+    def entries(self, key):
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT value FROM journal WHERE key = ? ORDER BY seq', (key,))]
+
+    def truncate(self, key):
+        with self.batch():
+            self.db.execute('DELETE FROM journal WHERE key = ?', (key,))
+
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            if self.depth == 0:
+                self.db.execute('BEGIN IMMEDIATE')
+            self.depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.db.execute('ROLLBACK')
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                self.db.execute('COMMIT')
+
+
+BACKENDS = {'file': FileBackend, 'sqlite': SqliteBackend}
+_backends = {}  # (pid, kind, data_dir): backend
+_backends_lock = threading.Lock()
+_background = threading.local()
+_warm = {}  # (data_dir, key): data, already read by a standby (see werewolf.leader)
+_in_flight = set()  # (data_dir, key): being saved by a child
+_in_flight_done = threading.Condition()
+
+
+def _after_fork():
+    # Another thread may have held these as we forked
+    global _backends_lock, _in_flight_done
+    _backends_lock = threading.Lock()
+    _in_flight_done = threading.Condition()
+
+
+def _settle(key, data_dir=None):
+    """Wait for any child still saving a key; writes to any one key are made in order"""
+    with _in_flight_done:
+        while (data_dir or _data_dir(), key) in _in_flight:
+            _in_flight_done.wait()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def backend(data_dir=None, kind=None):
+    """The backend for a data directory; connections are not shared with forked children"""
+    data_dir = data_dir or _data_dir()
+    kind = kind or BACKEND or os.environ.get('PERSIST_BACKEND', 'file')
+    key = os.getpid(), kind, data_dir
+    with _backends_lock:
+        if key not in _backends:
+            _backends[key] = BACKENDS[kind](data_dir=data_dir)
+        return _backends[key]
+
+
+def batch(data_dir=None):
+    """Group several saves and drops; with the sqlite backend, they are made in one transaction"""
+    return backend(data_dir).batch()
+
+
+def save(key, obj, data_dir=None):
+    """Returns True if the object was saved (or, in the background, is being saved)"""
     key = str(key)
-    file = os.path.join(dir, key)
-    temp = os.path.join(dir, key + "~")
+    _warm.pop((data_dir or _data_dir(), key), None)
+    snapshots = getattr(_background, 'snapshots', None)
+    if snapshots is not None:
+        return snapshots.fork(key, obj, data_dir=data_dir)
+    _settle(key, data_dir)
     store = obj.save()
 
     try:
-        with open(temp, 'wb') as f:
-            pickle.dump(store, f)
-        os.rename(temp, file)
+        backend(data_dir).put(key, pickle.dumps(store))
+        return True
     except Exception:
         LOG.exception("Problem saving {}".format(key))
+        return False
+
+
+class Snapshots:
+    """Save objects from forked children
+
+    Within `background()`, save() forks a child that serialises the object and writes it
+    out, then exits; the parent carries straight on. A thread waits for each child, and
+    reports how long it took and how much it wrote. Should a child fail, the `on_failure`
+    given for its save is called (in the parent), so that the save may be retried; once
+    it succeeds, `on_success` is. If nothing was forked, everything was saved inline and
+    `on_success` is called as the block ends.
+
+    A save or drop of a key waits for any child still saving it, so a slow child can
+    never overwrite a newer version."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.saved = 0
+        self.failed = 0
+        self.last = None    # {'key', 'duration', 'size'}
+
+    @contextmanager
+    def background(self, on_failure=None, on_success=None):
+        _background.snapshots, _background.on_failure, _background.on_success = self, on_failure, on_success
+        _background.forked = False
         try:
-            os.unlink(temp)
-        except IOError:
-            LOG.exception("Problem unlinking temporary file {}".format(temp))
+            yield self
+        finally:
+            forked = _background.forked
+            _background.snapshots = _background.on_failure = _background.on_success = None
+        if not forked and on_success is not None:
+            on_success()
+
+    def fork(self, key, obj, data_dir=None):
+        data_dir = data_dir or _data_dir()
+        on_failure, on_success = _background.on_failure, _background.on_success
+        _background.forked = True
+        with _in_flight_done:
+            while (data_dir, key) in _in_flight:
+                _in_flight_done.wait()
+            _in_flight.add((data_dir, key))
+        with self.lock:
+            self.running += 1
+        start = time.time()
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            _background.snapshots = None
+            status = 1
+            try:
+                os.close(r)
+                data = pickle.dumps(obj.save())
+                backend(data_dir).put(key, data)
+                os.write(w, str(len(data)).encode('ascii'))
+                status = 0
+            except BaseException:
+                LOG.exception('Problem saving %s in the background', key)
+            finally:
+                os._exit(status)
+        os.close(w)
+        threading.Thread(target=self.reap, args=(pid, r, key, data_dir, start, on_failure, on_success),
+                         name='snapshot-{}'.format(key), daemon=True).start()
+        return True
+
+    def reap(self, pid, r, key, data_dir, start, on_failure, on_success):
+        with os.fdopen(r, 'rb') as f:
+            size = f.read()
+        _, status = os.waitpid(pid, 0)
+        duration = time.time() - start
+        with self.lock:
+            self.running -= 1
+            if status == 0 and size:
+                self.saved += 1
+                self.last = {'key': key, 'duration': duration, 'size': int(size)}
+            else:
+                self.failed += 1
+        with _in_flight_done:
+            _in_flight.discard((data_dir, key))
+            _in_flight_done.notify_all()
+        if status == 0 and size:
+            LOG.info('Saved %s in the background: %d bytes in %.3fs', key, int(size), duration)
+            if on_success is not None:
+                on_success()
+            return
+        LOG.error('Background save of %s failed (status %d)', key, status)
+        if on_failure is not None:
+            on_failure()
+
+    def wait(self):
+        """Wait for every child to finish"""
+        with _in_flight_done:
+            while _in_flight:
+                _in_flight_done.wait()
 
+    def stats(self):
+        with self.lock:
+            return {'running': self.running, 'saved': self.saved, 'failed': self.failed, 'last': self.last}
 
-def load(key, default=None, factory=None):
-    dir = _data_dir()
+
+def warm(copies, data_dir=None):
+    """Have the next load of each key use a copy of its data that is known to be current"""
+    data_dir = data_dir or _data_dir()
+    _warm.update(((data_dir, key), data) for key, data in copies.items())
+
+
+def load(key, default=None, factory=None, data_dir=None):
     key = str(key)
-    file = os.path.join(dir, key)
-    try:
-        with open(file, 'rb') as f:
-            store = pickle.load(f)
-        return factory(store)
-    except IOError:
+    data = _warm.pop((data_dir or _data_dir(), key), None)
+    if data is None:
+        data = backend(data_dir).get(key)
+    if data is None:
         return default()
+    return factory(pickle.loads(data))
 
 
-def drop(key):
-    dir = _data_dir()
+def drop(key, data_dir=None):
     key = str(key)
-    file = os.path.join(dir, key)
+    _settle(key, data_dir)
+    _warm.pop((data_dir or _data_dir(), key), None)
     try:
-        os.unlink(file)
-    except IOError:
-        LOG.exception("Problem unlinking persisted file {}".format(file))
+        backend(data_dir).delete(key)
+    except (IOError, KeyError):
+        LOG.exception("Problem dropping persisted {}".format(key))
+
+
+def keys(data_dir=None):
+    return backend(data_dir).keys()
+
+
+def append(key, record, data_dir=None):
+    """Add a record to the journal for a key"""
+    backend(data_dir).append(str(key), pickle.dumps(record))
+
+
+def entries(key, data_dir=None):
+    """Every record in the journal for a key, oldest first"""
+    return [pickle.loads(data) for data in backend(data_dir).entries(str(key))]
+
+
+def truncate(key, data_dir=None):
+    """Discard the journal for a key"""
+    backend(data_dir).truncate(str(key))
+
+
+def migrate(source=None, dest=None, data_dir=None):
+    """Copy everything in one backend to another; returns the number of keys copied"""
+    source, dest = backend(data_dir, kind=source), backend(data_dir, kind=dest)
+    copied = 0
+    with dest.batch():
+        for key in source.keys():
+            dest.put(key, source.get(key))
+            for data in source.entries(key):
+                dest.append(key, data)
+            copied += 1
+    return copied
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 3 or argv[0] != 'migrate':
+        raise SystemExit('usage: python -m werewolf.persist migrate SOURCE DEST  (backends: {})'.format(
+            ', '.join(BACKENDS)))
+    LOG.info('Copied %d keys in %s from %s to %s', migrate(source=argv[1], dest=argv[2]), _data_dir(),
+             argv[1], argv[2])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Compare the persistence backends
+
+    python -m werewolf.persist_bench [games]
+
+Each backend saves, lists and loads that many games, each about the size of a
+game of a dozen players part-way through."""
+
+import logging
+import sys
+import tempfile
+import time
+
+from . import persist
+
+LOG = logging.getLogger(__name__)
+
+
+class Stub:
+    def __init__(self, index):
+        self.index = index
+        self.players = ['U{:08d}'.format(i) for i in range(12)]
+        self.roles = {p: 'villager' for p in self.players}
+        self.vote_history = [{p: self.players[(i + j) % 12] for j, p in enumerate(self.players)} for i in range(10)]
+        self.notice = 'x' * 500
+
+    def save(self):
+        return self
+
+
+def timed(f):
+    start = time.perf_counter()
+    f()
+    return time.perf_counter() - start
+
+
+def bench(kind, games=2000):
+    data_dir = tempfile.mkdtemp()
+    persist.BACKEND = kind
+    backend = persist.backend(data_dir)
+    stubs = [Stub(i) for i in range(1, games + 1)]
+
+    def save_each():
+        for stub in stubs:
+            persist.save(stub.index, stub, data_dir=data_dir)
+
+    def save_batch():
+        with backend.batch():
+            save_each()
+
+    def list_all():
+        assert len(backend.keys()) == games
+
+    def load_all():
+        for stub in stubs:
+            persist.load(stub.index, factory=lambda v: v, data_dir=data_dir)
+
+    return {'save': timed(save_each), 'save (batch)': timed(save_batch),
+            'list': timed(list_all), 'load': timed(load_all)}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    games = int(argv[0]) if argv else 2000
+    results = {kind: bench(kind, games=games) for kind in persist.BACKENDS}
+    print('{} games; seconds in total'.format(games))
+    print('{:<14}'.format('') + ''.join('{:>10}'.format(kind) for kind in results))
+    for op in next(iter(results.values())):
+        print('{:<14}'.format(op) + ''.join('{:>10.3f}'.format(results[kind][op]) for kind in results))
+
+
+if __name__ == '__main__':
+    main()
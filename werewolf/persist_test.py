@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+from . import persist
+
+
+class Value:
+    def __init__(self, value):
+        self.value = value
+
+    def save(self):
+        return self.value
+
+
+@pytest.fixture(params=sorted(persist.BACKENDS))
+def data_dir(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(persist, 'BACKEND', request.param)
+    return str(tmp_path)
+
+
+def test_save_load_drop(data_dir):
+    persist.save('mux', Value([{'target': 1}]), data_dir=data_dir)
+    persist.save(1, Value({'game': 1}), data_dir=data_dir)
+    persist.save(1, Value({'game': 2}), data_dir=data_dir)
+    assert persist.load(1, factory=dict, data_dir=data_dir) == {'game': 2}
+    assert sorted(persist.keys(data_dir=data_dir)) == ['1', 'mux']
+
+    persist.drop(1, data_dir=data_dir)
+    assert persist.load(1, default=lambda: 'gone', factory=dict, data_dir=data_dir) == 'gone'
+    assert persist.keys(data_dir=data_dir) == ['mux']
+
+
+def test_batch_is_all_or_nothing(data_dir):
+    with pytest.raises(RuntimeError):
+        with persist.batch(data_dir=data_dir):
+            persist.save(1, Value(1), data_dir=data_dir)
+            raise RuntimeError()
+    if persist.BACKEND == 'sqlite':
+        assert persist.keys(data_dir=data_dir) == []
+
+
+def test_migrate(tmp_path):
+    data_dir = str(tmp_path)
+    for index in range(1, 6):
+        persist.save(index, Value(index), data_dir=data_dir)
+    assert persist.migrate(source='file', dest='sqlite', data_dir=data_dir) == 5
+    sqlite = persist.backend(data_dir, kind='sqlite')
+    assert sorted(sqlite.keys()) == ['1', '2', '3', '4', '5']
+    assert sqlite.get('3') == persist.backend(data_dir, kind='file').get('3')
+
+
+class Slow(Value):
+    def save(self):
+        time.sleep(0.2)
+        return self.value
+
+
+class Broken(Value):
+    def save(self):
+        raise RuntimeError('cannot save')
+
+
+def test_background_saves(data_dir):
+    snapshots = persist.Snapshots()
+    failures = []
+    with snapshots.background(on_failure=lambda: failures.append(2)):
+        assert persist.save(1, Slow({'game': 1}), data_dir=data_dir)
+        assert persist.save(2, Broken({'game': 2}), data_dir=data_dir)
+    assert snapshots.stats()['running'] > 0
+
+    # An ordinary save waits for the one in the background, and so comes out on top
+    persist.save(1, Value({'game': 'newer'}), data_dir=data_dir)
+    snapshots.wait()
+    assert persist.load(1, factory=dict, data_dir=data_dir) == {'game': 'newer'}
+    assert persist.load(2, default=lambda: None, factory=dict, data_dir=data_dir) is None
+    # Each child is reported just after it is done with
+    for _ in range(50):
+        if failures:
+            break
+        time.sleep(0.01)
+    stats = snapshots.stats()
+    assert (stats['saved'], stats['failed'], failures) == (1, 1, [2])
+    assert stats['last']['key'] == '1' and stats['last']['size'] > 0
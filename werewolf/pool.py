@@ -0,0 +1,180 @@
+"""A pool of spare private channels, made ahead of time
+
+Making a channel is the slowest and most rate-limited call in starting a game, and the
+service cannot delete one afterwards. With CHANNEL_POOL set to a size, each team keeps
+that many spare private channels, made in the background by a thread that allows
+POOL_INTERVAL seconds between them. A game starting takes its room and personal
+channels from the pool where it can: each need then only be renamed and have its
+players invited. When a game ends, its private channels have their players removed,
+are renamed back and return to the pool.
+
+WARNING: the service cannot clear a channel's history, so the players of a later game
+can read everything said in a recycled channel by the game before: the wolves' room
+and each player's role and private chat. The pool is therefore only used if
+CHANNEL_POOL_KEEPS_HISTORY=1 is also set, to acknowledge that.
+
+The spares, and the bot that must stay in each, are kept under DATA_DIR/pool. Only one
+process uses the pool: with SHARD_PROCESSES, games end in a shard process, which passes
+its channels back to the ingress process to return (see werewolf.shard).
+"""
+
+from collections import deque
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+
+from . import fanout, persist
+from .service import Agent, Channel
+from .service.base import supports
+
+LOG = logging.getLogger(__name__)
+
+SIZE = int(os.environ.get('CHANNEL_POOL', 0))
+KEEPS_HISTORY = os.environ.get('CHANNEL_POOL_KEEPS_HISTORY', '') not in ('', '0')
+INTERVAL = float(os.environ.get('POOL_INTERVAL', 3))
+PREFIX = 'ww-spare-'
+
+
+class ChannelPool(threading.Thread):
+    def __init__(self, srv=None, size=SIZE, interval=INTERVAL, path=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.srv = srv
+        self.size = size
+        self.interval = interval
+        self.path = path
+        self.lock = threading.Lock()
+        self.wanted = threading.Event()
+        self.bot = None
+        self.spares = deque()   # Channel
+        self.made = 0
+        self.claimed = 0
+        self.returned = 0
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            self.bot = None if state['bot'] is None else Agent(*state['bot'])
+            self.spares.extend(Channel(*c) for c in state['spares'])
+            self.made = state['made']
+        except FileNotFoundError:
+            pass
+
+    def save(self):
+        # The caller holds the lock
+        temp = self.path + '~'
+        with open(temp, 'w') as f:
+            json.dump({'bot': None if self.bot is None else list(self.bot),
+                       'spares': [list(c) for c in self.spares], 'made': self.made}, f)
+        os.rename(temp, self.path)
+
+    def new_channel(self, name=None, private=False, invite=None):
+        """Make a channel as the service would, but from the pool if we can"""
+        if not private:
+            return self.srv.new_channel(name=name, private=private, invite=invite)
+        bots = [agent for agent in invite or () if agent.is_bot]
+        with self.lock:
+            if bots and self.bot != bots[0]:
+                self.bot = bots[0]
+                self.save()
+            spare = self.spares.popleft() if self.spares else None
+            if spare is not None:
+                self.claimed += 1
+                self.save()
+        self.wanted.set()
+        if spare is None:
+            return self.srv.new_channel(name=name, private=private, invite=invite)
+        channel = self.srv.rename_channel(channel=spare, name=name)
+        # Only the bot remains in a spare, so it must do the inviting
+        self.srv.invite_to_channel(channel=channel, invite=[agent for agent in invite if agent != self.bot])
+        return channel
+
+    def give_back(self, channel=None, members=()):
+        """Clear out a finished game's channel and return it to the pool"""
+        members = [agent for agent in members if agent != self.bot]
+        if members:
+            self.srv.remove_from_channel(channel=channel, agents=members)
+        with self.lock:
+            name = '{}{}'.format(PREFIX, self.made)
+            self.made += 1
+        spare = self.srv.rename_channel(channel=channel, name=name)
+        with self.lock:
+            self.spares.append(spare)
+            self.returned += 1
+            self.save()
+
+    def run(self):
+        while True:
+            self.wanted.wait()
+            with self.lock:
+                short = self.bot is not None and len(self.spares) < self.size
+                name = '{}{}'.format(PREFIX, self.made)
+                if short:
+                    self.made += 1
+            if not short:
+                self.wanted.clear()
+                continue
+            try:
+                channel = self.srv.new_channel(name=name, private=True, invite=[self.bot])
+                with self.lock:
+                    self.spares.append(channel)
+                    self.save()
+                LOG.debug('%s made spare channel %s', self.name, channel)
+            except Exception:
+                LOG.exception('%s had a problem making a spare channel', self.name)
+            time.sleep(self.interval)
+
+    def stats(self):
+        with self.lock:
+            return {'spares': len(self.spares), 'made': self.made, 'claimed': self.claimed,
+                    'returned': self.returned}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_refused = False    # Warned that the pool is not used
+
+
+def channel_pool(srv=None, size=None, keeps_history=None):
+    """The pool for a service's team, or None if there is no pool"""
+    size = SIZE if size is None else size
+    keeps_history = KEEPS_HISTORY if keeps_history is None else keeps_history
+    team = getattr(srv, 'team', None)
+    if size <= 0 or not isinstance(team, str) or \
+            not (supports(srv, 'rename_channel') and supports(srv, 'remove_from_channel')):
+        return None
+    if not keeps_history:
+        global _refused
+        if not _refused:
+            _refused = True
+            LOG.warning('CHANNEL_POOL is ignored: recycled channels keep their history, which later players '
+                        'can read. Set CHANNEL_POOL_KEEPS_HISTORY=1 to use the pool regardless')
+        return None
+    with _pools_lock:
+        if team not in _pools:
+            LOG.warning('Recycling private channels for team %s: later players can read their history', team)
+            path = os.path.join(persist._data_dir(), 'pool')
+            os.makedirs(path, exist_ok=True)
+            _pools[team] = ChannelPool(srv=srv, size=size, path=os.path.join(path, '{}.json'.format(team)),
+                                       name='pool-{}'.format(team), daemon=True)
+            _pools[team].start()
+            _pools[team].wanted.set()
+        return _pools[team]
+
+
+def new_channel(srv=None):
+    """The way to make a channel for a game: from the pool, if the team has one"""
+    pool = channel_pool(srv)
+    return srv.new_channel if pool is None else pool.new_channel
+
+
+def give_back(srv=None, channels=()):
+    """Return a finished game's private channels, each with its members, to the team's pool"""
+    pool = channel_pool(srv)
+    if pool is None:
+        return
+    try:
+        fanout.gather(pool.give_back, [dict(channel=channel, members=members) for channel, members in channels])
+    except Exception:
+        LOG.exception('Problem returning channels to the pool for team %s', srv.team)
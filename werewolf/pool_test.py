@@ -0,0 +1,54 @@
+import os
+import time
+
+from .pool import ChannelPool, channel_pool
+from .service import Agent
+from werewolf.service.service_test import MockService
+
+BOT = Agent(id='B1', name='werewolf', is_bot=True)
+ALICE = Agent(id='U1', name='alice')
+BOB = Agent(id='U2', name='bob')
+
+
+def wait_for(f, timeout=5):
+    deadline = time.time() + timeout
+    while not f():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_channels_come_from_the_pool_and_go_back(tmpdir):
+    srv = MockService()
+    path = os.path.join(str(tmpdir), 'T1.json')
+    pool = ChannelPool(srv=srv, size=2, interval=0, path=path, daemon=True)
+    pool.start()
+
+    # Until a game has started, the pool does not know which bot to put in its spares
+    first = pool.new_channel(name='game-wolves', private=True, invite=[BOT, ALICE, BOB])
+    assert srv._in_channel[first.id] == {BOT, ALICE, BOB}
+    wait_for(lambda: pool.stats()['spares'] == 2)
+    assert len(srv._channel_cache) == 3
+
+    public = pool.new_channel(name='game', invite=[BOT, ALICE, BOB])
+    assert not public.is_private
+    claimed = pool.new_channel(name='game-alice', private=True, invite=[BOT, ALICE])
+    assert claimed.name == 'game-alice'
+    assert srv._in_channel[claimed.id] == {BOT, ALICE}
+    assert pool.stats()['claimed'] == 1
+    wait_for(lambda: pool.stats()['spares'] == 2)
+
+    pool.give_back(channel=claimed, members=[BOT, ALICE])
+    assert srv._in_channel[claimed.id] == {BOT}
+    assert srv._channel_cache[claimed.id].name.startswith('ww-spare-')
+
+    # The spares outlive the process
+    again = ChannelPool(srv=srv, size=2, interval=0, path=path)
+    assert again.bot == BOT
+    assert [c.id for c in again.spares] == [c.id for c in pool.spares]
+    assert again.stats()['spares'] == 3
+
+
+def test_the_pool_must_be_asked_for_knowing_history_is_kept():
+    srv = MockService()
+    srv.team = 'T1'
+    assert channel_pool(srv, size=2, keeps_history=False) is None
@@ -0,0 +1,53 @@
+"""A cheap classification of incoming messages, made before they are queued
+
+Most messages in a game's channels are discussion which no command will match. These
+may be dealt with at a lower priority; messages in channels that no game is using, and
+which don't mention the bot, can't affect anything at all and are dropped outright.
+Messages from dead players are always passed on, so they can be told to hush."""
+
+import logging
+import re
+from .commands import COMMANDS
+from .dispatch import QueuedOnMessage
+
+LOG = logging.getLogger(__name__)
+
+DROP = 'drop'
+CHATTER = 'chatter'
+COMMAND = 'command'
+
+MENTION = re.compile(r'<@!?(\w+)')
+
+
+def vocabulary(commands=COMMANDS):
+    return frozenset(verb for command in commands.values() for verb in command.verbs)
+
+
+class Prefilter:
+    def __init__(self, routes=None, verbs=None):
+        self.routes = routes    # Channel id: target; typically MuxDispatch.route_ids
+        self.verbs = vocabulary() if verbs is None else verbs
+
+    def classify(self, channel=None, sender=None, receivers=None, text=None):
+        text = text or ''
+        mentioned = {m.group(1) for m in MENTION.finditer(text)}
+        if any(str(rcv.id) in mentioned for rcv in receivers or ()):
+            return COMMAND
+
+        target = self.routes.get(channel.id)
+        if target is None:
+            return DROP
+
+        words = text.split(None, 1)
+        if words and words[0] in self.verbs:
+            return COMMAND
+
+        if sender is not None and any(p.id == sender.id for p in getattr(target, 'dead', ())):
+            return COMMAND
+
+        return CHATTER
+
+    def classify_item(self, m):
+        if isinstance(m, QueuedOnMessage):
+            return self.classify(channel=m.channel, sender=m.sender, receivers=m.receivers, text=m.text)
+        return COMMAND
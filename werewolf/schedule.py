@@ -1,7 +1,7 @@
 from collections import defaultdict
 from datetime import timedelta, datetime, timezone
 import re
-import time
+from . import clock
 from .parser import max_kleene, cat, alt, token, drop_token, natural, maybe, eos, map, EOS
 from .sentinel import Sentinel
 
@@ -25,7 +25,7 @@ class Schedule:
         From the start time, t, count forward delta seconds, only counting those seconds in the active periods.
         """
         if t is Schedule.NOW:
-            t = time.time()
+            t = clock.now()
         if not isinstance(delta, timedelta):
             delta = timedelta(seconds=delta)
         gmt = datetime.fromtimestamp(t, timezone.utc)
@@ -54,7 +54,7 @@ class EmptySchedule:
 
     def next_time_in_period(self, t=NOW, delta=0):
         if t is EmptySchedule.NOW:
-            t = time.time()
+            t = clock.now()
         if not isinstance(delta, timedelta):
             delta = timedelta(seconds=delta)
         gmt = datetime.fromtimestamp(t) + delta
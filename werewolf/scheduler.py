@@ -0,0 +1,115 @@
+from collections import deque, Counter, OrderedDict
+import logging
+from .dispatch import QueuedOnMessage, QueuedTick
+from .ingress import IngressQueue
+
+LOG = logging.getLogger(__name__)
+
+DEADLINE = 'deadline'
+ADMIN = 'admin'
+COMMAND = 'command'
+BACKGROUND = 'background'
+LANES = (DEADLINE, ADMIN, COMMAND, BACKGROUND)
+LANE_WEIGHTS = {DEADLINE: 8, ADMIN: 8, COMMAND: 4, BACKGROUND: 1}
+
+
+def classify(item):
+    """Choose a lane for an event
+
+    Messages addressed to the bot (to start, advance or delete a game) and oauth
+    callbacks are administrative; any other message is a player's command."""
+    if isinstance(item, QueuedTick):
+        return DEADLINE
+    if not isinstance(item, QueuedOnMessage):
+        return ADMIN
+    if any('<@{}>'.format(rcv.id) in (item.text or '') for rcv in item.receivers or ()):
+        return ADMIN
+    return COMMAND
+
+
+def team_of(item):
+    srv = getattr(item, 'srv', None)
+    return getattr(srv, 'team', None)
+
+
+class Lane:
+    """Per-team queues, served by weighted round-robin"""
+    def __init__(self, team_weights=None):
+        self.teams = OrderedDict()  # team: deque; the first team is the one being served
+        self.team_weights = team_weights or {}
+        self.credit = 0
+        self.size = 0
+
+    def push(self, team, item):
+        self.teams.setdefault(team, deque()).append(item)
+        self.size += 1
+
+    def pop(self):
+        team, items = next(iter(self.teams.items()))
+        if self.credit <= 0:
+            self.credit = self.team_weights.get(team, 1)
+        item = items.popleft()
+        self.size -= 1
+        self.credit -= 1
+        if not items:
+            del self.teams[team]
+            self.credit = 0
+        elif self.credit <= 0:
+            self.teams.move_to_end(team)
+        return team, item
+
+
+class FairScheduler(IngressQueue):
+    """An ingress queue that serves events fairly across teams and by priority
+
+    Events are sorted into lanes - phase deadlines, administrative commands, player
+    commands and background work - by `classify`. Lanes are served by weighted
+    round-robin in priority order, so that a lower lane still receives a share of the
+    service when the higher lanes are busy.
+    Within a lane, each team has its own queue, and the teams take turns (according to
+    `team_weights`); events from any one team in a lane are served in order."""
+    def __init__(self, classify=classify, lane_weights=None, team_weights=None, *args, **kwargs):
+        self.classify = classify
+        self.lane_weights = dict(LANE_WEIGHTS, **(lane_weights or {}))
+        self.team_weights = team_weights
+        super().__init__(*args, **kwargs)
+
+    def _init(self, maxsize):
+        self.lanes = OrderedDict((lane, Lane(team_weights=self.team_weights)) for lane in LANES)
+        self.lane_credit = dict(self.lane_weights)
+        self.size = 0
+        self.served = Counter()     # (lane, team): count
+
+    def _qsize(self):
+        return self.size
+
+    def _push(self, item):
+        lane = self.classify(item)
+        if lane not in self.lanes:
+            LOG.warning('Unknown lane %s for %s', lane, item)
+            lane = COMMAND
+        self.lanes[lane].push(team_of(item), item)
+        self.size += 1
+
+    def _pop(self):
+        for _ in range(2):
+            for name, lane in self.lanes.items():
+                if lane.size > 0 and self.lane_credit[name] > 0:
+                    self.lane_credit[name] -= 1
+                    team, item = lane.pop()
+                    self.size -= 1
+                    self.served[name, team] += 1
+                    return item
+            # Every busy lane has used its share: start a new round
+            self.lane_credit = dict(self.lane_weights)
+        raise IndexError('pop from an empty scheduler')
+
+    def stats(self):
+        stats = super().stats()
+        with self.mutex:
+            stats['lanes'] = {name: {'depth': lane.size,
+                                     'teams': {str(team): len(items) for team, items in lane.teams.items()},
+                                     'served': {str(team): count for (n, team), count in self.served.items()
+                                                if n == name}}
+                              for name, lane in self.lanes.items()}
+        return stats
@@ -1,3 +1,4 @@
+import asyncio
 from collections import namedtuple
 
 
@@ -44,6 +45,20 @@ class BaseService:
         Passing `None` is harmless."""
         raise NotImplementedError()
 
+    def rename_channel(self, channel=None, name=None):
+        """Give a channel a new name; returns its updated handle"""
+        raise NotImplementedError()
+
+    def remove_from_channel(self, channel=None, agents=None):
+        """Remove one or more users from a channel"""
+        raise NotImplementedError()
+
+    def open_direct(self, agent=None):
+        """Open the direct-message channel between the bot and a user
+
+        This returns a serialisable handle to the channel, which is the same each time."""
+        raise NotImplementedError()
+
     def lookup_channel(self, channel=None):
         """Given a channel, fill in any missing details from its description"""
         raise NotImplementedError()
@@ -77,4 +92,104 @@ class BaseService:
 
     def whisper(self, channel=None, agent=None, text=None):
         """Deliver a message to a single user, within a channel"""
-        raise NotImplementedError()
\ No newline at end of file
+        raise NotImplementedError()
+
+
+class AsyncBaseService:
+    """The coroutine counterpart of BaseService
+
+    Methods take the same arguments as their BaseService equivalents."""
+    async def broadcast(self, channel=None, text=None):
+        raise NotImplementedError()
+
+    async def new_channel(self, name=None, private=False, invite=None):
+        raise NotImplementedError()
+
+    async def delete_channel(self, channel=None):
+        raise NotImplementedError()
+
+    async def invite_to_channel(self, channel=None, invite=None):
+        raise NotImplementedError()
+
+    async def rename_channel(self, channel=None, name=None):
+        raise NotImplementedError()
+
+    async def remove_from_channel(self, channel=None, agents=None):
+        raise NotImplementedError()
+
+    async def open_direct(self, agent=None):
+        raise NotImplementedError()
+
+    async def lookup_channel(self, channel=None):
+        raise NotImplementedError()
+
+    async def lookup_user(self, agent=None):
+        raise NotImplementedError()
+
+    async def oauth_uri(self, scope=None, state=None):
+        raise NotImplementedError()
+
+    async def oauth_complete(self, code=None):
+        raise NotImplementedError()
+
+    async def post_notice(self, channel=None, notice=None, text=None):
+        raise NotImplementedError()
+
+    async def delete_message(self, channel=None, message_id=None):
+        raise NotImplementedError()
+
+    async def whisper(self, channel=None, agent=None, text=None):
+        raise NotImplementedError()
+
+
+def supports(srv, name):
+    """Does a service (or the asynchronous one behind a SyncService) implement this method?"""
+    service = getattr(srv, 'service', srv)
+    return getattr(type(service), name, None) not in (None, getattr(BaseService, name), getattr(AsyncBaseService, name))
+
+
+def _adapt(name):
+    def method(self, *args, **kwargs):
+        return self.call(getattr(self.service, name)(*args, **kwargs))
+    method.__name__ = name
+    method.__doc__ = getattr(BaseService, name).__doc__
+    return method
+
+
+class SyncService(BaseService):
+    """Present an AsyncBaseService to synchronous code running off the event loop thread
+
+    Each call is handed to the loop and the calling thread waits for its result."""
+    def __init__(self, service=None, loop=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.service = service
+        self.loop = loop
+
+    @property
+    def team(self):
+        return self.service.team
+
+    def call(self, coro):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            coro.close()
+            raise RuntimeError("Synchronous service calls cannot be made from the event loop thread")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    broadcast = _adapt('broadcast')
+    new_channel = _adapt('new_channel')
+    delete_channel = _adapt('delete_channel')
+    invite_to_channel = _adapt('invite_to_channel')
+    rename_channel = _adapt('rename_channel')
+    remove_from_channel = _adapt('remove_from_channel')
+    open_direct = _adapt('open_direct')
+    lookup_channel = _adapt('lookup_channel')
+    lookup_user = _adapt('lookup_user')
+    oauth_uri = _adapt('oauth_uri')
+    oauth_complete = _adapt('oauth_complete')
+    post_notice = _adapt('post_notice')
+    delete_message = _adapt('delete_message')
+    whisper = _adapt('whisper')
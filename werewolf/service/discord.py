@@ -1,27 +1,18 @@
 """A BaseService implementation that interoperates with discord
 
-This is a little awkward since the discord api works using asyncio coroutines, whereas the original slack
-implementation used synchronous calls.
-
-Due to the performance constraints on a Slack event-stream consumer, the main driver of calls to this
-service runs on a work thread (where it consumes events one-at-a-time). It'll therefore make calls to the
-Service implementation on that work thread (that is, off of the thread that runs the asyncio event loop).
-
-In order to wake the asyncio loop, we have to prod something into an asyncio.Queue to get messages into
-the handler. Responses are delivered to the waiting thread using a traditional queue.Queue. Yuck.
+The discord api works using asyncio coroutines, whereas the original slack implementation
+used synchronous calls. AsyncService implements the AsyncBaseService interface directly
+on the event loop; Service wraps it for the synchronous game code, which runs on worker
+threads (that is, off of the thread that runs the asyncio event loop).
 """
 
-import asyncio
 import cachetools
-from collections import namedtuple
 import discord
-import functools
 import logging
 import os
-import queue
 import yaml
 
-from .base import Agent, Channel, BaseService
+from .base import Channel, AsyncBaseService, SyncService
 
 LOG = logging.getLogger(__name__)
 
@@ -40,76 +31,45 @@ def token():
     return SERVICE_CONFIG['token']
 
 
-def make_sync(f):
-    @functools.wraps(f)
-    def sync(self, *args, **kwargs):
-        result_queue = queue.Queue()
-        kwargs['team'] = self.team
-        message = Service.ServiceMessage(f, (self, *args), kwargs, result_queue)
-        self.client.loop.call_soon_threadsafe(asyncio.ensure_future, self.queue.put(message))
-        return result_queue.get()
-    sync._async = f
-    return sync
-
-
-class Service(BaseService):
-    ServiceMessage = namedtuple('ServiceMessage', ('method', 'args', 'kwargs', 'result'))
-    queue = None
-
-    @classmethod
-    def init(cls, client=None):
-        cls.queue = asyncio.Queue()
-        cls.client = client
-        asyncio.ensure_future(cls._service_loop())
-
+class AsyncService(AsyncBaseService):
     def __init__(self, guild=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         self.team = guild
         self._user_cache = cachetools.TTLCache(maxsize=1024, ttl=600)
         self._channel_cache = cachetools.TTLCache(maxsize=1024, ttl=600)
 
-    @classmethod
-    async def _service_loop(cls):
-        while True:
-            message = await cls.queue.get()
-            result = await message.method(*message.args, **message.kwargs)
-            message.result.put(result)
-
-    @make_sync
-    async def broadcast(self, channel=None, text=None, team=None):
+    async def broadcast(self, channel=None, text=None):
         if not hasattr(channel, 'chan'):
-            channel = await self.lookup_channel._async(self, channel=channel, team=team)
+            channel = await self.lookup_channel(channel=channel)
         return await channel.chan.send(text)
 
-    @make_sync
-    async def new_channel(self, name=None, private=False, invite=None, team=None):
+    async def new_channel(self, name=None, private=False, invite=None):
         overwrites = {}
         if private:
             overwrites = {
-                team.default_role: discord.PermissionOverwrite(read_messages=False),
-                team.me: discord.PermissionOverwrite(read_messages=True)
+                self.team.default_role: discord.PermissionOverwrite(read_messages=False),
+                self.team.me: discord.PermissionOverwrite(read_messages=True)
             }
-        chan = await team.create_text_channel(name, overwrites=overwrites)
+        chan = await self.team.create_text_channel(name, overwrites=overwrites)
         channel = Channel(id=chan.id, name=chan.name)
         channel.chan = chan
-        await self.invite_to_channel._async(self, team=team, channel=channel, invite=invite)
+        await self.invite_to_channel(channel=channel, invite=invite)
         return channel
 
-    def delete_channel(self, channel=None, team=None):
+    async def delete_channel(self, channel=None):
         pass
 
-    @make_sync
-    async def invite_to_channel(self, channel=None, invite=None, team=None):
+    async def invite_to_channel(self, channel=None, invite=None):
         if invite is None:
             return
         if not hasattr(channel, 'chan'):
-            channel = await self.lookup_channel._async(self, channel=channel, team=team)
+            channel = await self.lookup_channel(channel=channel)
         for agent in invite:
             if not hasattr(agent, 'user'):
-                agent = await self.lookup_user._async(self, agent=agent, team=team)
+                agent = await self.lookup_user(agent=agent)
             await channel.chan.set_permissions(agent.user, read_messages=True, send_messages=True)
 
-    @make_sync
-    async def lookup_channel(self, channel=None, team=None):
+    async def lookup_channel(self, channel=None):
         if channel.name is not None:
             return channel
         cid = int(channel.id)
@@ -117,15 +77,14 @@ class Service(BaseService):
         if cached is not None:
             return cached
         # Do the lookup
-        chan = team.get_channel(cid)
+        chan = self.team.get_channel(cid)
         channel = channel.replace(id=cid, name=chan.name)
         channel.chan = chan
         self._channel_cache[channel.id] = channel
         LOG.debug('Cache records channel id %s with name %s', channel.id, channel)
         return channel
 
-    @make_sync
-    async def lookup_user(self, agent=None, team=None):
+    async def lookup_user(self, agent=None):
         LOG.debug("Looking up user details: %s", agent)
         if agent.name is not None:
             return agent
@@ -135,7 +94,7 @@ class Service(BaseService):
             LOG.debug('Cache finds agent id %r with %s', aid, cached)
             return cached
         # Do the lookup
-        user = team.get_member(aid)
+        user = self.team.get_member(aid)
         if user is not None:
             agent = agent.replace(id=aid,
                                   name=user.name,
@@ -147,20 +106,32 @@ class Service(BaseService):
         LOG.debug('Cache miss, and nothing returned for %s', agent)
         return agent
 
-    def oauth_uri(self, scope=None, state=None):
+    async def oauth_uri(self, scope=None, state=None):
         pass
 
-    def oauth_complete(self, code=None):
+    async def oauth_complete(self, code=None):
         pass
 
-    @make_sync
-    async def post_notice(self, channel=None, notice=None, text=None, team=None):
+    async def post_notice(self, channel=None, notice=None, text=None):
         pass
 
-    @make_sync
-    async def delete_message(self, channel=None, message_id=None, team=None):
+    async def delete_message(self, channel=None, message_id=None):
         pass
 
-    @make_sync
-    async def whisper(self, channel=None, agent=None, text=None, team=None):
+    async def whisper(self, channel=None, agent=None, text=None):
         pass
+
+
+class Service(SyncService):
+    client = None
+    services = {}   # guild id: AsyncService
+
+    @classmethod
+    def init(cls, client=None):
+        cls.client = client
+
+    def __init__(self, guild=None, *args, **kwargs):
+        service = Service.services.get(guild.id)
+        if service is None:
+            service = Service.services[guild.id] = AsyncService(guild=guild)
+        super().__init__(*args, service=service, loop=self.client.loop, **kwargs)
@@ -1,5 +1,6 @@
 from collections import defaultdict
 import logging
+import threading
 from werewolf.service import Channel, Notice
 
 
@@ -32,37 +33,65 @@ class MockService:
         self._in_channel = defaultdict(set)  # Channel -> {Agent}
         self.message_offset = 0
         self._messages = defaultdict(list)  # Channel -> [Text]
+        self._lock = threading.RLock()  # Games may make several calls at once
 
     def broadcast(self, channel=None, text=None):
-        self.message_offset += 1
-        text.ts = self.message_offset
-        text.channel = channel
-        for agent in self._in_channel[channel.id]:
-            if not hasattr(agent, '_messages'):
-                agent._messages = []
-            agent._messages.append(text)
-        self._messages[channel].append(text)
-        print("<{}> -> {}".format(channel.name, text))
-        return {'ts': self.message_offset}
+        with self._lock:
+            self.message_offset += 1
+            text.ts = self.message_offset
+            text.channel = channel
+            for agent in self._in_channel[channel.id]:
+                if not hasattr(agent, '_messages'):
+                    agent._messages = []
+                agent._messages.append(text)
+            self._messages[channel].append(text)
+            print("<{}> -> {}".format(channel.name, text))
+            return {'ts': self.message_offset}
 
     def new_channel(self, name=None, private=False, invite=None):
-        self.channel_offset += 1
-        channel = Channel(id="CH{}".format(self.channel_offset),
-                          name=name,
-                          is_private=private)
-        self._channel_cache[channel.id] = channel
-        LOG.debug("Creating channel: %s", channel)
+        with self._lock:
+            self.channel_offset += 1
+            channel = Channel(id="CH{}".format(self.channel_offset),
+                              name=name,
+                              is_private=private)
+            self._channel_cache[channel.id] = channel
+            LOG.debug("Creating channel: %s", channel)
 
-        # Invite the users to the channel
-        self.invite_to_channel(channel=channel, invite=invite)
-        return channel
+            # Invite the users to the channel, while the user that made it is still there to do so
+            self._in_channel[channel.id].update(invite)
+            return channel
 
     def delete_channel(self, channel=None):
         LOG.debug("Deleting channel: %s", channel)
         self._channel_cache.pop(channel.id, None)
 
     def invite_to_channel(self, channel=None, invite=None):
-        self._in_channel[channel.id].update(invite)
+        with self._lock:
+            self._must_have_bot(channel)
+            self._in_channel[channel.id].update(invite)
+
+    def _must_have_bot(self, channel):
+        # As with Slack, once a channel is made only the bot is left in it to manage it
+        assert any(agent.is_bot for agent in self._in_channel[channel.id]), 'No bot in {}'.format(channel)
+
+    def rename_channel(self, channel=None, name=None):
+        with self._lock:
+            self._must_have_bot(channel)
+            channel = channel.replace(name=name)
+            self._channel_cache[channel.id] = channel
+            return channel
+
+    def remove_from_channel(self, channel=None, agents=None):
+        with self._lock:
+            self._must_have_bot(channel)
+            self._in_channel[channel.id].difference_update(agents)
+
+    def open_direct(self, agent=None):
+        with self._lock:
+            channel = Channel(id="D{}".format(agent.id), name='@{}'.format(agent.name), is_im=True)
+            self._channel_cache[channel.id] = channel
+            self._in_channel[channel.id].add(agent)
+            return channel
 
     def lookup_channel(self, channel=None):
         if channel.id not in self._channel_cache:
@@ -3,9 +3,10 @@ import cachetools
 import logging
 import os
 import requests
+import threading
 import urllib.parse
 import yaml
-from ..sentinel import Sentinel
+from ..cluster import Cluster
 from .base import Agent, Channel, Notice, BaseService
 
 LOG = logging.getLogger(__name__)
@@ -14,19 +15,24 @@ CONFIG = None
 SERVICE_CONFIG = {}
 SERVICES = {}
 TOKENS = None
+CLUSTER = None
 
 
 def load_config():
-    global CONFIG, SERVICE_CONFIG, TOKENS
+    global CONFIG, SERVICE_CONFIG, TOKENS, CLUSTER
     CONFIG = os.environ['CONFIG']
     with open(CONFIG) as f:
         SERVICE_CONFIG = yaml.safe_load(f)
 
+    # Only the teams that this node owns are served here; the others are forwarded
+    CLUSTER = Cluster.from_config(SERVICE_CONFIG, node=os.environ.get('NODE'))
+
     TOKENS = set()
     teams = SERVICE_CONFIG['teams']
     for team in teams:
         config = teams[team]
-        SERVICES[team] = Service(team=team, config=config)
+        if CLUSTER is None or CLUSTER.owns(team):
+            SERVICES[team] = Service(team=team, config=config)
         TOKENS.add(config['token'])
 
 
@@ -34,12 +40,16 @@ def get_service(team=None):
     return SERVICES.get(team)
 
 
+def get_cluster():
+    return CLUSTER
+
+
 def validate_token(token):
     return token in TOKENS
 
 
 class Service(BaseService):
-    IM_PLACEHOLDER = Sentinel("(im)")
+    IM_PLACEHOLDER = '(im)'   # Not a possible channel name; kept as a string, so that games can save it
     OAUTH_HANDOFF = 'https://slack.com/oauth/authorize'
     OAUTH_ACCESS = 'https://slack.com/api/oauth.access'
 
@@ -54,6 +64,7 @@ class Service(BaseService):
         self.oauth_base_uri = config['oauth-uri']
         self._user_cache = cachetools.TTLCache(maxsize=1024, ttl=600)
         self._channel_cache = cachetools.TTLCache(maxsize=1024, ttl=600)
+        self._cache_lock = threading.Lock()    # Lookups may be resolved concurrently
         self.session = requests.Session()
 
     def get(self, *args, **kwargs):
@@ -89,8 +100,8 @@ class Service(BaseService):
                           is_private=j.get('channel', {}).get('is_private', False))
         LOG.info("channel created: %s", channel)
 
-        # Invite the users to the channel
-        self.invite_to_channel(channel=channel, invite=invite)
+        # Invite the users to the channel, while the user that made it is still there to do so
+        self.invite_to_channel(channel=channel, invite=invite, token=self.user)
 
         # The high-privileged user must leave the channel
         resp = self.post('https://slack.com/api/conversations.leave',
@@ -118,19 +129,46 @@ class Service(BaseService):
         j = self.json(resp)
         LOG.debug("Channel delete responds with %s", j)
 
-    def invite_to_channel(self, channel=None, invite=None):
+    def invite_to_channel(self, channel=None, invite=None, token=None):
+        # Once a channel is made, only the bot remains in it to invite anyone else
         if invite is not None:
             resp = self.post('https://slack.com/api/conversations.invite',
-                             headers={'Authorization': 'Bearer {}'.format(self.user)},
+                             headers={'Authorization': 'Bearer {}'.format(token or self.bot)},
                              json={'channel': channel.id, 'users': ','.join(user.id for user in invite)})
             self.json(resp)
         return
 
+    def rename_channel(self, channel=None, name=None):
+        LOG.debug("Renaming channel %s to %s", channel, name)
+        resp = self.post('https://slack.com/api/conversations.rename',
+                         headers={'Authorization': 'Bearer {}'.format(self.bot)},
+                         json={'channel': channel.id, 'name': name})
+        j = self.json(resp)
+        return channel.replace(name=j.get('channel', {}).get('name', name))
+
+    def remove_from_channel(self, channel=None, agents=None):
+        for agent in agents or ():
+            resp = self.post('https://slack.com/api/conversations.kick',
+                             headers={'Authorization': 'Bearer {}'.format(self.bot)},
+                             json={'channel': channel.id, 'user': agent.id})
+            self.json(resp)
+
+    def open_direct(self, agent=None):
+        resp = self.post('https://slack.com/api/conversations.open',
+                         headers={'Authorization': 'Bearer {}'.format(self.bot)},
+                         json={'users': agent.id})
+        j = self.json(resp)
+        channel = Channel(id=j.get('channel', {}).get('id'), name=Service.IM_PLACEHOLDER, is_im=True)
+        with self._cache_lock:
+            self._channel_cache[channel.id] = channel.name
+        return channel
+
     def lookup_channel(self, channel=None):
         LOG.debug("Looking up channel details: %s", channel)
         if channel.name is not None:
             return channel
-        name = self._channel_cache.get(channel.id)
+        with self._cache_lock:
+            name = self._channel_cache.get(channel.id)
         if name is not None:
             channel = channel.replace(name=name)
             LOG.debug('Cache finds channel id %s with name %s', channel.id, channel.name)
@@ -147,7 +185,8 @@ class Service(BaseService):
                         channel = channel.replace(name=Service.IM_PLACEHOLDER)
                     else:
                         channel = channel.replace(name=j.get('channel', {}).get('name'))
-                    self._channel_cache[channel.id] = channel.name
+                    with self._cache_lock:
+                        self._channel_cache[channel.id] = channel.name
                     LOG.debug('Cache records channel id %s with name %s', channel.id, channel.name)
                     return channel
 
@@ -160,7 +199,8 @@ class Service(BaseService):
         LOG.debug("Looking up user details: %s", agent)
         if agent.name is not None:
             return agent
-        cached = self._user_cache.get(agent.id)
+        with self._cache_lock:
+            cached = self._user_cache.get(agent.id)
         if cached is not None:
             LOG.debug('Cache finds agent id %s with %s', agent.id, cached)
             return cached
@@ -176,7 +216,8 @@ class Service(BaseService):
                                           is_bot=j.get('user', {}).get('is_bot', False),
                                           real_name=j.get('user', {}).get('real_name', ""))
 
-                    self._user_cache[agent.id] = agent
+                    with self._cache_lock:
+                        self._user_cache[agent.id] = agent
                     LOG.debug('Cache records agent id %s with %s', agent.id, agent)
                     return agent
 
@@ -0,0 +1,266 @@
+"""Run SpecificWerewolf games in a pool of worker processes
+
+The ingress process keeps the lobby (the default target) and the routing tables. Each
+game is owned by exactly one shard process, chosen by its index; the ingress process
+only holds a RemoteTarget stub for it. Shards load their games from persistence, so
+all processes must share a DATA_DIR.
+
+Requests to a shard are small tuples:
+
+    (MESSAGE, team, index, sender, receivers, channel, text, message_id, seq)
+    (TICK, team, index)
+    (ADVANCE, team, index)
+    (ADOPT, team, index)
+
+where agents, channels and text are encoded by werewolf.wire. Shards reply with
+
+    (DEADLINE, index, phase_shift, dead)
+
+after each request, so the ingress process can schedule the game's next tick (and know
+whose messages its prefilter must pass on; see werewolf.prefilter), and
+
+    (DONE, seq)
+
+once a journalled message (see werewolf.inbound) has been handled and its game written
+out, or
+
+    (DELETE, index, channels)
+
+when a game has finished and its routing should be dropped. The channels are those the
+ingress process may return to a channel pool, as [channel, [agent]] pairs; shards do
+not use the pool themselves (see werewolf.pool).
+"""
+
+import logging
+import multiprocessing
+import threading
+import time
+
+from . import persist, pool
+from .dispatch import MuxDispatch, DeleteTarget
+from .game import SpecificWerewolf
+from .service import Agent, Channel
+from .wire import encode_agent, decode_agent, encode_channel, decode_channel, encode_text, decode_text
+
+LOG = logging.getLogger(__name__)
+
+MESSAGE = 'm'
+TICK = 't'
+ADVANCE = 'a'
+ADOPT = 'l'
+DELETE = 'd'
+DEADLINE = 's'
+DONE = 'k'
+
+
+class RemoteTarget:
+    """The ingress process's stand-in for a game owned by a shard process"""
+    def __init__(self, team=None, index=None, inbox=None, phase_shift=None, dead=()):
+        self.team = team
+        self.index = index
+        self.inbox = inbox
+        self.phase_shift = phase_shift  # As last reported by the shard
+        self.dead = list(dead)          # Likewise
+        self.dirty = False              # The shard writes out the game itself
+
+    def on_message(self, srv=None, sender=None, receivers=None, channel=None, text=None, seq=None):
+        self.inbox.put((MESSAGE, self.team, self.index,
+                        encode_agent(sender), [encode_agent(r) for r in receivers or []],
+                        encode_channel(channel), encode_text(text), getattr(text, 'message_id', None), seq))
+
+    def tick(self, srv=None, srv_lookup=None):
+        self.inbox.put((TICK, self.team, self.index))
+
+    def advance(self):
+        self.inbox.put((ADVANCE, self.team, self.index))
+
+    def adopt(self):
+        self.inbox.put((ADOPT, self.team, self.index))
+
+    def persist(self):
+        """The owning shard persists the game"""
+
+    def __repr__(self):
+        return 'RemoteTarget(team={!r}, index={!r})'.format(self.team, self.index)
+
+
+def shard_main(inbox=None, outbox=None, data_dir=None, srv_lookup=None, target_factory=None, initializer=None):
+    """The main loop of a shard process"""
+    if initializer is not None:
+        initializer()
+    persist.DATA_DIR = data_dir
+    pool.SIZE = 0   # The ingress process alone makes and takes back pooled channels
+    games = {}
+
+    while True:
+        request = inbox.get()
+        if request is None:
+            break
+        op, team, index = request[:3]
+        seq = request[8] if op == MESSAGE else None
+        try:
+            game = games.get(index)
+            if game is None:
+                game = games[index] = persist.load(index, default=lambda: None, factory=target_factory)
+            if game is None:
+                LOG.warning('Shard has no game %s for request %s', index, op)
+                outbox.put((DELETE, index, []))
+                continue
+            srv = srv_lookup(team)
+            if srv is None:
+                continue
+
+            if op == MESSAGE:
+                sender, receivers, channel, text, message_id = request[3:8]
+                result = game.on_message(srv=srv, sender=decode_agent(sender),
+                                         receivers=[decode_agent(r) for r in receivers],
+                                         channel=decode_channel(channel), text=decode_text(text, message_id))
+            elif op == TICK:
+                result = game.tick(srv=srv)
+            elif op == ADVANCE:
+                game.phase_shift = time.time()
+                result = game.tick(srv=srv)
+            else:
+                result = None
+
+            for item in result or ():
+                if isinstance(item, DeleteTarget):
+                    games.pop(index, None)
+                    outbox.put((DELETE, index, [[encode_channel(c), [encode_agent(a) for a in members]]
+                                                for c, members in game.pooled_channels()]))
+                else:
+                    LOG.warning('Shard cannot handle response from game %s: %s', index, item)
+            if getattr(game, 'dirty', True):
+                game.persist()
+            if index in games:
+                outbox.put((DEADLINE, index, game.phase_shift, [encode_agent(p) for p in game.dead]))
+        except Exception:
+            LOG.exception('Problem handling shard request %s for game %s', op, index)
+        finally:
+            if seq is not None:
+                outbox.put((DONE, seq))
+
+
+class ProcessShardDispatch(MuxDispatch):
+    """A MuxDispatch which hands its games off to a pool of worker processes
+
+    The lobby still runs on the dispatcher thread of the ingress process."""
+    def __init__(self, processes=2, srv_lookup=None, target_factory=None, initializer=None, context=None,
+                 *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if target_factory is None:
+            target_factory = SpecificWerewolf.load
+        ctx = multiprocessing.get_context(context)
+        self.outbox = ctx.Queue()
+        self.inboxes = [ctx.Queue() for _ in range(max(processes, 1))]
+        self.processes = [ctx.Process(target=shard_main, name='shard-{}'.format(i), daemon=True,
+                                      kwargs=dict(inbox=inbox, outbox=self.outbox, data_dir=persist._data_dir(),
+                                                  srv_lookup=srv_lookup, target_factory=target_factory,
+                                                  initializer=initializer))
+                          for i, inbox in enumerate(self.inboxes)]
+        self.srv_lookup = srv_lookup
+        self.remote = {}    # index: RemoteTarget
+        self.collector = threading.Thread(target=self.collect, name='shard-collector', daemon=True)
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        self.collector.start()
+        super().start()
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join()
+
+    def inbox(self, index):
+        return self.inboxes[hash(index) % len(self.inboxes)]
+
+    def stub(self, team=None, index=None, phase_shift=None, dead=()):
+        target = self.remote[index] = RemoteTarget(team=team, index=index, inbox=self.inbox(index),
+                                                   phase_shift=phase_shift, dead=dead)
+        return target
+
+    def register(self, handler, channels):
+        if not isinstance(handler, RemoteTarget):
+            # A freshly-started game: write it out and hand it to its shard
+            handler.persist()
+            handler = self.stub(team=handler.team, index=handler.index, phase_shift=handler.phase_shift,
+                                dead=handler.dead)
+            handler.adopt()
+        super().register(handler, channels)
+
+    def unregister(self, handler):
+        self.remote.pop(handler.index, None)
+        super().unregister(handler)
+
+    def target_message(self, target, srv=None, sender=None, receivers=None, channel=None, text=None):
+        if not isinstance(target, RemoteTarget):
+            return super().target_message(target, srv=srv, sender=sender, receivers=receivers, channel=channel,
+                                          text=text)
+        # The event is done once the shard has handled it and written out its game, not when it is sent
+        seq = getattr(self.current, 'seq', None) if self.inbound is not None else None
+        if seq is not None:
+            self.inbound.hold(seq)
+        target.on_message(srv=srv, sender=sender, receivers=receivers, channel=channel, text=text, seq=seq)
+        self.touch(target)
+
+    def target_tick(self, target, srv=None):
+        if not isinstance(target, RemoteTarget):
+            return super().target_tick(target, srv=srv)
+        # The deadline we hold has passed: wait for the shard to report the next one, or
+        # wake the game again later if it never does
+        self.retry(target)
+        target.tick(srv=srv)
+        self.touch(target)
+
+    def target_advance(self, target, srv=None):
+        target.advance()
+
+    def collect(self):
+        """Apply replies from the shards to the routing tables"""
+        while True:
+            reply = self.outbox.get()
+            try:
+                if reply[0] == DELETE:
+                    with self.lock:
+                        target = self.remote.get(reply[1])
+                        if target is not None:
+                            self.unregister(target)
+                            self.persist()
+                    if target is not None and reply[2]:
+                        pool.give_back(srv=self.srv_lookup(target.team),
+                                       channels=[(decode_channel(c), [decode_agent(a) for a in members])
+                                                 for c, members in reply[2]])
+                elif reply[0] == DONE:
+                    self.inbound.release(reply[1])
+                elif reply[0] == DEADLINE:
+                    with self.lock:
+                        target = self.remote.get(reply[1])
+                        if target is not None:
+                            target.phase_shift = reply[2]
+                            target.dead = [decode_agent(p) for p in reply[3]]
+                            self.arm(target)
+            except Exception:
+                LOG.exception('Problem handling shard reply %s', reply)
+
+    @classmethod
+    def load(cls, value, default_type=None, default_factory=None, target_factory=None, **kwargs):
+        """Reload the routing tables only; the shards load the games themselves"""
+        default = persist.load('default', default=default_type, factory=default_factory)
+        loaded = cls(default=default, target_factory=target_factory, **kwargs)
+        for item in value:
+            team = item.get('team')
+            if team is None:
+                game = persist.load(item['target'], default=lambda: None, factory=target_factory)
+                if game is None:
+                    continue
+                team = game.team
+            # Wake each game promptly, so its shard reports its real deadline
+            target = loaded.stub(team=team, index=item['target'], phase_shift=time.time(),
+                                 dead=[Agent(id=p) for p in item.get('dead', ())])
+            loaded.route(target, [Channel(id=c) for c in item['channels']])
+            loaded.arm(target)
+        loaded.dirty = False
+        return loaded
@@ -0,0 +1,66 @@
+import pytest
+import queue
+import time
+from . import persist
+from .game import GeneralWerewolf, SpecificWerewolf
+from .game_test import simple_rules, factory
+from .roles import EVIL
+from .shard import ProcessShardDispatch, RemoteTarget, TICK
+from .text import Text
+from werewolf.service.service_test import get_service
+
+
+def test_game_runs_in_shard(tmp_path, rules=simple_rules):
+    persist.DATA_DIR = str(tmp_path)
+    srv, bot, players, game = factory(rules)
+    srv = get_service(game.team)
+    mux = ProcessShardDispatch(processes=2, srv_lookup=get_service, target_factory=SpecificWerewolf.load,
+                               queue=queue.Queue(), default=GeneralWerewolf(), context='fork', daemon=True)
+
+    mux.process(game.start(srv=srv, bot=bot))
+    [target] = mux.target_map
+    assert isinstance(target, RemoteTarget)
+    assert mux.channel_map[game.public] is target
+    assert (tmp_path / str(game.index)).exists()
+
+    # The stand-in keeps the dead players, for the prefilter
+    target.dead = [game.players[0]]
+    reloaded = ProcessShardDispatch.load(mux.save(), default_type=GeneralWerewolf, target_factory=SpecificWerewolf.load,
+                                         processes=1, srv_lookup=get_service, queue=queue.Queue())
+    [stub] = reloaded.target_map
+    assert [p.id for p in stub.dead] == [game.players[0].id]
+    target.dead = []
+
+    mux.start()
+    try:
+        for r in [game.roles[p] for p in game.players if game.roles[p].role.team == EVIL]:
+            mux.on_message(srv=srv, sender=r.player, receivers=[bot], channel=r.channel, text=Text("concede"))
+
+        deadline = time.time() + 10
+        while mux.target_map and time.time() < deadline:
+            time.sleep(0.05)
+        assert mux.target_map == {}
+        assert mux.channel_map == {}
+        assert not (tmp_path / str(game.index)).exists()
+    finally:
+        mux.stop()
+
+
+def test_a_silent_shard_is_not_ticked_again_at_once(tmp_path):
+    persist.DATA_DIR = str(tmp_path)
+    mux = ProcessShardDispatch(processes=1, srv_lookup=get_service, queue=queue.Queue(), default=GeneralWerewolf(),
+                               context='fork')
+    # As after a restart: the deadline has passed, and the shard has not said what the next one is
+    target = mux.stub(team='T1', index=1, phase_shift=time.time() - 1)
+    mux.route(target, [])
+    mux.arm(target)
+
+    before = time.time()
+    for _ in range(3):
+        mux.tick(srv_lookup=get_service)
+    assert not mux.deadlines.wait(timeout=0.1)
+
+    assert target.inbox.get(timeout=1) == (TICK, 'T1', 1)
+    with pytest.raises(queue.Empty):
+        target.inbox.get(timeout=0.2)
+    assert before + mux.tick_retry <= mux.deadlines.next() <= time.time() + mux.tick_retry
@@ -0,0 +1,84 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class Deadlines:
+    """Track the next moment at which each target needs to be woken
+
+    Each target has at most one deadline; arming it again replaces the old one.
+    A timer thread calls wait(), which returns once some deadline has passed; the
+    targets that are due are then collected with take()."""
+    def __init__(self):
+        self.heap = []      # (when, seq, target)
+        self.when = {}      # target: when
+        self.fired = set()
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+
+    def arm(self, target, when, sooner=False):
+        """Set a target's deadline; with `sooner`, an earlier deadline already set is kept"""
+        with self.cond:
+            if when is None:
+                self.when.pop(target, None)
+                return
+            if sooner and self.when.get(target, when) < when:
+                return
+            self.when[target] = when
+            heapq.heappush(self.heap, (when, next(self.seq), target))
+            self.cond.notify_all()
+
+    def disarm(self, target):
+        with self.cond:
+            self.when.pop(target, None)
+            self.fired.discard(target)
+
+    def next(self):
+        """The earliest live deadline, or None"""
+        with self.cond:
+            self._trim()
+            return self.heap[0][0] if self.heap else None
+
+    def _trim(self):
+        # Discard heap entries that have been re-armed or disarmed
+        while self.heap and self.when.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+
+    def _fire(self, now):
+        fired = 0
+        while True:
+            self._trim()
+            if not self.heap or self.heap[0][0] > now:
+                return fired
+            when, _, target = heapq.heappop(self.heap)
+            del self.when[target]
+            self.fired.add(target)
+            fired += 1
+
+    def wait(self, timeout=None):
+        """Block until another deadline passes (or the timeout expires)
+
+        Returns True if more targets have become ready to take()."""
+        limit = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while True:
+                now = time.time()
+                if self._fire(now) > 0:
+                    return True
+                wake = self.heap[0][0] if self.heap else None
+                if limit is not None and (wake is None or limit < wake):
+                    wake = limit
+                if limit is not None and now >= limit:
+                    return False
+                self.cond.wait(None if wake is None else wake - now)
+
+    def take(self, now=None):
+        """Collect every target whose deadline has passed"""
+        with self.cond:
+            self._fire(time.time() if now is None else now)
+            fired, self.fired = self.fired, set()
+            return fired
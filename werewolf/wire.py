@@ -0,0 +1,56 @@
+"""A compact encoding of agents, channels and text for passing between processes
+
+Everything encodes to plain tuples, lists, strings and numbers, so the result may be
+pickled cheaply or written out as JSON."""
+
+from .service import Agent, Channel
+from .text import Text
+
+AGENT = 'a'
+CHANNEL = 'c'
+
+
+def encode_agent(agent):
+    return None if agent is None else list(agent)
+
+
+def decode_agent(value):
+    return None if value is None else Agent(*value)
+
+
+def encode_channel(channel):
+    return None if channel is None else list(channel)
+
+
+def decode_channel(value):
+    return None if value is None else Channel(*value)
+
+
+def encode_text(text):
+    if text is None or isinstance(text, str):
+        return text
+    rope = []
+    for item in text:
+        if isinstance(item, Agent):
+            rope.append([AGENT] + list(item))
+        elif isinstance(item, Channel):
+            rope.append([CHANNEL] + list(item))
+        else:
+            rope.append(item)
+    return rope
+
+
+def decode_text(value, message_id=None):
+    if value is None or isinstance(value, str):
+        return value
+    rope = []
+    for item in value:
+        if isinstance(item, list) and item[0] == AGENT:
+            rope.append(Agent(*item[1:]))
+        elif isinstance(item, list) and item[0] == CHANNEL:
+            rope.append(Channel(*item[1:]))
+        else:
+            rope.append(item)
+    text = Text(*rope)
+    text.message_id = message_id
+    return text